@@ -0,0 +1,148 @@
+"""Tracking Slack acks for messages sent over the websocket"""
+import time
+from collections import OrderedDict
+
+
+class PendingAck(object):
+    """A sent message that Slack hasn't acked yet"""
+
+    __slots__ = ('payload', 'channel', 'sent_at', 'last_sent_at', 'tries')
+
+    def __init__(self, payload, sent_at, channel=None):
+        self.payload = payload
+        self.channel = channel
+        self.sent_at = sent_at
+        self.last_sent_at = sent_at
+        self.tries = 1
+
+
+class AckTracker(object):
+    """Bounded record of sent messages waiting for a reply_to ack
+
+    Messages are kept in send order by their local event id. A message that
+    isn't acked within resend_after seconds is due to be sent again, up to
+    max_tries sends in all, unless a newer message has been sent to the same
+    channel since, or is waiting to be (it has a newer queue). A resend goes
+    out as a new message,
+    and the next message sent to the channel takes over the tries and first
+    send time of the one it replaces. Messages still unacked after
+    expire_after seconds, or pushed out by more than max_size newer ones, are
+    dropped and counted.
+    """
+
+    def __init__(self, max_size=1000, resend_after=5, max_tries=3, expire_after=30,
+                 clock=time.monotonic):
+        self.max_size = max_size
+        self.resend_after = resend_after
+        self.max_tries = max_tries
+        self.expire_after = expire_after
+        self._clock = clock
+
+        # Local event id -> PendingAck, oldest first
+        self._pending = OrderedDict()
+        # Channel -> id of the last message sent to it, and the message being resent to it
+        self._latest = {}
+        self._resending = {}
+
+        self.acked_count = 0
+        self.error_count = 0
+        self.resent_count = 0
+        self.superseded_count = 0
+        self.dropped_count = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def sent(self, event_id, payload, channel=None):
+        """Record that a message was sent (to channel, if given) and is waiting for an ack"""
+
+        pending = self._pending[event_id] = PendingAck(payload, self._clock(), channel)
+        if channel is not None:
+            self._latest[channel] = event_id
+            resent = self._resending.pop(channel, None)
+            if resent is not None:
+                pending.sent_at = resent.sent_at
+                pending.tries = resent.tries + 1
+
+        while len(self._pending) > self.max_size:
+            self._pending.popitem(last=False)
+            self.dropped_count += 1
+
+    def acked(self, event_id, ok=True):
+        """Record Slack's ack for a message
+
+        Returns the seconds from the first send to the ack, or None if the
+        message isn't being tracked (already acked, expired, or never sent).
+        """
+
+        pending = self._pending.pop(event_id, None)
+        if pending is None:
+            return None
+
+        latency = self._clock() - pending.sent_at
+        self.acked_count += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        if not ok:
+            self.error_count += 1
+
+        return latency
+
+    def due(self, waiting=()):
+        """Return (event id, channel, payload) for each message that should be resent
+
+        Each message returned stops being tracked, as it's to be sent again
+        as a new message. Also drops messages that have expired, run out of
+        tries, or been superseded by a newer message to the same channel:
+        one that's been sent, or one waiting to be sent to a channel in
+        waiting (like a MessageScheduler).
+        """
+
+        now = self._clock()
+        to_resend = []
+
+        for event_id, pending in list(self._pending.items()):
+            # Everything after this was sent more recently, so it isn't due
+            if now - pending.last_sent_at < min(self.resend_after, self.expire_after):
+                break
+
+            if now - pending.sent_at >= self.expire_after:
+                del self._pending[event_id]
+                self.dropped_count += 1
+            elif now - pending.last_sent_at >= self.resend_after:
+                del self._pending[event_id]
+                if pending.tries >= self.max_tries:
+                    self.dropped_count += 1
+                elif pending.channel is not None and (self._latest[pending.channel] != event_id
+                                                      or pending.channel in waiting):
+                    self.superseded_count += 1
+                else:
+                    if pending.channel is not None:
+                        self._resending[pending.channel] = pending
+                    self.resent_count += 1
+                    to_resend.append((event_id, pending.channel, pending.payload))
+
+        return to_resend
+
+    def mean_latency(self):
+        """Return the average seconds from send to ack, or None if nothing's been acked"""
+
+        if self.acked_count:
+            return self.total_latency / self.acked_count
+        return None
+
+    def __len__(self):
+        """Number of messages waiting for an ack"""
+        return len(self._pending)
+
+    def __contains__(self, event_id):
+        return event_id in self._pending
+
+    def __repr__(self):
+        """Representation of the tracker"""
+
+        mean = self.mean_latency()
+        mean_ms = f"{mean * 1000:.0f}ms" if mean is not None else "n/a"
+        return (f"<Ack Tracker: pending={len(self._pending)} acked={self.acked_count} "
+                f"errors={self.error_count} resent={self.resent_count} "
+                f"superseded={self.superseded_count} dropped={self.dropped_count} "
+                f"mean_latency={mean_ms}>")
@@ -0,0 +1,54 @@
+"""Jittered exponential backoff for reconnecting to Slack"""
+import random
+import time
+from collections import deque
+
+
+class Backoff(object):
+    """Delays between reconnect attempts
+
+    Each failed attempt doubles the delay ceiling, starting at base seconds and
+    capped at cap seconds, and the actual delay is picked at random up to the
+    ceiling ("full jitter") so many bots don't reconnect in lockstep. If more
+    than max_attempts attempts happen within window seconds, the delay is at
+    least storm_delay, to stop a reconnect storm.
+    """
+
+    def __init__(self, base=1, cap=60, max_attempts=10, window=60, storm_delay=60,
+                 clock=time.monotonic, rand=random.random):
+        self.base = base
+        self.cap = cap
+        self.max_attempts = max_attempts
+        self.window = window
+        self.storm_delay = storm_delay
+        self._clock = clock
+        self._rand = rand
+
+        self.failures = 0
+        # Times of the latest attempts, just enough to spot a storm
+        self._attempts = deque(maxlen=max_attempts + 1)
+
+    def next_delay(self):
+        """Record an attempt and return how many seconds to wait before it"""
+
+        now = self._clock()
+        self._attempts.append(now)
+
+        # The cap kicks in long before 2 ** 32, and the exponent can't run away
+        ceiling = min(self.cap, self.base * 2 ** min(self.failures, 32))
+        delay = self._rand() * ceiling
+        self.failures += 1
+
+        storm = len(self._attempts) > self.max_attempts and now - self._attempts[0] <= self.window
+        if storm:
+            delay = max(delay, self.storm_delay)
+        return delay
+
+    def reset(self):
+        """Start over from the base delay after a healthy connection"""
+
+        self.failures = 0
+
+    def __repr__(self):
+        """Representation of the backoff"""
+        return f"<Backoff: failures={self.failures} base={self.base} cap={self.cap}>"
@@ -0,0 +1,55 @@
+"""Batching of commands that arrive together"""
+
+
+class CommandBatcher(object):
+    """Collect commands that arrive together and hand them over as one batch
+
+    Commands added in the same loop tick (or, if window is given, within
+    window seconds of the first one) are passed to handle as one list of
+    (channel, user, text), in the order they were added, so a burst of
+    commands in a channel costs one response instead of one each.
+    """
+
+    def __init__(self, handle, loop, window=0):
+        self.handle = handle
+        self.loop = loop
+        self.window = window
+        self._pending = []
+        self._flush_handle = None
+
+        self.batches = 0
+        self.commands = 0
+        self.largest = 0
+
+    def add(self, channel, user, text):
+        """Add a command to the next batch"""
+
+        self._pending.append((channel, user, text))
+        if self._flush_handle is None:
+            if self.window:
+                self._flush_handle = self.loop.call_later(self.window, self.flush)
+            else:
+                self._flush_handle = self.loop.call_soon(self.flush)
+
+    def flush(self):
+        """Hand every pending command to handle now"""
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            self.batches += 1
+            self.commands += len(batch)
+            self.largest = max(self.largest, len(batch))
+            self.handle(batch)
+
+    def __len__(self):
+        """Number of commands waiting for the next batch"""
+        return len(self._pending)
+
+    def __repr__(self):
+        """Representation of the batcher"""
+        return (f"<Command Batcher: window={self.window} batches={self.batches} "
+                f"commands={self.commands} largest={self.largest}>")
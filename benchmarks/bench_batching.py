@@ -0,0 +1,88 @@
+"""Measure CPU per command as bursts grow, handling each command alone vs a tick's worth at once
+
+Run from the repo root with: python -m benchmarks.bench_batching
+"""
+import asyncio
+import time
+
+import qbot
+from batching import CommandBatcher
+from myqueue import QueueRegistry
+
+CHANNELS = 4
+# Users already waiting in each channel, so rendering a queue isn't free
+WAITING = 200
+BURST_SIZES = (1, 10, 100, 1000)
+COMMANDS = 20_000
+
+
+class RenderingOutbox(object):
+    """Stand-in outbox that renders every message it's given, like one send each"""
+
+    def __init__(self):
+        self.sent = 0
+
+    def send(self, channel, notice='', state=None):
+        str(state)
+        self.sent += 1
+
+
+def make_burst(size, start):
+    """Return a burst of commands spread over the channels: joins, repeats, and leaves"""
+
+    commands = []
+    for i in range(start, start + size):
+        user = f'<@U{i % 500:06d}>'
+        text = ('nq', 'nq', f'omw {user}')[i % 3]
+        commands.append((f'C{i % CHANNELS}', user, text))
+    return commands
+
+
+def setup():
+    qbot.QUEUES = QueueRegistry()
+    for channel in range(CHANNELS):
+        for user in range(WAITING):
+            qbot.QUEUES.get(f'C{channel}').push(f'<@W{user:06d}>')
+    qbot.OUTBOX = RenderingOutbox()
+
+
+def one_at_a_time(size):
+    """Return CPU seconds per command with a handle_message task per command"""
+
+    setup()
+    loop = qbot.EVENT_LOOP
+    start = time.process_time()
+    for offset in range(0, COMMANDS, size):
+        for channel, user, text in make_burst(size, offset):
+            loop.create_task(qbot.handle_message(qbot.OUTBOX, channel, user, text))
+        loop.run_until_complete(asyncio.sleep(0))
+    return (time.process_time() - start) / COMMANDS
+
+
+def batched(size):
+    """Return CPU seconds per command with every burst handled as one batch"""
+
+    setup()
+    loop = qbot.EVENT_LOOP
+    batcher = CommandBatcher(qbot.handle_batch, loop)
+    start = time.process_time()
+    for offset in range(0, COMMANDS, size):
+        for channel, user, text in make_burst(size, offset):
+            batcher.add(channel, user, text)
+        loop.run_until_complete(asyncio.sleep(0))
+    return (time.process_time() - start) / COMMANDS
+
+
+def main():
+    qbot.LOGGER.disabled = True
+    print(f"{COMMANDS:,} commands over {CHANNELS} channels, {WAITING} users waiting in each")
+    print(f"{'burst':>6} {'one at a time':>16} {'batched':>16}")
+    for size in BURST_SIZES:
+        alone = one_at_a_time(size)
+        together = batched(size)
+        print(f"{size:>6} {alone * 1e6:>13.1f} us {together * 1e6:>13.1f} us "
+              f"({alone / together:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""Measure event throughput on presence-heavy traffic with and without pre-decode filtering
+
+Run from the repo root with: python -m benchmarks.bench_filter
+"""
+import time
+
+import qbot
+from benchmarks.bench_logging import make_events
+from eventfilter import EventFilter
+from mocks import MockWebSocket
+
+
+def events_per_second(events, event_filter=None):
+    """Return how many raw events per second get filtered and parsed"""
+
+    websocket = MockWebSocket()
+    start = time.perf_counter()
+    for event in events:
+        if event_filter and event_filter.drop_reason(event):
+            continue
+        qbot.parse_event(websocket, event)
+    return len(events) / (time.perf_counter() - start)
+
+
+def main():
+    # 90% presence changes, like a busy workspace with presence_sub on
+    events = make_events()
+    qbot.LOGGER.disabled = True
+
+    unfiltered = events_per_second(events)
+    print(f"{'decode everything':<24} {unfiltered:>10,.0f} events/s")
+
+    event_filter = EventFilter()
+    filtered = events_per_second(events, event_filter)
+    print(f"{'filter before decoding':<24} {filtered:>10,.0f} events/s "
+          f"({filtered / unfiltered:.1f}x, {event_filter.dropped_types:,} dropped)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Replace a running bot with a new instance mid-stream and measure the handoff gap
+
+Two bot processes share a state directory and connect to a local fake Slack
+that streams the same events to every connection, like Slack does. The first
+runs alone for a while, then the second starts up, connects, and takes over.
+Every event is a different user joining a queue, so the saved queues show
+whether any command was missed, and "already in the queue" replies show
+whether any was acted on twice. The same stream with no handoff is the
+baseline.
+
+Run from the repo root with, e.g.:
+    python -m benchmarks.bench_handoff --rate 500 --seconds 4
+"""
+import argparse
+import os
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from fakeslack import FakeSlack
+from journal import unpack_state
+
+CHANNELS = 20
+
+
+def make_events(count):
+    """Return count enqueue messages, each from a different user, with fixed timestamps"""
+
+    return [{'type': 'message', 'channel': f'C{i % CHANNELS:08d}', 'user': f'U{i:08d}',
+             'text': 'nq', 'ts': f'{1000000 + i}.000100'} for i in range(count)]
+
+
+def start_bot(fake, state_dir):
+    """Start a bot process against the fake Slack, keeping its logs"""
+
+    env = dict(os.environ, SLACK_BOT_TOKEN='fake-token', SLACK_API_URL=fake.api_url,
+               QBOT_STATE_DIR=state_dir, QBOT_METRICS_PORT='0', QBOT_SEND_INTERVAL='0',
+               QBOT_LOG_LEVEL='INFO')
+    log = tempfile.TemporaryFile(mode='w+')
+    process = subprocess.Popen([sys.executable, 'qbot.py'], env=env, stderr=log,
+                               stdout=subprocess.DEVNULL, cwd=os.getcwd())
+    return process, log
+
+
+def stop_bot(process, log):
+    """Stop a bot process (if it hasn't already exited) and return its logs"""
+
+    if process.poll() is None:
+        process.send_signal(signal.SIGINT)
+    process.wait(10)
+    log.seek(0)
+    return log.read()
+
+
+def run(rate, seconds, handoff):
+    """Stream events to one bot, handing over to a second partway if handoff; return the results"""
+
+    events = make_events(int(rate * seconds))
+    fake = FakeSlack(events, rate=rate, drain_timeout=2, broadcast=True).start()
+    logs = []
+    try:
+        with tempfile.TemporaryDirectory() as state_dir:
+            bots = [start_bot(fake, state_dir)]
+            if handoff:
+                # Start the new instance partway through the stream
+                while fake.started_at is None:
+                    time.sleep(0.01)
+                time.sleep(max(0, fake.started_at + seconds * 0.4 - time.perf_counter()))
+                handoff_at = time.perf_counter()
+                bots.append(start_bot(fake, state_dir))
+
+            while fake.finished_at is None:
+                time.sleep(0.05)
+            logs = [stop_bot(*bot) for bot in bots]
+
+            with open(os.path.join(state_dir, 'snapshot.bin'), 'rb') as snapshot:
+                _, queues = unpack_state(snapshot.read())
+    finally:
+        fake.stop()
+
+    # Every user should be in their channel's queue once, in order
+    expected = {}
+    for event in events:
+        expected.setdefault(event['channel'], []).append(f"<@{event['user']}>")
+    missed = sum(len(set(users) - set(queues.get(channel, [])))
+                 for channel, users in expected.items())
+    out_of_order = sum(queues.get(channel, []) != users for channel, users in expected.items())
+    twice = sum(msg.get('text', '').count("already in the queue") for msg in fake.received)
+
+    answered = sorted(fake.answered_at)
+    quiet = max((later - earlier for earlier, later in zip(answered, answered[1:])), default=0)
+    results = {'report': fake.report(), 'missed': missed, 'out_of_order': out_of_order,
+               'twice': twice, 'quiet_ms': quiet * 1000}
+
+    if handoff:
+        took = re.search(r'Took over from pid \d+ in ([\d.]+) ms', logs[1])
+        stopped = re.search(r'Handing over \d+ queue\(s\) after ([\d.]+) ms', logs[0])
+        results['takeover_ms'] = float(took.group(1)) if took else None
+        results['handing_ms'] = float(stopped.group(1)) if stopped else None
+        # How far into the stream the new instance was started
+        results['handoff_started'] = handoff_at - fake.started_at
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rate', type=int, default=500, help="events per second")
+    parser.add_argument('--seconds', type=float, default=4, help="how long to stream for")
+    args = parser.parse_args()
+
+    print(f"{int(args.rate * args.seconds):,} commands at {args.rate:,}/s over {CHANNELS} channels")
+    for handoff in (False, True):
+        results = run(args.rate, args.seconds, handoff)
+        report = results['report']
+        print(f"{'handoff' if handoff else 'no handoff':<11} "
+              f"answered {report['commands_answered']:>5,}  unanswered {report['commands_unanswered']}  "
+              f"missed {results['missed']}  twice {results['twice']}  "
+              f"out of order {results['out_of_order']}  "
+              f"p50 {report['p50_ms']:>6.2f} ms  p99 {report['p99_ms']:>7.2f} ms  "
+              f"max {report['max_ms']:>7.2f} ms  longest gap between replies {results['quiet_ms']:.1f} ms")
+        if handoff:
+            print(f"{'':<11} new instance started {results['handoff_started']:.2f} s in; "
+                  f"took over {results['takeover_ms']} ms after connecting "
+                  f"(the old one stopped {results['handing_ms']} ms after being asked)")
+
+
+if __name__ == '__main__':
+    main()
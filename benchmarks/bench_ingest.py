@@ -0,0 +1,99 @@
+"""Measure message latency and backlog during a burst, unbounded vs through the ingest buffer
+
+Frames in a burst are already buffered on the socket, so reading them doesn't
+wait: without backpressure the reader hands off a whole socket's worth of
+events before any of them get parsed.
+
+Run from the repo root with: python -m benchmarks.bench_ingest
+"""
+import asyncio
+import time
+
+import qbot
+from benchmarks.bench_logging import make_events
+from ingest import IngestQueue
+from mocks import MockWebSocket
+
+# Frames buffered on the socket at a time (read without yielding), and consumers
+READ_CHUNK = 10_000
+CONSUMERS = 4
+BUFFER_SIZES = (100, 1000)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)]
+
+
+def parse(websocket, msg, received_at, latencies):
+    """Parse an event, recording how long messages waited"""
+
+    if '"message"' in msg:
+        latencies.append(time.perf_counter() - received_at)
+    qbot.parse_event(websocket, msg, received_at)
+
+
+async def unbounded(events):
+    """Schedule every event with call_soon, like receive_events used to"""
+
+    websocket = MockWebSocket()
+    loop = asyncio.get_running_loop()
+    latencies = []
+    peak = 0
+    for i, msg in enumerate(events):
+        loop.call_soon(parse, websocket, msg, time.perf_counter(), latencies)
+        if i % READ_CHUNK == READ_CHUNK - 1:
+            peak = max(peak, len(loop._ready))
+            await asyncio.sleep(0)
+    while len(latencies) < len(events) // 10:
+        await asyncio.sleep(0)
+    return latencies, peak, 0
+
+
+async def bounded(events, size, overflow):
+    """Put every event through an IngestQueue drained by a pool of consumers"""
+
+    websocket = MockWebSocket()
+    ingest = IngestQueue(size, overflow=overflow)
+    latencies = []
+
+    async def consume():
+        while True:
+            msg, received_at = await ingest.get()
+            parse(websocket, msg, received_at, latencies)
+            await asyncio.sleep(0)
+
+    consumers = [asyncio.ensure_future(consume()) for _ in range(CONSUMERS)]
+    for i, msg in enumerate(events):
+        await ingest.put((msg, time.perf_counter()), ingest.classify(msg))
+        if i % READ_CHUNK == READ_CHUNK - 1:
+            await asyncio.sleep(0)
+    while len(ingest):
+        await asyncio.sleep(0)
+    for consumer in consumers:
+        consumer.cancel()
+    lost = sum(ingest.shed.values()) + sum(ingest.dropped.values())
+    return latencies, ingest.max_seen, lost
+
+
+def report(name, latencies, peak, lost):
+    print(f"{name:<24} message wait p50 {percentile(latencies, 0.5) * 1000:>8.2f} ms  "
+          f"p99 {percentile(latencies, 0.99) * 1000:>8.2f} ms  "
+          f"peak backlog {peak:>6,}  lost {lost:>6,}")
+
+
+def main():
+    # 90% presence changes, like a busy workspace with presence_sub on
+    events = make_events()
+    qbot.LOGGER.disabled = True
+    loop = qbot.EVENT_LOOP
+
+    report('call_soon (unbounded)', *loop.run_until_complete(unbounded(events)))
+    for size in BUFFER_SIZES:
+        for overflow in ('block', 'drop'):
+            report(f'ingest {size} {overflow}',
+                   *loop.run_until_complete(bounded(events, size, overflow)))
+
+
+if __name__ == '__main__':
+    main()
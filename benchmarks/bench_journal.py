@@ -0,0 +1,80 @@
+"""Measure journal write cost per change and recovery time
+
+Run from the repo root with: python -m benchmarks.bench_journal
+"""
+import tempfile
+import time
+
+from journal import QueueJournal
+from myqueue import QueueRegistry
+
+WRITES = 100_000
+RECOVERY_ENTRIES = 1_000_000
+CHANNELS = 100
+
+
+def write_changes(registry, count, start=0):
+    """Make count queue changes spread over CHANNELS channels, carrying on from change start"""
+
+    for i in range(start, start + count):
+        queue = registry.get(f"C{i % CHANNELS}")
+        user = f"<@U{i // CHANNELS % 20:08d}>"
+        if queue.has_user(user):
+            queue.remove(user)
+        else:
+            queue.push(user)
+
+
+def bench_writes(sync_every):
+    """Return the average microseconds per journaled queue change, fsyncing every sync_every
+
+    Recording a change never fsyncs (the bot does it every second, off the
+    loop), so this syncs after each group of changes itself.
+    """
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        journal = QueueJournal(state_dir, snapshot_every=float('inf'))
+        registry = QueueRegistry(journal=journal)
+
+        start = time.perf_counter()
+        for group in range(0, WRITES, sync_every):
+            write_changes(registry, min(sync_every, WRITES - group), group)
+            journal.sync()
+        elapsed = time.perf_counter() - start
+
+        journal.close()
+    return elapsed / WRITES * 1e6
+
+
+def bench_recovery():
+    """Return the seconds to load a journal with RECOVERY_ENTRIES changes"""
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        journal = QueueJournal(state_dir, flush_every=10_000, snapshot_every=float('inf'))
+        write_changes(QueueRegistry(journal=journal), RECOVERY_ENTRIES)
+        journal.close()
+
+        journal = QueueJournal(state_dir)
+        start = time.perf_counter()
+        replayed = journal.load(QueueRegistry(journal=journal))
+        elapsed = time.perf_counter() - start
+
+        journal.close()
+    return replayed, elapsed
+
+
+def main():
+    baseline = time.perf_counter()
+    write_changes(QueueRegistry(), WRITES)
+    no_journal = (time.perf_counter() - baseline) / WRITES * 1e6
+    print(f"{'no journal':<22} {no_journal:>8.2f} us/change")
+
+    for sync_every in [1, 100, 10_000]:
+        print(f"{f'sync every {sync_every}':<22} {bench_writes(sync_every):>8.2f} us/change")
+
+    replayed, elapsed = bench_recovery()
+    print(f"recovered {replayed:,} journal changes in {elapsed:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
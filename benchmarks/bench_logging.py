@@ -0,0 +1,68 @@
+"""Measure event throughput with synchronous prints vs background logging
+
+Run from the repo root with: python -m benchmarks.bench_logging
+"""
+import contextlib
+import json
+import tempfile
+import time
+
+import logs
+import qbot
+from mocks import MockWebSocket
+
+EVENTS = 50_000
+
+
+def make_events():
+    """Return raw events that are mostly presence traffic, like a busy workspace"""
+
+    events = []
+    for i in range(EVENTS):
+        if i % 10:
+            event = {'type': 'presence_change', 'user': f'U{i % 500:08d}', 'presence': 'away'}
+        else:
+            event = {'type': 'message', 'channel': 'C1', 'user': f'U{i % 500:08d}',
+                     'text': 'anyone around?', 'ts': f'{i}.000100'}
+        events.append(json.dumps(event))
+    return events
+
+
+def events_per_second(events, before_parse=None):
+    """Return how many events per second parse_event gets through"""
+
+    websocket = MockWebSocket()
+    start = time.perf_counter()
+    for event in events:
+        if before_parse:
+            before_parse(event)
+        qbot.parse_event(websocket, event)
+    return len(events) / (time.perf_counter() - start)
+
+
+def main():
+    events = make_events()
+
+    with tempfile.TemporaryFile('w') as output:
+        # What every event used to cost: prints on the event loop thread
+        def old_prints(event):
+            print("Got an event!", file=output)
+            print("Parsing event:", json.loads(event), file=output)
+
+        qbot.LOGGER.disabled = True
+        print(f"{'synchronous prints':<34} {events_per_second(events, old_prints):>10,.0f} events/s")
+        qbot.LOGGER.disabled = False
+
+        modes = [('background, INFO', 'INFO', {}),
+                 ('background, DEBUG', 'DEBUG', {}),
+                 ('background, DEBUG, 1% presence', 'DEBUG', {'presence_change': 0.01})]
+        for name, level, rates in modes:
+            logs.setup(level, stream=output, sample_rates=rates)
+            with contextlib.ExitStack() as stack:
+                stack.callback(logs.stop)
+                rate = events_per_second(events)
+            print(f"{name:<34} {rate:>10,.0f} events/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Compare the memory queue storage takes across thousands of channel queues
+
+Run from the repo root with: python -m benchmarks.bench_memory
+"""
+import gc
+import random
+import tracemalloc
+
+from myqueue import Queue
+
+CHANNELS = 5_000
+USERS_PER_QUEUE = 20
+WORKSPACE_USERS = 20_000
+
+MODES = [('LinkedList', {}),
+         ('IndexedLinkedList', {'indexed': True}),
+         ('CompactList', {'compact': True})]
+
+
+def build(mode, kwargs, storage_only=False):
+    """Return queues filled the way messages would fill them, and the bytes they take
+
+    With storage_only, the queues are made first and only what's pushed into
+    them is measured, leaving out each Queue's own overhead.
+    """
+
+    rand = random.Random(18)
+    prefix = mode[:2] + ('s' if storage_only else 'q')
+    queues = [Queue(**kwargs) for _ in range(CHANNELS)] if storage_only else []
+    gc.collect()
+    tracemalloc.start()
+    for i in range(CHANNELS):
+        if storage_only:
+            q = queues[i]
+        else:
+            q = Queue(**kwargs)
+            queues.append(q)
+        for _ in range(USERS_PER_QUEUE):
+            # Every message makes a new mention string, like qbot does
+            q.push(f"<@{prefix}{rand.randrange(WORKSPACE_USERS):08d}>")
+        # Some users leave from the middle, and some get served
+        for _ in range(USERS_PER_QUEUE // 4):
+            q.remove(q.users()[rand.randrange(len(q))])
+            q.pop()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return queues, size
+
+
+def main():
+    print(f"{CHANNELS:,} queues of {USERS_PER_QUEUE // 2} users, from {WORKSPACE_USERS:,} users")
+    print(f"{'':<18} {'whole queues':>25} {'storage only':>25}")
+    for mode, kwargs in MODES:
+        line = f"{mode:<18}"
+        for storage_only in (False, True):
+            queues, size = build(mode, kwargs, storage_only)
+            entries = sum(len(q) for q in queues)
+            line += f" {size / 2 ** 20:>8.1f} MiB {size / entries:>6.0f} B/entry"
+            del queues
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Compare LinkedList and IndexedLinkedList backed queues
+
+Run from the repo root with: python -m benchmarks.bench_myqueue
+"""
+import timeit
+
+from myqueue import Queue
+
+SIZES = [10, 1_000, 100_000]
+
+
+def make_queue(size, indexed):
+    """Return a queue filled with size fake user mentions"""
+
+    q = Queue(indexed=indexed)
+    for i in range(size):
+        q.push(f"<@U{i:08d}>")
+    return q
+
+
+def time_op(stmt, number):
+    """Return the average microseconds per call of stmt"""
+
+    return timeit.timeit(stmt, number=number) / number * 1e6
+
+
+def bench(size, indexed):
+    """Return per-operation timings (in microseconds) for a queue of this size"""
+
+    q = make_queue(size, indexed)
+    last_user = f"<@U{size - 1:08d}>"
+    mid_user = f"<@U{size // 2:08d}>"
+    number = 1000 if size <= 1_000 else 20
+
+    def push_pop():
+        q.push('<@Unew>')
+        q.remove('<@Unew>')
+
+    def has_user():
+        q.has_user(last_user)
+
+    def remove_mid():
+        q.remove(mid_user)
+        q.push(mid_user)
+
+    def pop():
+        q.push(q.peek())
+        q.pop()
+
+    return {'push+remove tail': time_op(push_pop, number),
+            'has_user tail': time_op(has_user, number),
+            'remove middle': time_op(remove_mid, number),
+            'pop': time_op(pop, number)}
+
+
+def main():
+    print(f"{'size':>8} {'operation':<22} {'LinkedList':>14} {'Indexed':>14}")
+    for size in SIZES:
+        plain = bench(size, indexed=False)
+        indexed = bench(size, indexed=True)
+        for op in plain:
+            print(f"{size:>8} {op:<22} {plain[op]:>11.2f} us {indexed[op]:>11.2f} us")
+
+
+if __name__ == '__main__':
+    main()
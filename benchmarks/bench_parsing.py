@@ -0,0 +1,49 @@
+"""Compare parsing.classify against calling each parsing function in turn
+
+Run from the repo root with: python -m benchmarks.bench_parsing
+"""
+import time
+
+import parsing
+
+MESSAGES = ["nq please", "omw <@U12345678>!", "dq <@U12345678>", "qbot help",
+            "queue status?", "q = [ <@U1> <@U2> <@U3> ]", "q.clear()",
+            "thanks for the help!", "can someone look at my flask app?",
+            "lunch anyone?"]
+ROUNDS = 20_000
+
+
+def chained(text):
+    """Classify text the way respond_to_message used to"""
+
+    new_queue = parsing.get_queue_change(text)
+    if new_queue is not None:
+        return new_queue
+    elif parsing.is_dequeue_message(text):
+        return parsing.get_user_to_pop(text)
+    elif parsing.is_enqueue_message(text):
+        return True
+    elif parsing.is_help_message(text):
+        return True
+    elif parsing.is_status_message(text):
+        return True
+
+
+def messages_per_second(func):
+    """Return how many messages per second func classifies"""
+
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for text in MESSAGES:
+            func(text)
+    elapsed = time.perf_counter() - start
+    return ROUNDS * len(MESSAGES) / elapsed
+
+
+def main():
+    for name, func in [('chained functions', chained), ('classify', parsing.classify)]:
+        print(f"{name:<18} {messages_per_second(func):>12,.0f} msgs/s")
+
+
+if __name__ == '__main__':
+    main()
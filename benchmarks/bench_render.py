@@ -0,0 +1,48 @@
+"""Measure repeated status replies on a large queue
+
+Run from the repo root with: python -m benchmarks.bench_render
+"""
+import time
+
+from myqueue import Queue
+
+SIZE = 10_000
+REPLIES = 1_000
+
+
+def concat_str(q):
+    """Render the queue the way Queue.__str__ used to, with repeated +="""
+
+    q_str = "QUEUE = [ "
+    for node in q._list.all():
+        q_str += node.data + " "
+    q_str += "]"
+    return q_str
+
+
+def time_replies(render, q, mutate_every=None):
+    """Return the average microseconds per status reply"""
+
+    start = time.perf_counter()
+    for i in range(REPLIES):
+        if mutate_every and i % mutate_every == 0:
+            q.push('<@Unew>')
+            q.remove('<@Unew>')
+        render(q)
+    return (time.perf_counter() - start) / REPLIES * 1e6
+
+
+def main():
+    q = Queue(indexed=True)
+    for i in range(SIZE):
+        q.push(f"<@U{i:08d}>")
+
+    print(f"{SIZE:,} entries, {REPLIES:,} status replies")
+    print(f"{'+= concat':<28} {time_replies(concat_str, q):>10.1f} us/reply")
+    print(f"{'join, no cache':<28} {time_replies(Queue.__str__, q, mutate_every=1):>10.1f} us/reply")
+    print(f"{'cached, change every 10':<28} {time_replies(str, q, mutate_every=10):>10.1f} us/reply")
+    print(f"{'cached, unchanged':<28} {time_replies(str, q):>10.1f} us/reply")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Measure cold start: import time, restoring saved queues, and time to the first handled event
+
+Each measurement runs in a fresh interpreter, so nothing is already imported.
+
+Run from the repo root with: python -m benchmarks.bench_startup
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from journal import QueueJournal, pack_state, unpack_state
+from myqueue import QueueRegistry
+
+RUNS = 7
+CHANNELS = 2000
+USERS_PER_CHANNEL = 25
+
+IMPORT_QBOT = """
+import time
+start = time.perf_counter()
+{before}
+import qbot
+print((time.perf_counter() - start) * 1000)
+"""
+
+# Starts like main() does, up to the websocket: restore the queues, then
+# handle one message event and time until its reply is sent
+FIRST_EVENT = """
+import time
+start = time.perf_counter()
+import asyncio, json
+import qbot
+from acks import AckTracker
+imported = time.perf_counter()
+
+qbot.STATE_DIR = {state_dir!r}
+qbot.open_journal()
+restored = time.perf_counter()
+
+
+class Socket(object):
+    def __init__(self):
+        self.sent = asyncio.Event()
+
+    async def send(self, msg):
+        self.sent.set()
+
+
+websocket = Socket()
+qbot.sent_acks = AckTracker()
+qbot.event_id_global = 1
+qbot.parse_event(websocket, json.dumps({{'type': 'message', 'channel': 'C1',
+                                         'user': 'UNEW', 'text': 'nq'}}))
+qbot.EVENT_LOOP.run_until_complete(websocket.sent.wait())
+replied = time.perf_counter()
+print(json.dumps([(imported - start) * 1000, (restored - imported) * 1000,
+                  (replied - restored) * 1000]))
+"""
+
+
+def run(code):
+    """Run code in a fresh interpreter and return what it printed, decoded, and the wall time"""
+
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True,
+                            text=True, cwd=os.getcwd()).stdout
+    return json.loads(output), (time.perf_counter() - start) * 1000
+
+
+def make_state(state_dir):
+    """Save a snapshot of many channels' queues, and return the state"""
+
+    registry = QueueRegistry()
+    for channel in range(CHANNELS):
+        registry.get(f'C{channel}').override([f'<@U{channel * 7 + user:06d}>'
+                                              for user in range(USERS_PER_CHANNEL)])
+    journal = QueueJournal(state_dir)
+    journal.snapshot(registry)
+    journal.close()
+    return registry.state()
+
+
+def main():
+    lazy = statistics.median(run(IMPORT_QBOT.format(before=''))[0] for _ in range(RUNS))
+    eager = statistics.median(
+        run(IMPORT_QBOT.format(before='import requests, websockets.asyncio.client'))[0]
+        for _ in range(RUNS))
+    print(f"{'import qbot':<34} {lazy:>7.1f} ms "
+          f"({eager:.1f} ms with requests and websockets imported up front)")
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        state = make_state(state_dir)
+        size = os.path.getsize(os.path.join(state_dir, 'snapshot.bin'))
+        results = [run(FIRST_EVENT.format(state_dir=state_dir)) for _ in range(RUNS)]
+
+    imported, restored, replied = (statistics.median(times)
+                                   for times in zip(*(times for times, _ in results)))
+    wall = statistics.median(wall for _, wall in results)
+    print(f"{'restore ' + f'{CHANNELS:,} queues':<34} {restored:>7.1f} ms "
+          f"({size / 1024:,.0f} KiB snapshot)")
+    print(f"{'first event handled and replied':<34} {replied:>7.1f} ms after restoring")
+    print(f"{'start to first reply (in process)':<34} {imported + restored + replied:>7.1f} ms")
+    print(f"{'start to first reply (wall)':<34} {wall:>7.1f} ms, "
+          f"including interpreter startup")
+
+    # The decoding part of a restore, binary vs the old JSON snapshot
+    as_json = json.dumps({'seq': 0, 'queues': state})
+    as_binary = pack_state(0, state)
+    start = time.perf_counter()
+    json.loads(as_json)
+    json_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    unpack_state(as_binary)
+    binary_ms = (time.perf_counter() - start) * 1000
+    print(f"{'decode snapshot':<34} {binary_ms:>7.1f} ms binary ({len(as_binary) / 1024:,.0f} KiB) "
+          f"vs {json_ms:.1f} ms JSON ({len(as_json) / 1024:,.0f} KiB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Measure command throughput in one process vs sharded across worker processes
+
+Run from the repo root with: python -m benchmarks.bench_workers
+"""
+import os
+import threading
+import time
+
+import qbot
+from myqueue import QueueRegistry
+from workers import WorkerPool, shard_for
+
+CHANNELS = 200
+COMMANDS = 40_000
+BATCH = 100
+WORKER_COUNTS = (1, 2, 4)
+
+
+def make_commands():
+    """Return enqueue commands spread over many channels, so the queues get long"""
+
+    return [(f'C{i % CHANNELS}', f'<@U{i:06d}>', 'nq') for i in range(COMMANDS)]
+
+
+def in_process(commands):
+    """Return commands per second handled and rendered in this process"""
+
+    qbot.QUEUES = QueueRegistry()
+    start = time.perf_counter()
+    for channel, user, text in commands:
+        response_msg, hb_queue = qbot.get_response(user, text, channel)
+        str(hb_queue)
+    return len(commands) / (time.perf_counter() - start)
+
+
+def sharded(commands, workers):
+    """Return commands per second handled by a pool of workers, reply to reply"""
+
+    done = threading.Event()
+
+    def deliver(replies):
+        if pool.handled >= expected:
+            done.set()
+
+    pool = WorkerPool(workers, deliver)
+
+    # Wait for every worker to be up before timing anything
+    warmup = {shard_for(f'W{i}', workers): f'W{i}' for i in range(100)}
+    expected = len(warmup)
+    pool.start()
+    for channel in warmup.values():
+        pool.submit(channel, '<@W>', 'qbot help')
+    pool.flush()
+    done.wait()
+
+    done.clear()
+    expected += len(commands)
+    start = time.perf_counter()
+    for i, (channel, user, text) in enumerate(commands, 1):
+        pool.submit(channel, user, text)
+        if i % BATCH == 0:
+            pool.flush()
+    pool.flush()
+    done.wait()
+    elapsed = time.perf_counter() - start
+
+    pool.stop()
+    return len(commands) / elapsed
+
+
+def main():
+    commands = make_commands()
+    qbot.LOGGER.disabled = True
+    print(f"{os.cpu_count()} CPU(s), {COMMANDS:,} commands over {CHANNELS} channels")
+
+    print(f"{'in process':<12} {in_process(commands):>10,.0f} commands/s")
+    for workers in WORKER_COUNTS:
+        print(f"{f'{workers} worker(s)':<12} {sharded(commands, workers):>10,.0f} commands/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Fire concurrent Events API posts at the bot's HTTP ingestion mode and report throughput and ack latency
+
+The bot runs its EventsServer in this process, handling every event as it
+would in production (replies go to a mock chat.postMessage), while a separate
+client process posts signed events over the given numbers of connections.
+
+Run from the repo root with, e.g.:
+    python -m benchmarks.load_events --concurrency 1,10,50
+    python -m benchmarks.load_events --count 2000 --new-connections
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import time
+
+import logs
+import mocks
+import qbot
+from benchmarks.load_replay import synthetic_events
+from dedupe import EventDeduper
+from eventsapi import EventsServer, signature
+from fakeslack import percentile
+from myqueue import QueueRegistry
+
+SECRET = 'load-test-secret'
+
+
+def make_requests(events, keep_alive):
+    """Return a signed HTTP request for each event, wrapped like the Events API does"""
+
+    requests = []
+    for i, event in enumerate(events):
+        body = json.dumps({'type': 'event_callback', 'event_id': f'Ev{i}',
+                           'event': dict(event, ts=f'{i}.000100')}).encode()
+        timestamp = str(int(time.time()))
+        requests.append(b'POST /slack/events HTTP/1.1\r\n'
+                        b'Host: localhost\r\n'
+                        b'Content-Type: application/json\r\n'
+                        + f'X-Slack-Request-Timestamp: {timestamp}\r\n'
+                          f'X-Slack-Signature: {signature(SECRET, timestamp, body)}\r\n'
+                          f'Connection: {"keep-alive" if keep_alive else "close"}\r\n'
+                          f'Content-Length: {len(body)}\r\n\r\n'.encode()
+                        + body)
+    return requests
+
+
+def fire(port, requests, connections, keep_alive):
+    """Post the requests over this many connections; return the elapsed time and each ack latency"""
+
+    async def read_response(reader):
+        status = (await reader.readline()).split()[1]
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            if line.lower().startswith(b'content-length'):
+                length = int(line.split(b':')[1])
+        await reader.readexactly(length)
+        return status
+
+    async def client(share, latencies):
+        connection = None
+        for request in share:
+            if connection is None:
+                connection = await asyncio.open_connection('127.0.0.1', port)
+            reader, writer = connection
+            start = time.perf_counter()
+            writer.write(request)
+            status = await read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            assert status == b'200', status
+            if not keep_alive:
+                writer.close()
+                connection = None
+        if connection:
+            connection[1].close()
+
+    async def run():
+        latencies = []
+        start = time.perf_counter()
+        await asyncio.gather(*(client(requests[i::connections], latencies)
+                               for i in range(connections)))
+        return time.perf_counter() - start, latencies
+
+    return asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=5000, help="number of events to post")
+    parser.add_argument('--concurrency', default='1,10,50',
+                        help="comma separated numbers of connections to post over")
+    parser.add_argument('--new-connections', action='store_true',
+                        help="open a connection per request instead of keeping them alive")
+    args = parser.parse_args()
+
+    logs.set_level('ERROR')
+    os.environ['SLACK_BOT_TOKEN'] = 'good-token'
+    qbot.HTTP_SESSION = mocks.MockSession()
+    qbot.SEND_INTERVAL = 0
+    keep_alive = not args.new_connections
+    requests = make_requests(synthetic_events(args.count), keep_alive)
+
+    loop = qbot.EVENT_LOOP
+    server = loop.run_until_complete(
+        EventsServer(qbot.handle_api_event, SECRET).start(port=0))
+    print(f"{args.count:,} events, {'keep-alive' if keep_alive else 'a new connection each'}")
+    with concurrent.futures.ProcessPoolExecutor(1) as client:
+        for connections in map(int, args.concurrency.split(',')):
+            # Start every run from a fresh bot
+            qbot.QUEUES = QueueRegistry()
+            qbot.OUTBOX = None
+            qbot.SEEN_MESSAGES = EventDeduper()
+
+            elapsed, latencies = loop.run_until_complete(loop.run_in_executor(
+                client, fire, server.port, requests, connections, keep_alive))
+            print(f"{connections:>4} connection(s): {len(latencies) / elapsed:>8,.0f} req/s  "
+                  f"ack p50 {percentile(latencies, 50) * 1000:>6.2f} ms  "
+                  f"p99 {percentile(latencies, 99) * 1000:>6.2f} ms  "
+                  f"max {max(latencies) * 1000:>6.2f} ms")
+    server.close()
+
+
+if __name__ == '__main__':
+    main()
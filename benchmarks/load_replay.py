@@ -0,0 +1,86 @@
+"""Replay events through the bot against a local fake Slack and report latency
+
+Runs receive_events -> parse_event -> send_message end to end at each of the
+given rates, so the rate where latency climbs shows where the bot saturates.
+
+Run from the repo root with, e.g.:
+    python -m benchmarks.load_replay --rates 100,1000,5000
+    python -m benchmarks.load_replay --events recorded_events.jsonl --rates 500
+"""
+import argparse
+import random
+
+import websockets
+
+import logs
+import qbot
+from fakeslack import FakeSlack, load_events
+from myqueue import QueueRegistry
+
+
+def synthetic_events(count, channels=20, users=200, seed=0):
+    """Return count message events: mostly commands, with some chatter mixed in"""
+
+    rng = random.Random(seed)
+    texts = ['nq', 'nq please', 'dq {user}', 'omw {user}', 'q status?', 'qbot help',
+             'thanks!', 'anyone around?', 'lunch?']
+    events = []
+    for _ in range(count):
+        user = f'U{rng.randrange(users):08d}'
+        text = rng.choice(texts).format(user=f'<@{user}>')
+        events.append({'type': 'message',
+                       'channel': f'C{rng.randrange(channels):08d}',
+                       'user': user,
+                       'text': text})
+    return events
+
+
+def run(events, rate, send_interval):
+    """Run the bot against a fake Slack replaying events and return its report"""
+
+    # Start every run from a fresh bot
+    qbot.QUEUES = QueueRegistry()
+    qbot.OUTBOX = None
+    qbot.SEND_INTERVAL = send_interval
+
+    fake = FakeSlack(events, rate=rate).start()
+    qbot.SLACK_API_URL = fake.api_url
+    try:
+        ws_url = qbot.connect('fake-token')
+        try:
+            qbot.EVENT_LOOP.run_until_complete(qbot.receive_events(ws_url))
+        except websockets.ConnectionClosed:
+            pass
+    finally:
+        fake.stop()
+
+    return fake.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', help="JSONL file of events to replay (default: synthetic)")
+    parser.add_argument('--count', type=int, default=5000, help="number of synthetic events")
+    parser.add_argument('--rates', default='100,1000,5000',
+                        help="comma separated events/sec to replay at (0 for flat out)")
+    parser.add_argument('--send-interval', type=float, default=0,
+                        help="seconds between replies per channel (the bot's SEND_INTERVAL)")
+    args = parser.parse_args()
+
+    events = load_events(args.events) if args.events else synthetic_events(args.count)
+
+    # Replies still in flight when the fake Slack hangs up aren't worth a warning each
+    logs.set_level('ERROR')
+
+    print(f"{'rate':>8} {'events/s':>10} {'peak cmd/s':>11} {'p50 ms':>9} {'p90 ms':>9} "
+          f"{'p99 ms':>9} {'max ms':>9} {'unanswered':>11}")
+    for rate in args.rates.split(','):
+        rate = float(rate) or None
+        report = run(events, rate, args.send_interval)
+        print(f"{rate or 'max':>8} {report['events_per_sec']:>10} {report['peak_commands_per_sec']:>11} "
+              f"{report['p50_ms']:>9} {report['p90_ms']:>9} {report['p99_ms']:>9} "
+              f"{report['max_ms']:>9} {report['commands_unanswered']:>11}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""Microbenchmarks for every myqueue and parsing operation, with saved baselines
+
+Run from the repo root:
+    python -m benchmarks.microbench                         # just print timings
+    python -m benchmarks.microbench --save baseline.json    # save a baseline
+    python -m benchmarks.microbench --compare baseline.json # flag regressions
+
+Compare mode exits with status 1 if any benchmark got slower than the
+baseline by more than --threshold (default 20%).
+"""
+import argparse
+import json
+import platform
+import sys
+import timeit
+
+import parsing
+from myqueue import IndexedLinkedList, LinkedList, Queue
+
+SIZES = [10, 1_000, 10_000]
+MENTION_COUNTS = [1, 100, 1_000]
+
+
+def user(i):
+    """Return a fake user mention"""
+    return f"<@U{i:08d}>"
+
+
+def linked_list_cases(list_class):
+    """Yield (name, size, func) for each linked list operation"""
+
+    name = list_class.__name__
+    for size in SIZES:
+        ll = list_class()
+        for i in range(size):
+            ll.append(user(i))
+        mid, last = user(size // 2), user(size - 1)
+
+        # Removals are paired with an append so the list stays the same size
+        def append_remove(ll=ll):
+            ll.append('<@Unew>')
+            ll.remove('<@Unew>')
+
+        def remove_head(ll=ll):
+            ll.append(ll.remove(ll.head.data).data)
+
+        def remove_mid(ll=ll, mid=mid):
+            ll.remove(mid)
+            ll.append(mid)
+
+        yield f'{name}.append+remove tail', size, append_remove
+        yield f'{name}.remove head', size, remove_head
+        yield f'{name}.remove mid', size, remove_mid
+        yield f'{name}.remove miss', size, lambda ll=ll: ll.remove('<@Umissing>')
+        yield f'{name}.find last', size, lambda ll=ll, last=last: ll.find(last)
+        yield f'{name}.find miss', size, lambda ll=ll: ll.find('<@Umissing>')
+        yield f'{name}.all', size, lambda ll=ll: sum(1 for _ in ll.all())
+
+
+def queue_cases(indexed, priority=False, compact=False):
+    """Yield (name, size, func) for each Queue operation"""
+
+    name = ('Queue(priority)' if priority else 'Queue(compact)' if compact
+            else 'Queue(indexed)' if indexed else 'Queue')
+    for size in SIZES:
+        users = [user(i) for i in range(size)]
+        q = Queue(indexed=indexed, priority=priority, compact=compact)
+        q.override(users)
+        mid, last = users[size // 2], users[-1]
+
+        def push_remove(q=q):
+            q.push('<@Unew>')
+            q.remove('<@Unew>')
+
+        def pop(q=q):
+            head = q.peek()
+            q.pop()
+            q.push(head)
+
+        def remove_mid(q=q, mid=mid):
+            q.remove(mid)
+            q.push(mid)
+
+        def render(q=q):
+            q.version += 1
+            return str(q)
+
+        yield f'{name}.push+remove', size, push_remove
+        yield f'{name}.pop', size, pop
+        yield f'{name}.remove mid', size, remove_mid
+        yield f'{name}.peek', size, q.peek
+        yield f'{name}.has_user last', size, lambda q=q, last=last: q.has_user(last)
+        yield f'{name}.has_user miss', size, lambda q=q: q.has_user('<@Umissing>')
+        yield f'{name}.is_empty', size, q.is_empty
+        yield f'{name}.users', size, q.users
+        yield f'{name}.override', size, lambda q=q, users=users: q.override(users)
+        yield f'{name}.empty+override', size, lambda q=q, users=users: (q.empty(), q.override(users))
+        yield f'{name}.__str__', size, render
+        yield f'{name}.__str__ cached', size, lambda q=q: str(q)
+
+        if priority:
+            def reprioritize(q=q, mid=mid):
+                q.reprioritize(mid, 1)
+                q.reprioritize(mid, 0)
+
+            yield f'{name}.reprioritize mid', size, reprioritize
+
+
+def parsing_cases():
+    """Yield (name, size, func) for each parsing function
+
+    The size is the number of <@U...> mentions in the message. Long lists of
+    mentions are the worst case for get_queue_change, especially when the
+    list doesn't end up matching.
+    """
+
+    funcs = [parsing.is_enqueue_message, parsing.is_dequeue_message, parsing.get_user_to_pop,
+             parsing.get_queue_change, parsing.is_help_message, parsing.is_status_message,
+             parsing.classify]
+
+    for count in MENTION_COUNTS:
+        mentions = ' '.join(user(i) for i in range(count))
+        messages = {'override': f"q = [ {mentions} ]",
+                    'almost override': f"q = [ {mentions} typo ]",
+                    'dequeue': f"omw {mentions}",
+                    'chatter': f"thanks {mentions} for the help with the status"}
+
+        for func in funcs:
+            for kind, text in messages.items():
+                yield f'parsing.{func.__name__} {kind}', count, lambda func=func, text=text: func(text)
+
+
+def all_cases():
+    """Yield every (name, size, func) benchmark case"""
+
+    yield from linked_list_cases(LinkedList)
+    yield from linked_list_cases(IndexedLinkedList)
+    yield from queue_cases(indexed=False)
+    yield from queue_cases(indexed=True)
+    yield from queue_cases(indexed=True, priority=True)
+    yield from queue_cases(indexed=False, compact=True)
+    yield from parsing_cases()
+
+
+def time_case(func, repeat=3, min_time=0.01):
+    """Return the best seconds per call of func over several runs"""
+
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 10
+    return min(timer.repeat(repeat, number)) / number
+
+
+def run(match=None):
+    """Time every case (whose name contains match, if given) and return the results"""
+
+    results = {}
+    for name, size, func in all_cases():
+        if match and match not in name:
+            continue
+        key = f'{name} [{size}]'
+        results[key] = time_case(func)
+        print(f"{key:<60} {results[key] * 1e6:>12.3f} us")
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print how results compare to the baseline and return the regressed keys"""
+
+    regressions = []
+    print(f"\n{'benchmark':<60} {'baseline us':>12} {'now us':>12} {'change':>8}")
+    for key, seconds in results.items():
+        before = baseline.get(key)
+        if before is None:
+            continue
+        change = seconds / before - 1
+        flag = ''
+        if change > threshold:
+            flag = 'REGRESSION'
+            regressions.append(key)
+        elif change < -threshold:
+            flag = 'faster'
+        print(f"{key:<60} {before * 1e6:>12.3f} {seconds * 1e6:>12.3f} {change:>+8.0%} {flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--save', metavar='FILE', help="save results as a JSON baseline")
+    parser.add_argument('--compare', metavar='FILE', help="compare results to a JSON baseline")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="fractional slowdown that counts as a regression")
+    parser.add_argument('--match', help="only run benchmarks whose name contains this")
+    args = parser.parse_args()
+
+    results = run(args.match)
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'results': results}, baseline_file, indent=2, sort_keys=True)
+        print(f"\nSaved {len(results)} results to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}")
+            sys.exit(1)
+        print("\nNo regressions")
+
+
+if __name__ == '__main__':
+    main()
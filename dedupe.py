@@ -0,0 +1,74 @@
+"""Bounded duplicate detection for events Slack sends more than once"""
+import time
+from collections import OrderedDict
+
+
+class EventDeduper(object):
+    """Remembers recent event keys (like a message's channel and ts) to spot repeats
+
+    Keys are kept oldest first, so eviction only ever looks at the front:
+    keys older than max_age seconds are dropped as new ones come in, and the
+    oldest are dropped early if there are ever more than max_size. Lookups
+    and inserts are O(1) and memory never goes past max_size keys.
+    """
+
+    def __init__(self, max_size=10000, max_age=600, clock=time.monotonic):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._clock = clock
+        # Key -> time it was first seen, oldest first
+        self._seen = OrderedDict()
+
+        self.duplicates = 0
+
+    def seen(self, key):
+        """Return whether this key was already seen, remembering it if it wasn't"""
+
+        now = self._clock()
+        self._evict(now)
+
+        if key in self._seen:
+            self.duplicates += 1
+            return True
+
+        self._seen[key] = now
+        if len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        return False
+
+    def remember(self, keys):
+        """Remember keys (oldest first, like from keys()) as seen now, in one go"""
+
+        now = self._clock()
+        seen = self._seen
+        for key in keys:
+            seen[key] = now
+        while len(seen) > self.max_size:
+            seen.popitem(last=False)
+
+    def keys(self):
+        """Return the remembered keys, oldest first"""
+
+        self._evict(self._clock())
+        return list(self._seen)
+
+    def _evict(self, now):
+        """Forget keys that are older than max_age"""
+
+        cutoff = now - self.max_age
+        seen = self._seen
+        while seen:
+            key, first_seen = next(iter(seen.items()))
+            if first_seen > cutoff:
+                break
+            del seen[key]
+
+    def __contains__(self, key):
+        return key in self._seen
+
+    def __len__(self):
+        return len(self._seen)
+
+    def __repr__(self):
+        """Representation of the deduper"""
+        return f"<Event Deduper: keys={len(self._seen)} duplicates={self.duplicates}>"
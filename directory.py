@@ -0,0 +1,133 @@
+"""Cached directory of Slack users"""
+import asyncio
+import functools
+import time
+from collections import OrderedDict
+
+
+def display_name(user):
+    """Return the name Slack would show for a user dict"""
+
+    profile = user.get('profile') or {}
+    return profile.get('display_name') or profile.get('real_name') or user.get('name')
+
+
+class UserDirectory(object):
+    """Slack users by ID, cached so lookups don't cost an API call each
+
+    prefetch() loads the whole workspace a page of users.list at a time, and
+    users that aren't cached are fetched with users.info. At most max_size
+    users are kept, least recently used are dropped first, and a cached user
+    goes stale after ttl seconds. Many lookups of the same missing user wait
+    on one shared API call. Feed user_change events to update() to keep
+    cached users current.
+
+    API calls go through session.post (like a requests.Session) in the
+    default executor, so they don't block the event loop.
+    """
+
+    def __init__(self, token, session, api_url='https://slack.com/api', max_size=10000,
+                 ttl=3600, clock=time.monotonic):
+        self.token = token
+        self.session = session
+        self.api_url = api_url
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+
+        # User ID -> (user dict, time it goes stale), least recently used first
+        self._users = OrderedDict()
+        # User ID -> future for the users.info call fetching it
+        self._pending = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+
+    async def _call(self, method, **data):
+        """Call a Slack API method and return the decoded response"""
+
+        self.api_calls += 1
+        post = functools.partial(self.session.post, f'{self.api_url}/{method}',
+                                 data={'token': self.token, **data})
+        response = await asyncio.get_running_loop().run_in_executor(None, post)
+        return response.json()
+
+    async def prefetch(self, page_size=200):
+        """Cache every user in the workspace and return how many were loaded"""
+
+        loaded = 0
+        cursor = ''
+        while True:
+            response = await self._call('users.list', limit=page_size, cursor=cursor)
+            if not response.get('ok'):
+                break
+            for user in response.get('members', []):
+                self.update(user)
+                loaded += 1
+            cursor = (response.get('response_metadata') or {}).get('next_cursor')
+            if not cursor:
+                break
+        return loaded
+
+    def update(self, user):
+        """Cache a user dict (from users.list, users.info, or a user_change event)"""
+
+        user_id = user['id']
+        self._users[user_id] = (user, self._clock() + self.ttl)
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_size:
+            self._users.popitem(last=False)
+
+    def peek(self, user_id):
+        """Return the cached user dict, or None if it isn't cached (never calls the API)"""
+
+        cached = self._users.get(user_id)
+        if cached is None:
+            return None
+
+        user, stale_at = cached
+        if self._clock() >= stale_at:
+            del self._users[user_id]
+            return None
+        self._users.move_to_end(user_id)
+        return user
+
+    async def get(self, user_id):
+        """Return the user dict for this ID, fetching it if needed (None if Slack has no such user)"""
+
+        user = self.peek(user_id)
+        if user is not None:
+            self.hits += 1
+            return user
+
+        pending = self._pending.get(user_id)
+        if pending is None:
+            self.misses += 1
+            pending = self._pending[user_id] = asyncio.ensure_future(self._fetch(user_id))
+            pending.add_done_callback(lambda _: self._pending.pop(user_id, None))
+        # One waiter giving up shouldn't cancel the call for everyone else
+        return await asyncio.shield(pending)
+
+    async def _fetch(self, user_id):
+        """Fetch and cache a user with users.info"""
+
+        response = await self._call('users.info', user=user_id)
+        if response.get('ok'):
+            self.update(response['user'])
+            return response['user']
+        return None
+
+    async def name(self, user_id):
+        """Return the display name for a user ID, or the ID if there's no such user"""
+
+        user = await self.get(user_id)
+        return display_name(user) if user else user_id
+
+    def __len__(self):
+        return len(self._users)
+
+    def __repr__(self):
+        """Representation of the directory"""
+        return (f"<User Directory: users={len(self._users)} hits={self.hits} "
+                f"misses={self.misses} api_calls={self.api_calls}>")
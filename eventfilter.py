@@ -0,0 +1,51 @@
+"""Cheap filtering of raw websocket frames before they're decoded"""
+import re
+
+# Event types the bot acts on (acks for sent messages have no type, just reply_to)
+DEFAULT_EVENT_TYPES = ('hello', 'goodbye', 'message', 'user_change')
+
+
+class EventFilter(object):
+    """Drops frames for unwanted event types and channels without decoding them
+
+    A frame is kept if it has a reply_to, or if "type" is set to one of the
+    wanted event types anywhere in it. If channels are given, frames that
+    name a channel have to name at least one of them. Both checks are regex
+    searches over the raw text, so nested objects (like message attachments)
+    can only make a frame be kept, never wrongly dropped; parse_event still
+    looks at everything that gets through.
+    """
+
+    def __init__(self, event_types=DEFAULT_EVENT_TYPES, channels=None):
+        self.event_types = frozenset(event_types)
+        self.channels = frozenset(channels) if channels else None
+
+        type_alt = '|'.join(re.escape(event_type) for event_type in sorted(self.event_types))
+        self._keep_re = re.compile(rf'"reply_to"\s*:|"type"\s*:\s*"(?:{ type_alt })"')
+        self._channel_re = re.compile(r'"channel"\s*:\s*"([^"]*)"')
+
+        self.dropped_types = 0
+        self.dropped_channels = 0
+
+    def drop_reason(self, frame):
+        """Return why the frame should be dropped ('type' or 'channel'), or None to keep it"""
+
+        if isinstance(frame, bytes):
+            frame = frame.decode('utf-8', 'replace')
+
+        if not self._keep_re.search(frame):
+            self.dropped_types += 1
+            return 'type'
+
+        if self.channels is not None:
+            named = self._channel_re.findall(frame)
+            if named and self.channels.isdisjoint(named):
+                self.dropped_channels += 1
+                return 'channel'
+
+        return None
+
+    def __repr__(self):
+        """Representation of the filter"""
+        return (f"<Event Filter: types={sorted(self.event_types)} "
+                f"dropped_types={self.dropped_types} dropped_channels={self.dropped_channels}>")
@@ -0,0 +1,158 @@
+"""Slack Events API ingestion over HTTP, for running without an RTM websocket"""
+import asyncio
+import hashlib
+import hmac
+import json
+import time
+
+# Biggest request body accepted, in bytes
+MAX_BODY = 1 << 20
+# How far (in seconds) a signed request's timestamp can be from now
+MAX_SKEW = 300
+# How long (in seconds) an idle keep-alive connection is held open
+IDLE_TIMEOUT = 60
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 405: 'Method Not Allowed',
+               413: 'Payload Too Large'}
+
+
+def signature(secret, timestamp, body):
+    """Return the X-Slack-Signature Slack would send for this request"""
+
+    basestring = b'v0:' + timestamp.encode() + b':' + body
+    return 'v0=' + hmac.new(secret.encode(), basestring, hashlib.sha256).hexdigest()
+
+
+class EventsServer(object):
+    """HTTP/1.1 server for Slack Events API posts, with keep-alive connections
+
+    Every POST body is a JSON envelope. url_verification challenges are
+    answered with the challenge, and event_callback envelopes are acked with
+    an empty 200 right away; handle is then called with the inner event dict
+    and the time.perf_counter() the request was read, on the next loop
+    iteration, so handling an event never holds up its ack. If a
+    signing_secret is given, requests without a valid, recent
+    X-Slack-Signature get a 401.
+    """
+
+    def __init__(self, handle, signing_secret=None, clock=time.time):
+        self.handle = handle
+        self.signing_secret = signing_secret
+        self._clock = clock
+        self._server = None
+
+        self.requests = 0
+        self.events = 0
+        self.rejected = 0
+
+    async def start(self, host='127.0.0.1', port=3000):
+        """Start listening (port 0 picks a free port) and return this server"""
+
+        self._server = await asyncio.start_server(self._serve_connection, host, port)
+        return self
+
+    @property
+    def port(self):
+        """Port the server is listening on"""
+        return self._server.sockets[0].getsockname()[1]
+
+    async def _serve_connection(self, reader, writer):
+        """Answer requests on one connection until the client closes it"""
+
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+
+                method, _, target = request_line.decode('latin-1').strip().partition(' ')
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                connection = headers.get('connection', '').lower()
+                keep_alive = (connection != 'close' if target.endswith('HTTP/1.1')
+                              else connection == 'keep-alive')
+
+                length = int(headers.get('content-length') or 0)
+                if length > MAX_BODY:
+                    self._respond(writer, 413, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                self._respond(writer, *self._answer(method, headers, body), keep_alive=keep_alive)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _answer(self, method, headers, body):
+        """Return the status and body to answer a request with, handing off any event"""
+
+        received_at = time.perf_counter()
+        self.requests += 1
+
+        if method != 'POST':
+            return 405, b''
+        if self.signing_secret and not self._signed(headers, body):
+            self.rejected += 1
+            return 401, b''
+
+        try:
+            envelope = json.loads(body)
+        except ValueError:
+            return 400, b''
+        if not isinstance(envelope, dict):
+            return 400, b''
+
+        envelope_type = envelope.get('type')
+        if envelope_type == 'url_verification':
+            return 200, json.dumps({'challenge': envelope.get('challenge')}).encode()
+        if envelope_type == 'event_callback' and isinstance(envelope.get('event'), dict):
+            self.events += 1
+            asyncio.get_running_loop().call_soon(self.handle, envelope['event'], received_at)
+        # Anything else (like app_rate_limited) just needs acking
+        return 200, b''
+
+    def _signed(self, headers, body):
+        """Return whether a request has a valid signature from the last MAX_SKEW seconds"""
+
+        timestamp = headers.get('x-slack-request-timestamp', '')
+        try:
+            if abs(self._clock() - int(timestamp)) > MAX_SKEW:
+                return False
+        except ValueError:
+            return False
+        expected = signature(self.signing_secret, timestamp, body)
+        return hmac.compare_digest(expected, headers.get('x-slack-signature', ''))
+
+    @staticmethod
+    def _respond(writer, status, body=b'', keep_alive=True):
+        """Write an HTTP response"""
+
+        content_type = 'application/json' if body else 'text/plain'
+        writer.write(f'HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n'
+                     f'Content-Type: {content_type}\r\n'
+                     f'Content-Length: {len(body)}\r\n'
+                     f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode()
+                     + body)
+
+    def close(self):
+        """Stop accepting connections"""
+
+        if self._server:
+            self._server.close()
+
+    def __repr__(self):
+        """Representation of the server"""
+        return (f"<Events Server: requests={self.requests} events={self.events} "
+                f"rejected={self.rejected}>")
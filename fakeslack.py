@@ -0,0 +1,284 @@
+"""Local stand-in for the Slack RTM API, for tests and load testing"""
+import asyncio
+import json
+import threading
+import time
+
+import websockets
+
+import parsing
+
+
+def load_events(path):
+    """Return the events recorded in a JSONL file, one per line
+
+    Lines without a 'type' are treated as plain messages, using their 'text'
+    (or 'body') as the message text, so any corpus of messages can be replayed.
+    """
+
+    events = []
+    with open(path, encoding='utf-8') as events_file:
+        for line in events_file:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if 'type' not in event:
+                event = {'type': 'message',
+                         'channel': event.get('channel', 'C0000000'),
+                         'user': event.get('user', 'U0000000'),
+                         'text': event.get('text', event.get('body', ''))}
+            events.append(event)
+    return events
+
+
+def percentile(values, pct):
+    """Return the pct percentile of a list of numbers (nearest rank)"""
+
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+class FakeSlack(object):
+    """Fake Slack server that answers rtm.connect and replays events
+
+    Runs its own event loop in a background thread, so a bot using blocking
+    requests calls can connect to it from the main thread. rtm.connect (on
+    api_url) hands back the websocket URL. Each websocket connection gets a
+    hello, then the events at rate events per second (or as fast as possible
+    if rate is None), and a reply_to ack for every message the bot sends.
+
+    Each replayed command message is timed until the bot next replies in its
+    channel. Once every command has been answered (or nothing has come back
+    for drain_timeout seconds), the server says goodbye and closes the
+    websocket.
+
+    If broadcast is True, the events are replayed once, starting when the
+    first connection opens, and sent to every connection open at the time
+    (like Slack sends a workspace's events to each of a bot's connections).
+    """
+
+    def __init__(self, events=(), rate=None, host='127.0.0.1', drain_timeout=5, broadcast=False):
+        self.events = list(events)
+        self.rate = rate
+        self.host = host
+        self.drain_timeout = drain_timeout
+        self.broadcast = broadcast
+
+        self.api_url = None
+        self.ws_url = None
+        self.received = []
+        self.latencies = []
+        self.answered_at = []
+        self.started_at = None
+        self.finished_at = None
+
+        # Channel ID -> send times of commands waiting for a reply
+        self._waiting = {}
+        # Websocket -> frames waiting to be broadcast to it
+        self._connections = {}
+        self._broadcasting = None
+        self._loop = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._stop = None
+
+    def start(self):
+        """Start serving in a background thread and return self"""
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        """Stop the servers and wait for the thread to finish"""
+
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._stop.set)
+            self._thread.join()
+
+    def _run(self):
+        """Thread target that runs the servers on their own event loop"""
+
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self._serve())
+        self._loop.close()
+
+    async def _serve(self):
+        """Serve rtm.connect over HTTP and the RTM websocket until stopped"""
+
+        self._stop = asyncio.Event()
+        http_server = await asyncio.start_server(self._handle_http, self.host, 0)
+        ws_server = await websockets.serve(self._handle_websocket, self.host, 0)
+
+        http_port = http_server.sockets[0].getsockname()[1]
+        ws_port = ws_server.sockets[0].getsockname()[1]
+        self.api_url = f'http://{self.host}:{http_port}/api'
+        self.ws_url = f'ws://{self.host}:{ws_port}/'
+        self._ready.set()
+
+        await self._stop.wait()
+        http_server.close()
+        ws_server.close()
+        await http_server.wait_closed()
+        await ws_server.wait_closed()
+
+    async def _handle_http(self, reader, writer):
+        """Answer an HTTP request, which only succeeds for rtm.connect"""
+
+        request_line = await reader.readline()
+        content_length = 0
+        while True:
+            header = await reader.readline()
+            if header in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = header.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-length':
+                content_length = int(value)
+        await reader.readexactly(content_length)
+
+        if b'/rtm.connect' in request_line:
+            status, body = '200 OK', {'ok': True, 'url': self.ws_url}
+        else:
+            status, body = '404 Not Found', {'ok': False, 'error': 'unknown_method'}
+
+        content = json.dumps(body).encode()
+        writer.write(f'HTTP/1.1 {status}\r\n'
+                     f'Content-Type: application/json\r\n'
+                     f'Content-Length: {len(content)}\r\n'
+                     f'Connection: close\r\n\r\n'.encode() + content)
+        await writer.drain()
+        writer.close()
+
+    async def _handle_websocket(self, websocket, path=None):
+        """Say hello, replay the events, then say goodbye once replies are in"""
+
+        await websocket.send(json.dumps({'type': 'hello'}))
+        reader = asyncio.ensure_future(self._read_replies(websocket))
+
+        try:
+            if self.broadcast:
+                # Each connection gets its frames from its own queue, so one
+                # that's slow (or hanging up) doesn't hold up the others
+                frames = self._connections[websocket] = asyncio.Queue()
+                if self._broadcasting is None:
+                    self._broadcasting = asyncio.ensure_future(self._broadcast())
+                while not (self._broadcasting.done() and frames.empty()):
+                    get = asyncio.ensure_future(frames.get())
+                    await asyncio.wait([get, self._broadcasting],
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    if get.done():
+                        await websocket.send(get.result())
+                    else:
+                        get.cancel()
+            else:
+                await self._replay(websocket)
+                await self._drain()
+            await websocket.send(json.dumps({'type': 'goodbye'}))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self._connections.pop(websocket, None)
+            if not self.broadcast:
+                self.finished_at = time.perf_counter()
+            reader.cancel()
+            await websocket.close()
+
+    async def _broadcast(self):
+        """Replay the events to every open connection, once"""
+
+        await self._replay(None)
+        await self._drain()
+        self.finished_at = time.perf_counter()
+
+    async def _replay(self, websocket):
+        """Send each event, paced to the configured rate (to every connection if websocket is None)"""
+
+        self.started_at = time.perf_counter()
+
+        for i, event in enumerate(self.events):
+            if self.rate:
+                delay = self.started_at + i / self.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif i % 100 == 0:
+                # Let acks through now and then when sending flat out
+                await asyncio.sleep(0)
+
+            if event.get('type') == 'message':
+                event = dict(event, ts=event.get('ts') or f'{time.time():.6f}')
+                if not event.get('subtype') and parsing.classify(event.get('text', '')):
+                    self._waiting.setdefault(event.get('channel'), []).append(time.perf_counter())
+
+            if websocket is not None:
+                await websocket.send(json.dumps(event))
+                continue
+            frame = json.dumps(event)
+            for frames in self._connections.values():
+                frames.put_nowait(frame)
+
+    async def _drain(self):
+        """Wait until every command has a reply, or replies stop coming"""
+
+        last_count = -1
+        last_change = time.perf_counter()
+        while any(self._waiting.values()):
+            if len(self.received) != last_count:
+                last_count = len(self.received)
+                last_change = time.perf_counter()
+            elif time.perf_counter() - last_change > self.drain_timeout:
+                break
+            await asyncio.sleep(0.01)
+
+    async def _read_replies(self, websocket):
+        """Ack every message the bot sends and time the commands it answers"""
+
+        async for msg in websocket:
+            now = time.perf_counter()
+            msg = json.loads(msg)
+            self.received.append(msg)
+
+            if msg.get('type') == 'message':
+                for sent_at in self._waiting.pop(msg.get('channel'), []):
+                    self.latencies.append(now - sent_at)
+                    self.answered_at.append(now)
+
+            if 'id' in msg:
+                await websocket.send(json.dumps({'ok': True,
+                                                 'reply_to': msg['id'],
+                                                 'ts': f'{time.time():.6f}',
+                                                 'text': msg.get('text')}))
+
+    def report(self):
+        """Return a dict of latency percentiles (in ms) and throughput (events/sec)"""
+
+        elapsed = (self.finished_at or time.perf_counter()) - (self.started_at or 0)
+
+        # Most commands answered in any one second
+        peak = 0
+        start = 0
+        for end, answered in enumerate(self.answered_at):
+            while answered - self.answered_at[start] > 1:
+                start += 1
+            peak = max(peak, end - start + 1)
+
+        def ms(value):
+            return None if value is None else round(value * 1000, 2)
+
+        return {'events': len(self.events),
+                'commands_answered': len(self.latencies),
+                'commands_unanswered': sum(len(sent) for sent in self._waiting.values()),
+                'replies': len(self.received),
+                'p50_ms': ms(percentile(self.latencies, 50)),
+                'p90_ms': ms(percentile(self.latencies, 90)),
+                'p99_ms': ms(percentile(self.latencies, 99)),
+                'max_ms': ms(max(self.latencies, default=None)),
+                'events_per_sec': round(len(self.events) / elapsed, 1) if elapsed else None,
+                'peak_commands_per_sec': peak}
+
+    def __repr__(self):
+        """Representation of the fake Slack"""
+        return f"<Fake Slack: api={self.api_url} ws={self.ws_url} events={len(self.events)}>"
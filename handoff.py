@@ -0,0 +1,193 @@
+"""One bot per host, and handing a running bot's live state to the one replacing it"""
+import asyncio
+import json
+import os
+import struct
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # No flock (like on Windows), so nothing keeps a second instance out
+    fcntl = None
+
+REQUEST = b'HANDOFF'
+DONE = b'DONE\n'
+_LENGTH = struct.Struct('<I')
+
+
+class InstanceLock(object):
+    """Exclusive lock on a file, held for as long as this process runs the bot
+
+    Uses flock, so the lock goes away with the process even if it crashes,
+    and a lock file left behind never keeps a new instance out. The holder
+    writes its pid to the file so other instances can say who has it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    @property
+    def held(self):
+        """Whether this process holds the lock"""
+        return self._fd is not None
+
+    def acquire(self):
+        """Take the lock if it's free, and return whether this process holds it"""
+
+        if self._fd is not None:
+            return True
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    async def wait(self, timeout, interval=0.001):
+        """Keep trying to take the lock for up to timeout seconds, and return whether it was"""
+
+        deadline = time.monotonic() + timeout
+        while not self.acquire():
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(interval)
+        return True
+
+    def holder(self):
+        """Return the pid written by the last process to take the lock, or None"""
+
+        try:
+            with open(self.path, encoding='utf-8') as lock_file:
+                return int(lock_file.read())
+        except (OSError, ValueError):
+            return None
+
+    def release(self):
+        """Let go of the lock (closing the file drops the flock)"""
+
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __repr__(self):
+        """Representation of the lock"""
+        return f"<Instance Lock: path={self.path} held={self.held}>"
+
+
+def _frame(data):
+    """Return data prefixed with its length"""
+    return _LENGTH.pack(len(data)) + data
+
+
+async def _read_frame(reader):
+    """Read one length-prefixed frame"""
+
+    length, = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+    return await reader.readexactly(length)
+
+
+class HandoffServer(object):
+    """Unix socket a running instance listens on for a replacement asking to take over
+
+    When one asks, export is awaited for what to hand over, with the point
+    the new instance wants it to stop at (see request_handoff): it should
+    stop handling events and return the queue state (as bytes) and a dict of
+    anything else to pass on. Once the new instance confirms it has them,
+    finish is called with True (time to let go of the lock and exit);
+    if it never does, finish is called with False and this instance
+    carries on. Only one handoff runs at a time.
+    """
+
+    def __init__(self, export, finish, timeout=10):
+        self.export = export
+        self.finish = finish
+        self.timeout = timeout
+        self._server = None
+        self._busy = False
+
+        self.handoffs = 0
+        self.failed = 0
+
+    async def start(self, path):
+        """Start listening at path and return this server
+
+        Only call this while holding the instance lock: any socket file
+        already at path belongs to an instance that's gone.
+        """
+
+        if os.path.exists(path):
+            os.remove(path)
+        self._server = await asyncio.start_unix_server(self._serve, path)
+        return self
+
+    async def _serve(self, reader, writer):
+        """Hand over to whoever connected, if they ask properly"""
+
+        try:
+            request = await asyncio.wait_for(reader.readline(), self.timeout)
+            command, _, until = request.partition(b' ')
+            if command.strip() != REQUEST or self._busy:
+                return
+            until = json.loads(until) if until.strip() else None
+
+            self._busy = True
+            handed = False
+            try:
+                state, extras = await self.export(until)
+                writer.write(_frame(state) + _frame(json.dumps(extras).encode()))
+                await writer.drain()
+                handed = await asyncio.wait_for(reader.readline(), self.timeout) == DONE
+            except (ConnectionError, asyncio.TimeoutError):
+                pass
+            finally:
+                self._busy = False
+                if handed:
+                    self.handoffs += 1
+                else:
+                    self.failed += 1
+                self.finish(handed)
+        except (ConnectionError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        """Stop listening"""
+
+        if self._server:
+            self._server.close()
+
+    def __repr__(self):
+        """Representation of the server"""
+        return f"<Handoff Server: handoffs={self.handoffs} failed={self.failed}>"
+
+
+async def request_handoff(path, until=None, timeout=10):
+    """Ask the instance listening at path to hand over, and return its (state, extras)
+
+    until (anything JSON can hold) is passed on to its export, to say where
+    to stop. Raises OSError if nothing's listening there, and
+    asyncio.TimeoutError or asyncio.IncompleteReadError if it doesn't hand
+    over in time.
+    """
+
+    reader, writer = await asyncio.open_unix_connection(path)
+    try:
+        writer.write(REQUEST + b' ' + json.dumps(until).encode() + b'\n')
+        state = await asyncio.wait_for(_read_frame(reader), timeout)
+        extras = json.loads(await asyncio.wait_for(_read_frame(reader), timeout))
+        writer.write(DONE)
+        await writer.drain()
+    finally:
+        writer.close()
+    return state, extras
@@ -0,0 +1,161 @@
+"""Bounded buffer between the websocket and event parsing, with load shedding"""
+import asyncio
+import re
+from collections import Counter, deque
+
+# How much each event type matters when the buffer is full: when there's no
+# room, the oldest event of the lowest priority below the new event's is shed
+DEFAULT_PRIORITIES = {'presence_change': 0, 'user_typing': 0, 'reconnect_url': 0,
+                      'user_change': 1, 'message': 2, 'reply': 2, 'hello': 3, 'goodbye': 3}
+DEFAULT_PRIORITY = 1
+
+TYPE_RE = re.compile(r'"type"\s*:\s*"([^"]*)"')
+REPLY_RE = re.compile(r'"reply_to"\s*:')
+
+
+class IngestQueue(object):
+    """Bounded FIFO of raw events, for a fixed pool of consumers to drain
+
+    Holds at most max_size events, handed out in the order they came in.
+    When it's full, room is made by shedding the oldest queued event with a
+    lower priority than the new one. If there isn't one, overflow decides:
+    'block' makes put() wait for room (so reading from the websocket slows
+    down), and 'drop' drops the new event. on_drop, if given, is called with
+    the event type and 'shed' or 'dropped' for every event lost.
+    """
+
+    def __init__(self, max_size=1000, priorities=None, overflow='block', on_drop=None):
+        if overflow not in ('block', 'drop'):
+            raise ValueError(f"Unknown overflow policy {overflow!r}")
+
+        self.max_size = max_size
+        self.priorities = dict(DEFAULT_PRIORITIES if priorities is None else priorities)
+        self.overflow = overflow
+        self.on_drop = on_drop
+
+        # Priority -> deque of (seq, event type, item), each in arrival order
+        self._tiers = {}
+        self._size = 0
+        self._seq = 0
+        self._getters = deque()
+        self._putters = deque()
+
+        self.shed = Counter()
+        self.dropped = Counter()
+        self.full_waits = 0
+        self.max_seen = 0
+
+    def classify(self, frame):
+        """Return the event type of a raw frame, without decoding it
+
+        A frame can have more than one "type" (messages with attachments, for
+        one), so the one with the highest priority wins; guessing high only
+        ever means an event is kept when it could have been shed.
+        """
+
+        if isinstance(frame, bytes):
+            frame = frame.decode('utf-8', 'replace')
+
+        types = TYPE_RE.findall(frame)
+        if not types:
+            return 'reply' if REPLY_RE.search(frame) else None
+        if len(types) == 1:
+            return types[0]
+        return max(types, key=self._priority)
+
+    def _priority(self, event_type):
+        return self.priorities.get(event_type, DEFAULT_PRIORITY)
+
+    async def put(self, item, event_type=None):
+        """Add an item, waiting or shedding as needed; return whether it was added"""
+
+        priority = self._priority(event_type)
+        while self._size >= self.max_size and not self._shed_below(priority):
+            if self.overflow == 'drop':
+                self._lose(event_type, 'dropped')
+                return False
+
+            self.full_waits += 1
+            waiter = asyncio.get_running_loop().create_future()
+            self._putters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                waiter.cancel()
+                raise
+
+        self._seq += 1
+        tier = self._tiers.get(priority)
+        if tier is None:
+            tier = self._tiers[priority] = deque()
+        tier.append((self._seq, event_type, item))
+        self._size += 1
+        self.max_seen = max(self.max_seen, self._size)
+        self._wake(self._getters)
+        return True
+
+    async def get(self):
+        """Remove and return the oldest item, waiting for one if needed"""
+
+        while not self._size:
+            waiter = asyncio.get_running_loop().create_future()
+            self._getters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                waiter.cancel()
+                # Pass the wakeup on, in case this one was meant for us
+                if self._size:
+                    self._wake(self._getters)
+                raise
+
+        return self.get_nowait()
+
+    def get_nowait(self):
+        """Remove and return the oldest item (there has to be one)"""
+
+        # Only a handful of priorities, so finding the oldest head is cheap
+        oldest = min((tier for tier in self._tiers.values() if tier), key=lambda tier: tier[0][0])
+        _, _, item = oldest.popleft()
+        self._size -= 1
+        self._wake(self._putters)
+        return item
+
+    def _shed_below(self, priority):
+        """Drop the oldest item with a priority below this one; return whether one was found"""
+
+        for tier_priority in sorted(self._tiers):
+            if tier_priority >= priority:
+                break
+            tier = self._tiers[tier_priority]
+            if tier:
+                _, event_type, _ = tier.popleft()
+                self._size -= 1
+                self._lose(event_type, 'shed')
+                return True
+        return False
+
+    def _lose(self, event_type, reason):
+        """Count an event that was shed or dropped"""
+
+        (self.shed if reason == 'shed' else self.dropped)[event_type] += 1
+        if self.on_drop:
+            self.on_drop(event_type, reason)
+
+    @staticmethod
+    def _wake(waiters):
+        """Wake the first waiter that's still waiting"""
+
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def __len__(self):
+        return self._size
+
+    def __repr__(self):
+        """Representation of the queue"""
+        return (f"<Ingest Queue: size={self._size}/{self.max_size} "
+                f"shed={sum(self.shed.values())} dropped={sum(self.dropped.values())}>")
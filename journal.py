@@ -0,0 +1,342 @@
+"""Append-only journal and snapshots for saving queue state"""
+import json
+import logging
+import os
+import struct
+import sys
+from array import array
+
+# Snapshot file format: magic, then (seq, string table bytes, queues) as
+# little-endian u64, u32, u32; the string table, every channel and user ID
+# once, NUL-separated UTF-8; and each queue as (channel string, length, kind)
+# u32, u32, u8, followed by its users as u32 string indexes and, for priority
+# queues, their priorities as i64 or f64
+SNAPSHOT_MAGIC = b'QBS2'
+_HEADER = struct.Struct('<4sQII')
+_QUEUE_HEADER = struct.Struct('<IIB')
+PLAIN, INT_PRIORITIES, FLOAT_PRIORITIES = 0, 1, 2
+
+# Under the bot's logger, so these go wherever its logs do
+LOGGER = logging.getLogger('qbot.journal')
+
+
+def _to_bytes(values):
+    """Return an array's values as little-endian bytes"""
+
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(typecode, data):
+    """Return an array of the little-endian values in data"""
+
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def pack_state(seq, queues):
+    """Return a binary snapshot of queue state (channel -> entries, like QueueRegistry.state())"""
+
+    strings = {}
+    parts = []
+    for channel, entries in queues.items():
+        channel_index = strings.setdefault(channel, len(strings))
+        if entries and not isinstance(entries[0], str):
+            users = array('I', [strings.setdefault(user, len(strings)) for user, _ in entries])
+            priorities = [priority for _, priority in entries]
+            if all(isinstance(priority, int) for priority in priorities):
+                kind, priorities = INT_PRIORITIES, array('q', priorities)
+            else:
+                kind, priorities = FLOAT_PRIORITIES, array('d', priorities)
+            parts += [_QUEUE_HEADER.pack(channel_index, len(users), kind),
+                      _to_bytes(users), _to_bytes(priorities)]
+        else:
+            users = array('I', [strings.setdefault(user, len(strings)) for user in entries])
+            parts += [_QUEUE_HEADER.pack(channel_index, len(users), PLAIN), _to_bytes(users)]
+
+    if any('\0' in string for string in strings):
+        raise ValueError("Channel and user IDs can't contain NUL")
+    table = '\0'.join(strings).encode('utf-8')
+    return b''.join([_HEADER.pack(SNAPSHOT_MAGIC, seq, len(table), len(queues)), table, *parts])
+
+
+def unpack_state(data):
+    """Return the (seq, queues) in a binary snapshot made by pack_state
+
+    Raises ValueError if data isn't a whole, valid snapshot.
+    """
+
+    size = len(data)
+    if size < _HEADER.size:
+        raise ValueError("Queue snapshot is truncated")
+    magic, seq, table_size, queue_count = _HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError("Not a queue snapshot")
+    offset = _HEADER.size
+
+    if offset + table_size > size:
+        raise ValueError("Queue snapshot is truncated")
+    strings = data[offset:offset + table_size].decode('utf-8').split('\0')
+    offset += table_size
+    lookup = strings.__getitem__
+
+    queues = {}
+    for _ in range(queue_count):
+        if offset + _QUEUE_HEADER.size > size:
+            raise ValueError("Queue snapshot is truncated")
+        channel_index, length, kind = _QUEUE_HEADER.unpack_from(data, offset)
+        offset += _QUEUE_HEADER.size
+        if kind not in (PLAIN, INT_PRIORITIES, FLOAT_PRIORITIES):
+            raise ValueError(f"Unknown queue kind {kind} in queue snapshot")
+        # Users, and then priorities if it has them
+        if offset + (4 if kind == PLAIN else 12) * length > size:
+            raise ValueError("Queue snapshot is truncated")
+
+        try:
+            channel = strings[channel_index]
+            users = list(map(lookup, _from_bytes('I', data[offset:offset + 4 * length])))
+        except IndexError:
+            raise ValueError("Queue snapshot refers to a missing channel or user ID") from None
+        offset += 4 * length
+        if kind != PLAIN:
+            priorities = _from_bytes('q' if kind == INT_PRIORITIES else 'd',
+                                     data[offset:offset + 8 * length])
+            offset += 8 * length
+            users = [[user, priority] for user, priority in zip(users, priorities)]
+        queues[channel] = users
+
+    if offset != size:
+        raise ValueError("Queue snapshot has extra data after its queues")
+    return seq, queues
+
+
+class QueueJournal(object):
+    """Journal of queue changes, with periodic compacted snapshots
+
+    Every change to a queue is appended to the journal file as a JSON line of
+    [seq, channel, op, *args]. Writes are buffered and flushed to the OS
+    once flush_every changes have piled up, but recording a change never
+    fsyncs: sync() does, or start_sync() and fsync() from another thread, so
+    the fsync is shared by a group of changes and doesn't hold up recording.
+
+    A snapshot holds the full state of every queue and the seq of the last
+    change it includes, in the compact binary format of pack_state. Taking
+    one empties the journal, and loading replays only the journal changes
+    newer than the snapshot. A JSON snapshot.json from before the binary
+    format is still loaded if there's no binary one. A damaged snapshot
+    can't be loaded around (the journal only has the changes since it), so
+    loading refuses to, and leaves both files as they are.
+    """
+
+    def __init__(self, state_dir, flush_every=100, snapshot_every=10000):
+        self.state_dir = state_dir
+        self.flush_every = flush_every
+        self.snapshot_every = snapshot_every
+
+        self.journal_path = os.path.join(state_dir, 'journal.jsonl')
+        self.snapshot_path = os.path.join(state_dir, 'snapshot.bin')
+        self.json_snapshot_path = os.path.join(state_dir, 'snapshot.json')
+
+        self.seq = 0
+        self._unflushed = 0
+        self._unsynced = 0
+        self._since_snapshot = 0
+        self._replaying = False
+        # (seq, journal size) as of the snapshot being taken, if there is one
+        self._snapshot_at = None
+
+        os.makedirs(state_dir, exist_ok=True)
+        self._file = open(self.journal_path, 'a', encoding='utf-8')
+
+    def record(self, channel, op, *args):
+        """Append a queue change to the journal"""
+
+        # Changes made while replaying are already in the journal
+        if self._replaying:
+            return
+
+        self.seq += 1
+        self._file.write(json.dumps([self.seq, channel, op, *args]) + '\n')
+
+        self._unflushed += 1
+        self._unsynced += 1
+        self._since_snapshot += 1
+        if self._unflushed >= self.flush_every:
+            self._file.flush()
+            self._unflushed = 0
+
+    def sync(self):
+        """Flush and fsync any buffered changes to disk"""
+
+        if self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unflushed = self._unsynced = 0
+
+    def start_sync(self):
+        """Flush any buffered changes, and return a file descriptor to fsync them with (or None)
+
+        For syncing without holding up whatever records changes: pass the
+        descriptor (a duplicate, so closing the journal can't pull it out
+        from under the fsync) to fsync(), which can run in another thread.
+        """
+
+        if not self._unsynced:
+            return None
+        self._file.flush()
+        self._unflushed = self._unsynced = 0
+        return os.dup(self._file.fileno())
+
+    @staticmethod
+    def fsync(fd):
+        """fsync and close a file descriptor from start_sync"""
+
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def needs_snapshot(self):
+        """Return whether enough changes have built up to compact the journal"""
+
+        return self._since_snapshot >= self.snapshot_every
+
+    def snapshot(self, registry):
+        """Write the state of every queue in the registry and empty the journal"""
+
+        self.write_snapshot(*self.start_snapshot(registry))
+        self.finish_snapshot()
+
+    def start_snapshot(self, registry):
+        """Return the (seq, state) of every queue in the registry, to pass to write_snapshot
+
+        For taking a snapshot in steps, so that write_snapshot (which packs
+        and fsyncs it) can run in another thread while changes carry on
+        being recorded. Once it's written, finish_snapshot() drops the
+        changes it has from the journal.
+        """
+
+        self._file.flush()
+        self._unflushed = 0
+        self._snapshot_at = (self.seq, os.fstat(self._file.fileno()).st_size)
+        return self.seq, registry.state()
+
+    def write_snapshot(self, seq, state):
+        """Write a snapshot from start_snapshot to disk (this doesn't touch the journal)"""
+
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as snapshot_file:
+            snapshot_file.write(pack_state(seq, state))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        if os.path.exists(self.json_snapshot_path):
+            os.remove(self.json_snapshot_path)
+
+    def finish_snapshot(self):
+        """Empty the journal of the changes in the snapshot just written"""
+
+        if self._snapshot_at is None:
+            return
+        seq, size = self._snapshot_at
+        self._snapshot_at = None
+
+        # Keep anything recorded since the snapshot was started. If we crash
+        # before the truncate, load skips the changes it has by their seq.
+        self._file.flush()
+        self._unflushed = 0
+        with open(self.journal_path, 'rb') as journal_file:
+            journal_file.seek(size)
+            newer = journal_file.read()
+        self._file.seek(0)
+        self._file.truncate()
+        if newer:
+            # They need syncing again, whether or not they were before
+            self._file.write(newer.decode('utf-8'))
+            self._file.flush()
+            self._unsynced = self.seq - seq
+        self._since_snapshot = self.seq - seq
+
+    def load(self, registry):
+        """Restore the registry's queues from the snapshot and journal
+
+        Returns the number of journal changes that were replayed. Raises
+        ValueError, without changing either file, if the snapshot is damaged
+        or a change that isn't the last in the journal is.
+        """
+
+        snapshot_seq = 0
+        replayed = 0
+        # Whether the snapshot needs writing again once everything's loaded
+        rewrite = False
+        queues = {}
+        self._replaying = True
+
+        try:
+            saved = {}
+            if os.path.exists(self.snapshot_path):
+                with open(self.snapshot_path, 'rb') as snapshot_file:
+                    data = snapshot_file.read()
+                try:
+                    snapshot_seq, saved = unpack_state(data)
+                except ValueError as e:
+                    # Replaying the journal onto empty queues would apply its
+                    # changes to the wrong entries and lose everyone queued
+                    # before the snapshot, so leave it all for someone to look at
+                    LOGGER.error("Queue snapshot %s is damaged: %s", self.snapshot_path, e)
+                    raise ValueError(f"Queue snapshot {self.snapshot_path} is damaged ({e}); "
+                                     f"move it and {self.journal_path} aside to start with "
+                                     f"empty queues") from e
+            elif os.path.exists(self.json_snapshot_path):
+                with open(self.json_snapshot_path, encoding='utf-8') as snapshot_file:
+                    state = json.load(snapshot_file)
+                snapshot_seq, saved = state['seq'], state['queues']
+                rewrite = True
+            registry.restore(saved)
+
+            self.seq = snapshot_seq
+            with open(self.journal_path, encoding='utf-8') as journal_file:
+                for line_number, line in enumerate(journal_file, 1):
+                    try:
+                        seq, channel, op, *args = json.loads(line)
+                    except ValueError:
+                        # A crash mid-write leaves a partial last line, but
+                        # anything after it means the journal's damaged, and
+                        # skipping the rest would lose those changes for good
+                        if journal_file.read().strip():
+                            LOGGER.error("Journal %s is damaged at line %d, with changes after it",
+                                         self.journal_path, line_number)
+                            raise ValueError(f"Journal {self.journal_path} is damaged at line "
+                                             f"{line_number}") from None
+                        break
+                    if seq <= snapshot_seq:
+                        rewrite = True
+                        continue
+                    queue = queues.get(channel)
+                    if queue is None:
+                        queue = queues[channel] = registry.get(channel)
+                    getattr(queue, op)(*args)
+                    self.seq = seq
+                    replayed += 1
+        finally:
+            self._replaying = False
+
+        # Start from a clean snapshot so a partial line never sits mid-journal
+        # (there's no need when the snapshot already has everything)
+        if replayed or rewrite or self._file.tell():
+            self.snapshot(registry)
+        return replayed
+
+    def close(self):
+        """Sync and close the journal file"""
+
+        self.sync()
+        self._file.close()
+
+    def __repr__(self):
+        """Representation of the journal"""
+        return f"<Queue Journal: dir={self.state_dir} seq={self.seq}>"
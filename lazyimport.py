@@ -0,0 +1,37 @@
+"""Imports put off until a module is first used, to keep startup fast"""
+import importlib.util
+import sys
+import threading
+
+_LOCK = threading.Lock()
+
+
+def lazy_import(name):
+    """Return the named module, only actually imported when one of its attributes is first used
+
+    Uses importlib's LazyLoader: the module object goes into sys.modules right
+    away, so later imports of it get the same object, but its code only runs
+    on the first attribute lookup. Call load() before first touching it from
+    a thread other than the main one.
+    """
+
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def load(module):
+    """Finish importing a lazily imported module now, safely from any thread"""
+
+    with _LOCK:
+        # Any attribute lookup runs the module's code
+        getattr(module, '__name__')
+    return module
@@ -0,0 +1,160 @@
+"""Structured logging that's written from a background thread"""
+import logging
+import logging.handlers
+import queue
+import sys
+
+LOGGER = logging.getLogger('qbot')
+
+
+def fields(**kwargs):
+    """Return the extra= argument for logging a message with structured fields
+
+    For example: LOGGER.debug("Parsing event", extra=fields(event_type='message'))
+    """
+
+    return {'fields': kwargs}
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Formatter that puts a record's structured fields after the message as key=value"""
+
+    def __init__(self, fmt='%(asctime)s %(levelname)s %(message)s'):
+        super().__init__(fmt)
+
+    def format(self, record):
+        line = super().format(record)
+        record_fields = getattr(record, 'fields', None)
+        if record_fields:
+            line += ' ' + ' '.join(f'{key}={value!r}' for key, value in record_fields.items())
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    """Only let through one in every N records for noisy event types
+
+    Rates map an event_type field to the fraction of its records to keep
+    (1 keeps them all, 0 drops them all). Records without a rate, and records
+    at WARNING or above, always get through. Sampling is by count rather than
+    random, so it's cheap and exact over time.
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = dict(rates or {})
+        self._seen = {}
+        self.dropped = 0
+
+    def filter(self, record):
+        # Records from log_event were sampled before they were even created
+        if record.levelno >= logging.WARNING or getattr(record, 'presampled', False):
+            return True
+
+        record_fields = getattr(record, 'fields', None)
+        return self.keep(record_fields.get('event_type') if record_fields else None)
+
+    def keep(self, event_type):
+        """Return whether the next record for this event type should be logged"""
+
+        rate = self.rates.get(event_type)
+        if rate is None or rate >= 1:
+            return True
+
+        seen = self._seen.get(event_type, 0)
+        self._seen[event_type] = seen + 1
+        keep = rate > 0 and seen % round(1 / rate) == 0
+        if not keep:
+            self.dropped += 1
+        return keep
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves all formatting to the background thread
+
+    The standard QueueHandler formats the message before queueing it, which
+    would put the string formatting back on the event loop.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+# The running handler and listener, set up by setup()
+HANDLER = None
+LISTENER = None
+SAMPLER = SamplingFilter()
+
+
+def setup(level=logging.INFO, stream=None, sample_rates=None):
+    """Send qbot logs through a queue to a background thread that writes them
+
+    Returns the QueueListener; call stop() to flush it when shutting down.
+    """
+
+    global HANDLER, LISTENER
+
+    if LISTENER:
+        LISTENER.stop()
+        LOGGER.removeHandler(HANDLER)
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(KeyValueFormatter())
+
+    records = queue.SimpleQueue()
+    HANDLER = BackgroundQueueHandler(records)
+    HANDLER.addFilter(SAMPLER)
+    LISTENER = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+
+    LOGGER.addHandler(HANDLER)
+    LOGGER.propagate = False
+    set_level(level)
+    if sample_rates is not None:
+        SAMPLER.rates = dict(sample_rates)
+
+    LISTENER.start()
+    return LISTENER
+
+
+def stop():
+    """Flush and stop the background writer"""
+
+    global HANDLER, LISTENER
+
+    if LISTENER:
+        LISTENER.stop()
+        LOGGER.removeHandler(HANDLER)
+        LOGGER.propagate = True
+        HANDLER = LISTENER = None
+
+
+def log_event(event_type, msg, *args, **kwargs):
+    """Log a DEBUG record about an event, with the event type and kwargs as fields
+
+    Checks the level and sampling before building the record, so events that
+    won't be logged cost next to nothing.
+    """
+
+    if LOGGER.isEnabledFor(logging.DEBUG) and SAMPLER.keep(event_type):
+        LOGGER.debug(msg, *args, extra=dict(fields(event_type=event_type, **kwargs),
+                                            presampled=True))
+
+
+def set_level(level):
+    """Change the log level while running (a name like 'DEBUG' or a number)"""
+
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    LOGGER.setLevel(level)
+
+
+def set_sample_rate(event_type, rate):
+    """Change the fraction of an event type's records that get logged, while running"""
+
+    SAMPLER.rates[event_type] = rate
+
+
+def toggle_debug(*args):
+    """Switch between DEBUG and INFO logging (usable as a signal handler)"""
+
+    set_level(logging.INFO if LOGGER.isEnabledFor(logging.DEBUG) else logging.DEBUG)
+    LOGGER.warning("Log level is now %s", logging.getLevelName(LOGGER.level))
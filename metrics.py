@@ -0,0 +1,184 @@
+"""Low-overhead metrics, served as Prometheus text over HTTP"""
+import asyncio
+from bisect import bisect_left
+
+# Upper bounds (in seconds) for timing histograms, from 50us to 10s
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(label, label_value, extra=''):
+    """Return the {label="value"} part of a sample line"""
+
+    pairs = []
+    if label is not None:
+        escaped = str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{label}="{escaped}"')
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter(object):
+    """Count of things that only go up, optionally split by one label"""
+
+    kind = 'counter'
+
+    def __init__(self, name, doc, label=None):
+        self.name = name
+        self.doc = doc
+        self.label = label
+        self._values = {}
+
+    def inc(self, label_value=None, amount=1):
+        """Add amount to the count for this label value"""
+
+        self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def value(self, label_value=None):
+        """Return the count for this label value"""
+
+        return self._values.get(label_value, 0)
+
+    def samples(self):
+        """Yield the Prometheus sample lines"""
+
+        for label_value, value in self._values.items():
+            yield f'{self.name}{_format_labels(self.label, label_value)} {value}'
+
+
+class Gauge(Counter):
+    """Value that can go up and down
+
+    If a callback is given, it's called at scrape time and should return a
+    dict of label values to values (or a single value if there's no label).
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, doc, label=None, callback=None):
+        super().__init__(name, doc, label)
+        self.callback = callback
+
+    def set(self, value, label_value=None):
+        """Set the value for this label value"""
+
+        self._values[label_value] = value
+
+    def samples(self):
+        """Yield the Prometheus sample lines"""
+
+        if self.callback:
+            values = self.callback()
+            if self.label is None:
+                values = {None: values}
+            self._values = dict(values)
+        yield from super().samples()
+
+
+class Histogram(object):
+    """Distribution of observed values in fixed buckets, optionally split by one label
+
+    Observing a value is a bisect and two additions; the cumulative bucket
+    counts Prometheus wants are only worked out when the metrics are scraped.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, label=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.label = label
+        self.buckets = tuple(buckets)
+        # Label value -> [count per bucket (plus one for +Inf), sum]
+        self._values = {}
+
+    def observe(self, value, label_value=None):
+        """Record one observation for this label value"""
+
+        counts = self._values.get(label_value)
+        if counts is None:
+            counts = self._values[label_value] = [[0] * (len(self.buckets) + 1), 0]
+        counts[0][bisect_left(self.buckets, value)] += 1
+        counts[1] += value
+
+    def count(self, label_value=None):
+        """Return the number of observations for this label value"""
+
+        counts = self._values.get(label_value)
+        return sum(counts[0]) if counts else 0
+
+    def samples(self):
+        """Yield the Prometheus sample lines"""
+
+        for label_value, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = _format_labels(self.label, label_value, f'le="{bound}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.label, label_value)
+            yield f'{self.name}_sum{labels} {total}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class MetricsRegistry(object):
+    """Collection of metrics that can be rendered together"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        """Add a metric and return it"""
+
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, doc, label=None):
+        return self.register(Counter(name, doc, label))
+
+    def gauge(self, name, doc, label=None, callback=None):
+        return self.register(Gauge(name, doc, label, callback))
+
+    def histogram(self, name, doc, label=None, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, doc, label, buckets))
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format"""
+
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.doc}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, host='127.0.0.1', port=9100):
+        """Start serving the metrics over HTTP and return the asyncio server"""
+
+        async def handle(reader, writer):
+            request_line = await reader.readline()
+            # Skip the headers; every path gets the metrics
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+
+            if request_line.startswith(b'GET'):
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '405 Method Not Allowed', b''
+
+            writer.write(f'HTTP/1.1 {status}\r\n'
+                         f'Content-Type: text/plain; version=0.0.4\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+            writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+
+# Metrics for the whole bot
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram('qbot_stage_seconds',
+                                   "Time spent in each stage of handling an event", 'stage')
+EVENTS = REGISTRY.counter('qbot_events_total', "Events received from Slack, by type", 'type')
@@ -1,15 +1,48 @@
+import json
+from collections import Counter
+
 import requests
 
+# Users in the mock Slack workspace
+MOCK_USERS = [{'id': f'U{i}', 'name': f'user{i}', 'deleted': i == 4,
+               'profile': {'display_name': f'User {i}', 'real_name': f'Real {i}'}}
+              for i in range(5)]
+
 
 def post_request(url, data=None):
     """Mock POST request"""
 
     if 'slack.com/api/rtm.connect' in url:
         return mock_rtm_connect(data)
+    elif 'slack.com/api/users.list' in url:
+        return mock_users_list(data)
+    elif 'slack.com/api/users.info' in url:
+        return mock_users_info(data)
+    elif 'slack.com/api/chat.postMessage' in url:
+        return mock_post_message(data)
     else:
         return mock_no_response()
 
 
+class MockSession(object):
+    """Mock requests.Session that sends POSTs to post_request and counts them by API method
+
+    Messages posted with chat.postMessage are kept as (channel, text) in posted.
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.posted = []
+
+    def post(self, url, data=None):
+        """Mock POST request"""
+        method = url.rsplit('/', 1)[-1]
+        self.calls[method] += 1
+        if method == 'chat.postMessage':
+            self.posted.append((data.get('channel'), data.get('text')))
+        return post_request(url, data)
+
+
 def mock_rtm_connect(data):
     """Mock request to Slack RTM API (https://slack.com/api/rtm.connect)"""
 
@@ -29,6 +62,42 @@ def mock_rtm_connect(data):
     return response
 
 
+def mock_json_response(body):
+    """Mock 200 response with a JSON body"""
+
+    response = requests.Response()
+    response.status_code = 200
+    response._content = json.dumps(body).encode()
+    return response
+
+
+def mock_users_list(data):
+    """Mock request to Slack users.list API, two users per page"""
+
+    start = int(data.get('cursor') or 0)
+    end = start + 2
+    next_cursor = str(end) if end < len(MOCK_USERS) else ''
+    return mock_json_response({'ok': True, 'members': MOCK_USERS[start:end],
+                               'response_metadata': {'next_cursor': next_cursor}})
+
+
+def mock_users_info(data):
+    """Mock request to Slack users.info API"""
+
+    for user in MOCK_USERS:
+        if user['id'] == data.get('user'):
+            return mock_json_response({'ok': True, 'user': user})
+    return mock_json_response({'ok': False, 'error': 'user_not_found'})
+
+
+def mock_post_message(data):
+    """Mock request to Slack chat.postMessage API"""
+
+    if data.get('token') != 'good-token':
+        return mock_json_response({'ok': False, 'error': 'invalid_auth'})
+    return mock_json_response({'ok': True, 'channel': data.get('channel'), 'ts': '1.0001'})
+
+
 def mock_no_response():
     """Mock 404 request"""
 
@@ -37,3 +106,24 @@ def mock_no_response():
     response._content = b'{}'
 
     return response
+
+
+class MockWebSocket(object):
+    """Mock websocket connection that records sent messages"""
+
+    def __init__(self, events=None):
+        self.sent = []
+        self.events = list(events or [])
+        self.closed = False
+
+    async def send(self, msg):
+        """Mock sending a message"""
+        self.sent.append(msg)
+
+    async def recv(self):
+        """Mock receiving the next queued event"""
+        return self.events.pop(0)
+
+    async def close(self):
+        """Mock closing the connection"""
+        self.closed = True
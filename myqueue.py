@@ -1,5 +1,68 @@
 """Classes for the queue"""
+import asyncio
+import functools
+import operator
 import random
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+
+import metrics
+from waitstats import WaitStats
+
+
+# Who an override added, removed, and moved, each a list of users in queue order
+QueueChanges = namedtuple('QueueChanges', ['added', 'removed', 'moved'])
+
+
+def diff_users(old, new):
+    """Return the QueueChanges that turn the old list of users into the new one
+
+    Moved users are the fewest that have to move to put everyone else in the
+    new order: the users that stayed, minus the longest run of them that kept
+    their order (found in O(n log n) with patience sorting).
+    """
+
+    old_positions = {}
+    for position, user in enumerate(old):
+        old_positions.setdefault(user, []).append(position)
+
+    added = []
+    # (old position, user) for each user that stayed, in the new order
+    kept = []
+    for user in new:
+        positions = old_positions.get(user)
+        if positions:
+            kept.append((positions.pop(0), user))
+        else:
+            added.append(user)
+    removed = [old[position] for position in sorted(position
+                                                    for positions in old_positions.values()
+                                                    for position in positions)]
+
+    # Longest increasing run of old positions: tails[k] ends the best run of length k + 1
+    tail_positions, tails = [], []
+    previous = [None] * len(kept)
+    for i, (position, _) in enumerate(kept):
+        k = bisect_left(tail_positions, position)
+        previous[i] = tails[k - 1] if k else None
+        if k == len(tails):
+            tail_positions.append(position)
+            tails.append(i)
+        else:
+            tail_positions[k] = position
+            tails[k] = i
+
+    in_order = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        in_order.add(i)
+        i = previous[i]
+    moved = [user for i, (_, user) in enumerate(kept) if i not in in_order]
+
+    return QueueChanges(added, removed, moved)
 
 
 class Node(object):
@@ -25,7 +88,12 @@ class LinkedList(object):
     def append(self, data):
         """Add new node with given data to end of linked list"""
 
-        new_node = Node(data)
+        self._link(Node(data))
+
+    def _link(self, new_node):
+        """Add a node to the end of the linked list"""
+
+        new_node.next = None
 
         if not self.head:
             self.head = new_node
@@ -33,6 +101,30 @@ class LinkedList(object):
             self.tail.next = new_node
         self.tail = new_node
 
+    def override(self, values):
+        """Replace the linked list with the given values, in order
+
+        Values already in the list keep their nodes (the earliest node for
+        each time a duplicate value is given); the rest get new nodes.
+        """
+
+        old_nodes = self._nodes_by_value()
+        self.head = self.tail = None
+        for value in values:
+            nodes = old_nodes.get(value)
+            self._link(nodes.pop(0) if nodes else self._new_node(value))
+
+    def _nodes_by_value(self):
+        """Return a dict of each value to its nodes, in list order"""
+
+        nodes = {}
+        for node in self.all():
+            nodes.setdefault(node.data, []).append(node)
+        return nodes
+
+    def _new_node(self, data):
+        return Node(data)
+
     def remove(self, value):
         """Remove and return node with matching data from linked list"""
 
@@ -68,6 +160,11 @@ class LinkedList(object):
             yield curr
             curr = curr.next
 
+    def values(self):
+        """Return a list of the data in the linked list, in order"""
+
+        return [node.data for node in self.all()]
+
     def __repr__(self):
         """Representation of the queue"""
 
@@ -77,6 +174,506 @@ class LinkedList(object):
             return f"<Linked List: head={self.head} tail={self.tail}>"
 
 
+class DoubleNode(Node):
+    """Node class for doubly linked list elements"""
+
+    def __init__(self, data, next_node=None, prev_node=None):
+        """Create a DoubleNode"""
+        super().__init__(data, next_node)
+        self.prev = prev_node
+
+
+class IndexedLinkedList(LinkedList):
+    """Doubly linked list with a dict index from data to nodes
+
+    Appending, finding, and removing a value are O(1) instead of a walk from
+    the head. Duplicate values are allowed, and removal takes the earliest one,
+    same as LinkedList.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # Maps each value to its nodes, in list order
+        self._index = {}
+
+    def append(self, data):
+        """Add new node with given data to end of linked list"""
+
+        self._link(DoubleNode(data))
+
+    def _link(self, new_node):
+        """Add a node to the end of the linked list"""
+
+        new_node.prev = self.tail
+        super()._link(new_node)
+        self._index.setdefault(new_node.data, []).append(new_node)
+
+    def _nodes_by_value(self):
+        """Return a dict of each value to its nodes, in list order"""
+
+        # The index already has them, and gets rebuilt as nodes are linked again
+        nodes, self._index = self._index, {}
+        return nodes
+
+    def _new_node(self, data):
+        return DoubleNode(data)
+
+    def remove(self, value):
+        """Remove and return node with matching data from linked list"""
+
+        nodes = self._index.get(value)
+        if not nodes:
+            return None
+
+        node = nodes.pop(0)
+        if not nodes:
+            del self._index[value]
+
+        # Unlink the node from its neighbors
+        if node.prev:
+            node.prev.next = node.next
+        else:
+            self.head = node.next
+        if node.next:
+            node.next.prev = node.prev
+        else:
+            self.tail = node.prev
+
+        node.next = node.prev = None
+        return node
+
+    def find(self, value):
+        """Return whether node with matching data is in linked list"""
+
+        return value in self._index
+
+
+class HeapNode(object):
+    """Heap entry for a value, with its priority and arrival sequence number"""
+
+    __slots__ = ('data', 'priority', 'seq', 'key', 'pos')
+
+    def __init__(self, data, priority, seq):
+        """Create a HeapNode"""
+        self.data = data
+        self.seq = seq
+        self.pos = None
+        self.set_priority(priority)
+
+    def set_priority(self, priority):
+        """Set the priority and the sort key (highest priority first, then first come first served)"""
+        self.priority = priority
+        self.key = (-priority, self.seq)
+
+    def __repr__(self):
+        """Representation of a heap node"""
+        return f"<HeapNode data={self.data} priority={self.priority}>"
+
+
+_heap_key = operator.attrgetter('key')
+
+
+class IndexedHeap(object):
+    """Binary heap of values by priority, with a dict index from data to nodes
+
+    Works like a linked list to Queue: head is the next value out, and all()
+    yields the nodes in the order they'd come out. Appending, removing, and
+    reprioritizing are O(log n) and finding is O(1). Values with the same
+    priority keep the order they were appended in, by a sequence number that
+    only goes up.
+    """
+
+    def __init__(self):
+        self._heap = []
+        # Maps each value to its nodes (duplicates are allowed)
+        self._index = {}
+        self._seq = 0
+
+    @property
+    def head(self):
+        """The node that comes out next, or None"""
+        return self._heap[0] if self._heap else None
+
+    def append(self, data, priority=0):
+        """Add new node with given data and priority"""
+
+        self._seq += 1
+        node = HeapNode(data, priority, self._seq)
+        node.pos = len(self._heap)
+        self._heap.append(node)
+        self._index.setdefault(data, []).append(node)
+        self._sift_up(node.pos)
+
+    def remove(self, value):
+        """Remove and return the first node out with matching data"""
+
+        node = self._first(value)
+        if node is None:
+            return None
+
+        nodes = self._index[value]
+        nodes.remove(node)
+        if not nodes:
+            del self._index[value]
+
+        # Move the last node into the hole and restore the heap around it
+        last = self._heap.pop()
+        if last is not node:
+            self._heap[node.pos] = last
+            last.pos = node.pos
+            self._sift_down(last.pos)
+            self._sift_up(last.pos)
+
+        node.pos = None
+        return node
+
+    def override(self, items):
+        """Replace the heap with the given (value, priority) items
+
+        Items come out in the order given among equal priorities. Values
+        already in the heap keep their nodes, and keep their priority if it's
+        given as None (new values get 0).
+        """
+
+        old_nodes = self._index
+        self._heap = []
+        self._index = {}
+        for value, priority in items:
+            self._seq += 1
+            nodes = old_nodes.get(value)
+            if nodes:
+                node = nodes.pop(0)
+                node.seq = self._seq
+                node.set_priority(node.priority if priority is None else priority)
+            else:
+                node = HeapNode(value, priority or 0, self._seq)
+            node.pos = len(self._heap)
+            self._heap.append(node)
+            self._index.setdefault(value, []).append(node)
+
+        for pos in reversed(range(len(self._heap) // 2)):
+            self._sift_down(pos)
+
+    def reprioritize(self, value, priority):
+        """Change the priority of the first node out with matching data
+
+        The node keeps its place among nodes of the same priority by when it
+        was first appended. Returns the node, or None if there's no match.
+        """
+
+        node = self._first(value)
+        if node is not None:
+            node.set_priority(priority)
+            self._sift_down(node.pos)
+            self._sift_up(node.pos)
+        return node
+
+    def find(self, value):
+        """Return whether node with matching data is in the heap"""
+
+        return value in self._index
+
+    def all(self):
+        """Yield the nodes in the order they'll come out"""
+
+        yield from sorted(self._heap, key=_heap_key)
+
+    def values(self):
+        """Return a list of the data in the order it'll come out"""
+
+        return [node.data for node in self.all()]
+
+    def _first(self, value):
+        """Return the node with this data that comes out first, or None"""
+
+        nodes = self._index.get(value)
+        if not nodes:
+            return None
+        return min(nodes, key=_heap_key) if len(nodes) > 1 else nodes[0]
+
+    def _swap(self, i, j):
+        heap = self._heap
+        heap[i], heap[j] = heap[j], heap[i]
+        heap[i].pos = i
+        heap[j].pos = j
+
+    def _sift_up(self, pos):
+        heap = self._heap
+        while pos:
+            parent = (pos - 1) // 2
+            if heap[pos].key >= heap[parent].key:
+                break
+            self._swap(pos, parent)
+            pos = parent
+
+    def _sift_down(self, pos):
+        heap = self._heap
+        size = len(heap)
+        while True:
+            smallest = pos
+            for child in (2 * pos + 1, 2 * pos + 2):
+                if child < size and heap[child].key < heap[smallest].key:
+                    smallest = child
+            if smallest == pos:
+                break
+            self._swap(pos, smallest)
+            pos = smallest
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __repr__(self):
+        """Representation of the heap"""
+        head = self.head
+        return f"<Indexed Heap: head={head.data if head else None} size={len(self._heap)}>"
+
+
+class InternTable(object):
+    """Table that gives each distinct value a small integer ID
+
+    Storing the ID instead of the value means each value (like a user's
+    mention string) is kept once, however many queues it's in. The lists
+    using the table keep count of how many entries each ID has across all of
+    them, so they can tell a value isn't in any of them without looking.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        # ID -> value, and ID -> entries holding it
+        self.values = []
+        self.counts = array('i')
+
+    def id_for(self, value):
+        """Return the ID for this value, giving it one if it doesn't have one"""
+
+        value_id = self._ids.get(value)
+        if value_id is None:
+            value_id = self._ids[value] = len(self.values)
+            self.values.append(value)
+            self.counts.append(0)
+        return value_id
+
+    def get_id(self, value):
+        """Return the ID for this value, or None if it doesn't have one"""
+
+        return self._ids.get(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        """Representation of the table"""
+        return f"<Intern Table: values={len(self.values)}>"
+
+
+# Shared by every CompactList that isn't given its own table
+USER_IDS = InternTable()
+
+
+class CompactEntry(object):
+    """Entry handed out by CompactList where the other lists hand out nodes"""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __repr__(self):
+        """Representation of an entry"""
+        return f"<CompactEntry data={self.data}>"
+
+
+class CompactList(object):
+    """Queue storage in a ring buffer of interned integer IDs
+
+    Works like a linked list to Queue, but each entry is a 4-byte slot in an
+    array instead of a node object, and there's no index. Popping the first
+    value doesn't search, a value that's in no list is ruled out by the
+    table's counts, and otherwise finding it is a scan, but a fast one. The
+    buffer doubles when it's full.
+    Removing from the middle just leaves a tombstone in the slot, and once
+    tombstones outnumber the live entries they're compacted away (which may
+    shrink the buffer again). Duplicate values are allowed, and removal takes
+    the earliest one, same as LinkedList.
+    """
+
+    TOMBSTONE = -1
+    MIN_CAPACITY = 8
+    # Slots searched at a time by _find_slot
+    SEARCH_WINDOW = 1024
+
+    __slots__ = ('_table', '_slots', '_start', '_used', '_tombstones')
+
+    def __init__(self, table=None):
+        self._table = USER_IDS if table is None else table
+        self._slots = array('i', [self.TOMBSTONE]) * self.MIN_CAPACITY
+        # Slot of the first entry, and slots in use from there (tombstones
+        # included). The first and last slots in use are never tombstones.
+        self._start = 0
+        self._used = 0
+        self._tombstones = 0
+
+    @property
+    def head(self):
+        """Entry for the first value, or None"""
+
+        if not self._used:
+            return None
+        return CompactEntry(self._table.values[self._slots[self._start]])
+
+    def append(self, data):
+        """Add data to the end of the list"""
+
+        if self._used == len(self._slots):
+            self._resize()
+
+        value_id = self._table.id_for(data)
+        self._slots[(self._start + self._used) % len(self._slots)] = value_id
+        self._used += 1
+        self._table.counts[value_id] += 1
+
+    def remove(self, value):
+        """Remove the first matching value and return an entry for it, or None"""
+
+        slot = self._find_slot(value)
+        if slot is None:
+            return None
+
+        self._table.counts[self._slots[slot]] -= 1
+        self._slots[slot] = self.TOMBSTONE
+        self._tombstones += 1
+        self._trim()
+        # Compact once tombstones pile up, or shrink once the queue drains
+        capacity = len(self._slots)
+        if (self._tombstones > max(self.MIN_CAPACITY, len(self))
+                or (capacity > self.MIN_CAPACITY and 4 * len(self) < capacity)):
+            self._resize()
+        return CompactEntry(value)
+
+    def find(self, value):
+        """Return whether the value is in the list"""
+
+        return self._find_slot(value) is not None
+
+    def override(self, values):
+        """Replace the list with the given values, in order"""
+
+        self._forget()
+        self._slots = array('i', [self.TOMBSTONE]) * self.MIN_CAPACITY
+        self._start = self._used = self._tombstones = 0
+        ids = [self._table.id_for(value) for value in values]
+        if ids:
+            self._fill(ids)
+        counts = self._table.counts
+        for value_id in ids:
+            counts[value_id] += 1
+
+    def values(self):
+        """Return a list of the values in the list, in order"""
+
+        values = self._table.values
+        return [values[value_id] for value_id in self._in_order() if value_id >= 0]
+
+    def all(self):
+        """Yield an entry for each value in the list, in order"""
+
+        for value in self.values():
+            yield CompactEntry(value)
+
+    def _in_order(self):
+        """Return the slots in use, from first to last, as an array"""
+
+        end = self._start + self._used
+        capacity = len(self._slots)
+        if end <= capacity:
+            return self._slots[self._start:end]
+        return self._slots[self._start:] + self._slots[:end - capacity]
+
+    def _find_slot(self, value):
+        """Return the first slot holding this value, or None
+
+        The first slot and the table's counts are checked first. Otherwise
+        this searches the raw bytes of the array, which runs in C at memchr
+        speed, so it's quick even though it's a scan; that's the trade for
+        not keeping an index. It copies SEARCH_WINDOW slots at a time, so
+        values near the front don't cost a copy of the whole buffer.
+        """
+
+        value_id = self._table.get_id(value)
+        if value_id is None or not self._used or not self._table.counts[value_id]:
+            return None
+        if self._slots[self._start] == value_id:
+            return self._start
+
+        item_size = self._slots.itemsize
+        needle = value_id.to_bytes(item_size, sys.byteorder, signed=True)
+        end = self._start + self._used
+        capacity = len(self._slots)
+        ranges = [(self._start, end)] if end <= capacity else [(self._start, capacity),
+                                                                (0, end - capacity)]
+        with memoryview(self._slots) as view:
+            for start, stop in ranges:
+                for window in range(start, stop, self.SEARCH_WINDOW):
+                    haystack = view[window:min(window + self.SEARCH_WINDOW, stop)].tobytes()
+                    found = haystack.find(needle)
+                    # Only matches that line up with a slot count
+                    while found != -1 and found % item_size:
+                        found = haystack.find(needle, found + 1)
+                    if found != -1:
+                        return window + found // item_size
+        return None
+
+    def _forget(self):
+        """Take this list's entries out of the table's counts"""
+
+        counts = self._table.counts
+        for value_id in self._in_order():
+            if value_id >= 0:
+                counts[value_id] -= 1
+
+    def _trim(self):
+        """Drop tombstones from both ends of the slots in use"""
+
+        slots = self._slots
+        capacity = len(slots)
+        while self._used and slots[self._start] == self.TOMBSTONE:
+            self._start = (self._start + 1) % capacity
+            self._used -= 1
+            self._tombstones -= 1
+        while self._used and slots[(self._start + self._used - 1) % capacity] == self.TOMBSTONE:
+            self._used -= 1
+            self._tombstones -= 1
+        if not self._used:
+            self._start = 0
+
+    def _resize(self):
+        """Move the live entries to a new buffer that fits them, dropping tombstones"""
+
+        self._fill([value_id for value_id in self._in_order() if value_id >= 0])
+
+    def _fill(self, ids):
+        """Replace the slots with these IDs, in a buffer with room for at least one more"""
+
+        capacity = self.MIN_CAPACITY
+        while capacity <= len(ids):
+            capacity *= 2
+        self._slots = array('i', ids)
+        self._slots.extend(array('i', [self.TOMBSTONE]) * (capacity - len(ids)))
+        self._start = 0
+        self._used = len(ids)
+        self._tombstones = 0
+
+    def __len__(self):
+        return self._used - self._tombstones
+
+    def __del__(self):
+        self._forget()
+
+    def __repr__(self):
+        """Representation of the list"""
+        return f"<Compact List: size={len(self)} capacity={len(self._slots)}>"
+
+
 class Queue(object):
     """Hackbright Queue class"""
 
@@ -84,19 +681,90 @@ class Queue(object):
                       'earth_americas', 'frog', 'thinking_face', 'blowfish', 'bento', 'balloon', 'dancers', 'guitar',
                       'sunflower', 'lion_face', 'fire', 'elephant', 'hatched_chick', 'dog', 'spider_web', 'eyes']
 
-    def __init__(self):
-        self._list = LinkedList()
+    def __init__(self, indexed=False, journal=None, priority=False, stats=None,
+                 clock=time.monotonic, compact=False):
+        """Create a Queue
+
+        If indexed is True, back the queue with an IndexedLinkedList so that
+        push, pop, remove, and has_user don't walk the list. If priority is
+        True, back it with an IndexedHeap instead, so users can be pushed with
+        a priority and higher priorities are served first (first come, first
+        served within a priority). If compact is True (and priority isn't),
+        back it with a CompactList, which takes far less memory per user. If
+        a journal function is given, it's called with the name and arguments
+        of every change to the queue.
+
+        If stats (a waitstats.WaitStats) is given, the queue notes when each
+        user joins by the clock, and adds how long they waited to the stats
+        when they're popped.
+        """
+        self.priority = priority
+        if priority:
+            self._list_class = IndexedHeap
+        elif compact:
+            self._list_class = CompactList
+        else:
+            self._list_class = IndexedLinkedList if indexed else LinkedList
+        self._list = self._list_class()
         self.emoji = set(Queue.standard_emoji)
+        self.journal = journal
+        self._length = 0
+
+        self.stats = stats
+        self._clock = clock
+        # User -> times they joined (a list, in case they're in more than once)
+        self._joined = {}
 
-    def push(self, value):
-        """Add an element to the end of the linked list"""
+        # Bumped on every change, so __str__ knows when its cached string is stale
+        self.version = 0
+        self._rendered = None
+        self._rendered_version = None
 
-        self._list.append(value)
+    def _record(self, op, *args):
+        """Note a change to the queue and pass it to the journal, if there is one"""
+
+        self.version += 1
+        if self.journal:
+            self.journal(op, *args)
+
+    def push(self, value, priority=None):
+        """Add an element to the end of the linked list
+
+        Priority queues take an optional priority (0 if not given).
+        """
+
+        if priority is None:
+            self._list.append(value)
+            self._record('push', value)
+        else:
+            self._check_priority()
+            self._list.append(value, priority)
+            self._record('push', value, priority)
+        self._length += 1
+
+        if self.stats is not None:
+            self._joined.setdefault(value, []).append(self._clock())
+
+    def reprioritize(self, value, priority):
+        """Change the priority of a user in a priority queue"""
+
+        self._check_priority()
+        if self._list.reprioritize(value, priority):
+            self._record('reprioritize', value, priority)
+
+    def _check_priority(self):
+        """Error out if this isn't a priority queue"""
+
+        if not self.priority:
+            raise ValueError("Priorities only work in a priority queue")
 
     def remove(self, value):
         """Remove an element with the given value"""
 
-        self._list.remove(value)
+        if self._list.remove(value):
+            self._length -= 1
+            self._left(value)
+            self._record('remove', value)
 
     def pop(self):
         """Remove the first element from the linked list"""
@@ -104,7 +772,21 @@ class Queue(object):
         if self.is_empty():
             return None
         else:
-            return self.remove(self._list.head.data)
+            node = self._list.remove(self._list.head.data)
+            self._length -= 1
+            self._left(node.data, served=True)
+            self._record('pop')
+
+    def _left(self, value, served=False):
+        """Forget when a user joined, adding their wait to the stats if they were served"""
+
+        times = self._joined.get(value)
+        if times:
+            joined = times.pop(0)
+            if not times:
+                del self._joined[value]
+            if served:
+                self.stats.add(self._clock() - joined)
 
     def peek(self):
         """Return first user in queue without modifying linked list"""
@@ -124,35 +806,220 @@ class Queue(object):
 
         return self._list.head is None
 
+    def users(self):
+        """Return a list of the users in the queue, in order"""
+
+        return self._list.values()
+
+    def entries(self):
+        """Return what override needs to rebuild the queue
+
+        That's the users in order, or [user, priority] pairs for a priority queue.
+        """
+
+        if self.priority:
+            return [[node.data, node.priority] for node in self._list.all()]
+        return self.users()
+
     def empty(self):
         """Empty the queue"""
 
-        self._list = LinkedList()
+        self._list = self._list_class()
+        self._length = 0
+        self._joined = {}
+        self._record('empty')
 
     def override(self, new_list):
-        """Override the current queue with the given list"""
+        """Override the current queue with the given list
+
+        Only what changed is changed: users already in the queue keep their
+        entries (and when they joined), and the rest are added or dropped.
+        Items for a priority queue can also be [user, priority] pairs (users
+        given without one keep their priority). Returns a QueueChanges of who
+        was added, removed, and moved. Nothing is recorded if the queue
+        already holds exactly these users.
+        """
 
-        self.empty()
-        for item in new_list:
-            self.push(item)
+        new_list = list(new_list)
+        old_users = self.users()
+        if new_list == old_users:
+            return QueueChanges([], [], [])
+        if self.priority:
+            self._list.override([tuple(item) if isinstance(item, (list, tuple)) else (item, None)
+                                 for item in new_list])
+        else:
+            self._list.override(new_list)
+        new_users = self.users()
+
+        if self.stats is not None:
+            joined, self._joined = self._joined, {}
+            for user in new_users:
+                times = joined.get(user)
+                self._joined.setdefault(user, []).append(times.pop(0) if times else self._clock())
+
+        self._length = len(new_list)
+        self._record('override', new_list)
+        return diff_users(old_users, new_users)
+
+    def __len__(self):
+        """Number of users in the queue"""
+        return self._length
 
     def __repr__(self):
         """Representation of the queue"""
         return "<HB Queue>"
 
     def __str__(self):
-        """String format for the queue"""
+        """String format for the queue
 
-        q_str = "QUEUE = [ "
+        The string is cached until the next change to the queue.
+        """
 
-        # Add each node's data to the string
-        for node in self._list.all():
-            q_str += node.data + " "
+        if self._rendered_version == self.version:
+            return self._rendered
+
+        start = time.perf_counter()
 
         # Add a random emoji for empty queues
         if self.is_empty():
-            q_str += f":{ random.sample(self.emoji, 1)[0] }: "
-
-        q_str += "]"
+            q_str = f"QUEUE = [ :{ random.choice(list(self.emoji)) }: ]"
+        else:
+            q_str = "QUEUE = [ " + " ".join(self.users()) + " ]"
 
+        self._rendered = q_str
+        self._rendered_version = self.version
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - start, 'render')
         return q_str
+
+
+class QueueRegistry(object):
+    """Hackbright Queues keyed by Slack channel ID
+
+    Queues are created the first time a channel is looked up, and each channel
+    gets its own asyncio lock so that work in one channel never waits on
+    another. Queues that are empty and haven't been used for idle_timeout
+    seconds are evicted, so memory only grows with the active channels.
+
+    If a journal (like journal.QueueJournal) is given, every change to every
+    queue is recorded in it along with the queue's channel. If priority is
+    True, every queue is a priority queue, and if compact is True, every
+    queue uses compact storage. Each queue keeps stats of how long
+    users waited over the last wait_window seconds (None turns them off).
+
+    Queues loaded with restore() are only built the first time their channel
+    is looked up, so restoring many channels at startup is cheap.
+    """
+
+    def __init__(self, idle_timeout=3600, indexed=True, clock=time.monotonic, journal=None,
+                 priority=False, wait_window=3600, compact=False):
+        self.idle_timeout = idle_timeout
+        self.indexed = indexed
+        self.priority = priority
+        self.compact = compact
+        self.wait_window = wait_window
+        self.journal = journal
+        self._clock = clock
+        # Channel ID -> Queue, least recently used first
+        self._queues = OrderedDict()
+        self._last_used = {}
+        self._locks = {}
+        # Channel ID -> entries for restored queues that haven't been built yet
+        self._saved = {}
+
+    def get(self, channel):
+        """Return the queue for this channel, creating it if needed"""
+
+        queue = self._queues.get(channel)
+        if queue is None:
+            stats = WaitStats(self.wait_window, clock=self._clock) if self.wait_window else None
+            queue = Queue(indexed=self.indexed, priority=self.priority, stats=stats,
+                          clock=self._clock, compact=self.compact)
+            # Restored entries are already saved, so they aren't journaled again
+            saved = self._saved.pop(channel, None)
+            if saved:
+                queue.override(saved)
+            if self.journal:
+                queue.journal = functools.partial(self.journal.record, channel)
+            self._queues[channel] = queue
+        else:
+            self._queues.move_to_end(channel)
+
+        self._last_used[channel] = self._clock()
+        return queue
+
+    def restore(self, queues):
+        """Load saved queues (channel ID -> entries, as from state())"""
+
+        for channel, entries in queues.items():
+            if channel in self._queues:
+                self._queues[channel].override(entries)
+            elif entries:
+                self._saved[channel] = entries
+
+    def lock(self, channel):
+        """Return the asyncio lock for this channel's queue"""
+
+        lock = self._locks.get(channel)
+        if lock is None:
+            lock = self._locks[channel] = asyncio.Lock()
+        return lock
+
+    def evict_idle(self):
+        """Drop empty queues that have been idle too long and return their channels"""
+
+        cutoff = self._clock() - self.idle_timeout
+        evicted = []
+
+        # Queues are in least recently used order, so stop at the first active one
+        for channel in list(self._queues):
+            if self._last_used[channel] > cutoff:
+                break
+            lock = self._locks.get(channel)
+            if self._queues[channel].is_empty() and not (lock and lock.locked()):
+                del self._queues[channel]
+                del self._last_used[channel]
+                self._locks.pop(channel, None)
+                evicted.append(channel)
+
+        # Locks can outlive their queue (or never have had one) if a channel
+        # only sent messages that weren't commands
+        for channel, lock in list(self._locks.items()):
+            if channel not in self._queues and not lock.locked():
+                del self._locks[channel]
+
+        return evicted
+
+    def state(self):
+        """Return a dict of channel IDs to the entries in each non-empty queue"""
+
+        state = dict(self._saved)
+        state.update((channel, queue.entries()) for channel, queue in self._queues.items()
+                     if not queue.is_empty())
+        return state
+
+    def depths(self):
+        """Return a dict of channel IDs to the number of users in each queue"""
+
+        depths = {channel: len(entries) for channel, entries in self._saved.items()}
+        depths.update((channel, len(queue)) for channel, queue in self._queues.items())
+        return depths
+
+    def wait_times(self, p):
+        """Return a dict of channel IDs to the p quantile wait, for queues with waits"""
+
+        waits = {}
+        for channel, queue in self._queues.items():
+            wait = queue.stats.quantile(p) if queue.stats else None
+            if wait is not None:
+                waits[channel] = wait
+        return waits
+
+    def __contains__(self, channel):
+        return channel in self._queues or channel in self._saved
+
+    def __len__(self):
+        return len(self._queues) + len(self._saved)
+
+    def __repr__(self):
+        """Representation of the registry"""
+        return f"<Queue Registry: channels={len(self)}>"
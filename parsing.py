@@ -1,6 +1,70 @@
 """Helper functions for determining the keyword/type of message request"""
 
 import re
+from collections import namedtuple
+
+# Construct regex for things like: queue.empty(), q.clear(  ), queue=[],
+# QUEUE = [ <@User1234> <@U1234here>   ]
+_RE_QUEUE_NAME_ALT = r'q(ueue)?'
+_RE_CLEAR_METHOD_ALT = r'\.(clear|empty)\(\s*\)'
+_RE_USERNAMES = r'(<@\w+>\s*)*'
+_RE_LIST = rf'\s*=\s*\[\s*({ _RE_USERNAMES })\s*\]'
+
+# The regexes below are compiled the first time each one is used, so
+# importing this module (and starting up) doesn't pay for all of them
+_PATTERNS = {
+    'QUEUE_CHANGE_RE': (rf'{ _RE_QUEUE_NAME_ALT }({ _RE_CLEAR_METHOD_ALT }|{ _RE_LIST })', re.I),
+    'USER_RE': (r'<@\w+>', 0),
+    'ENQUEUE_RE': (r'^e?nq(ueue)?\b', 0),
+    'DEQUEUE_RE': (r'^(omw|de?q(ueue)?)\b', 0),
+    'HELP_RE': (r'^q(ueue)?bot\b.+\bhelp\b', 0),
+    'STATUS_RE': (r'^q(ueue)?(bot)?\b.+\bstatus\b', 0),
+    # All the start-of-message commands in one alternation, in the same
+    # priority order that respond_to_message checks them
+    'COMMAND_RE': (r'(?P<dequeue>(omw|de?q(ueue)?)\b)'
+                   r'|(?P<enqueue>e?nq(ueue)?\b)'
+                   r'|(?P<help>q(ueue)?bot\b.+\bhelp\b)'
+                   r'|(?P<status>q(ueue)?(bot)?\b.+\bstatus\b)', 0),
+}
+
+
+class _Regexes(object):
+    """Holder for the regexes in _PATTERNS, compiling each on first lookup"""
+
+    def __getattr__(self, name):
+        try:
+            pattern, flags = _PATTERNS[name]
+        except KeyError:
+            raise AttributeError(name) from None
+        regex = re.compile(pattern, flags)
+        setattr(self, name, regex)
+        return regex
+
+
+_REGEXES = _Regexes()
+
+
+def __getattr__(name):
+    """Look up module-level regexes (like parsing.USER_RE) lazily too"""
+
+    if name in _PATTERNS:
+        return getattr(_REGEXES, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+OVERRIDE = 'override'
+DEQUEUE = 'dequeue'
+ENQUEUE = 'enqueue'
+HELP = 'help'
+STATUS = 'status'
+
+Command = namedtuple('Command', ['kind', 'users', 'new_queue'])
+Command.__doc__ = """A classified message
+
+kind is one of OVERRIDE, DEQUEUE, ENQUEUE, HELP, or STATUS. users holds the
+users mentioned in a dequeue message, and new_queue holds the list of users
+for an override.
+"""
 
 
 def is_enqueue_message(text):
@@ -21,9 +85,7 @@ def is_enqueue_message(text):
     False
     """
 
-    plain_text = text.strip().lower()
-    search_re = r'^e?nq(ueue)?\b'
-    return bool(re.search(search_re, plain_text))
+    return bool(_REGEXES.ENQUEUE_RE.search(text.strip().lower()))
 
 
 def is_dequeue_message(text):
@@ -46,9 +108,7 @@ def is_dequeue_message(text):
     False
     """
 
-    plain_text = text.strip().lower()
-    search_re = r'^(omw|de?q(ueue)?)\b'
-    return bool(re.search(search_re, plain_text))
+    return bool(_REGEXES.DEQUEUE_RE.search(text.strip().lower()))
 
 
 def get_user_to_pop(text):
@@ -60,7 +120,7 @@ def get_user_to_pop(text):
     >>> get_user_to_pop("none here either <@  >")
     """
 
-    match = re.search(r'<@\w+>', text)
+    match = _REGEXES.USER_RE.search(text)
     if match:
         return match.group()
     else:
@@ -77,15 +137,7 @@ def get_queue_change(text):
     >>> get_queue_change("This isn't a real queue change")
     """
 
-    # Construct regex for things like: queue.empty(), q.clear(  ), queue=[],
-    # QUEUE = [ <@User1234> <@U1234here>   ]
-    re_queue_name_alt = r'q(ueue)?'
-    re_clear_method_alt = r'\.(clear|empty)\(\s*\)'
-    re_usernames = r'(<@\w+>\s*)*'
-    re_list = rf'\s*=\s*\[\s*({ re_usernames })\s*\]'
-
-    search_re = rf'{ re_queue_name_alt }({ re_clear_method_alt }|{ re_list })'
-    match = re.search(search_re, text, flags=re.I)
+    match = _REGEXES.QUEUE_CHANGE_RE.search(text)
     # For reference, here's the group order for this regex match
     # Group 1: 'q' or 'queue' to start (mandatory)
     # Group 2: '.a_method( )' or ' = [ a list ]' (mandatory)
@@ -99,7 +151,7 @@ def get_queue_change(text):
             new_queue = []
         # Otherwise find each username in the list
         else:
-            new_queue = re.findall(r'<@\w+>', match.group(4))
+            new_queue = _REGEXES.USER_RE.findall(match.group(4))
 
     # If no match, then not changing the queue
     else:
@@ -123,8 +175,7 @@ def is_help_message(text):
     False
     """
 
-    plain_text = text.strip().lower()
-    return bool(re.search(r'^q(ueue)?bot\b.+\bhelp\b', plain_text))
+    return bool(_REGEXES.HELP_RE.search(text.strip().lower()))
 
 
 def is_status_message(text):
@@ -140,5 +191,34 @@ def is_status_message(text):
     False
     """
 
-    plain_text = text.strip().lower()
-    return bool(re.search(r'^q(ueue)?(bot)?\b.+\bstatus\b', plain_text))
+    return bool(_REGEXES.STATUS_RE.search(text.strip().lower()))
+
+
+def classify(text):
+    """Return the Command for this text, or None if it isn't a command
+
+    Gives the same answer as checking get_queue_change, is_dequeue_message,
+    is_enqueue_message, is_help_message, and is_status_message in that order,
+    but with precompiled regexes and one pass over the start of the message.
+
+    >>> classify("q = [ <@U1234> <@xyz123> ]")
+    Command(kind='override', users=[], new_queue=['<@U1234>', '<@xyz123>'])
+    >>> classify("omw <@U12345678>!")
+    Command(kind='dequeue', users=['<@U12345678>'], new_queue=None)
+    >>> classify("nq please")
+    Command(kind='enqueue', users=[], new_queue=None)
+    >>> classify("hello there")
+    """
+
+    new_queue = get_queue_change(text)
+    if new_queue is not None:
+        return Command(OVERRIDE, [], new_queue)
+
+    match = _REGEXES.COMMAND_RE.match(text.strip().lower())
+    if not match:
+        return None
+
+    kind = match.lastgroup
+    if kind == DEQUEUE:
+        return Command(DEQUEUE, _REGEXES.USER_RE.findall(text), None)
+    return Command(kind, [], None)
@@ -1,18 +1,161 @@
 import os
-import requests
+import signal
+import threading
+import time
 import asyncio
-import websockets
+import functools
 import json
 
+import logs
+import metrics
 import parsing
-from myqueue import Queue
+from journal import QueueJournal, pack_state, unpack_state
+from acks import AckTracker
+from backoff import Backoff
+from batching import CommandBatcher
+from dedupe import EventDeduper
+from directory import UserDirectory
+from eventfilter import EventFilter
+from eventsapi import EventsServer
+from handoff import HandoffServer, InstanceLock, request_handoff
+from ingest import IngestQueue
+from lazyimport import lazy_import, load
+from myqueue import QueueRegistry
+from scheduler import MessageScheduler
+from workers import WorkerPool
+
+# These take longer to import than everything else put together, and aren't
+# needed until the first connection (see http_session)
+requests = lazy_import('requests')
+websockets = lazy_import('websockets')
 
 EVENT_LOOP = asyncio.get_event_loop()
-HB_QUEUE = Queue()
+QUEUES = QueueRegistry()
 
-# qbtesting channel of the queuebottest Slack
+# qbtesting channel of the queuebottest Slack, used for connection notices
 CHANNEL_ID = 'C77DZM4F9'
 
+# Base URL for Slack API calls (can point at a local fake Slack for testing)
+SLACK_API_URL = os.getenv('SLACK_API_URL', 'https://slack.com/api')
+
+# Shared HTTP session, so Slack API calls reuse pooled keep-alive connections
+# (made by http_session the first time it's needed)
+HTTP_SESSION = None
+HTTP_SESSION_LOCK = threading.Lock()
+
+# A connection that stays up this long (in seconds) resets the reconnect backoff
+STABLE_CONNECTION = 60
+
+# How often (in seconds) to look for idle channel queues to evict
+EVICT_INTERVAL = 60
+
+# Where queue state is saved, and how often (in seconds) to sync it to disk
+STATE_DIR = os.getenv('QBOT_STATE_DIR', 'qbot_state')
+JOURNAL_SYNC_INTERVAL = 1
+JOURNAL = None
+
+# Only one instance runs per state directory, holding the lock file there. A
+# new one takes over from it (see take_over) over the socket next to it,
+# waiting up to HANDOFF_TIMEOUT seconds for each step, and up to HANDOFF_QUIET
+# seconds for a first message to say where the running one should stop
+LOCK_FILE = 'qbot.lock'
+HANDOFF_SOCKET = 'qbot.sock'
+HANDOFF_TIMEOUT = 10
+HANDOFF_QUIET = 1
+INSTANCE_LOCK = None
+HANDOFF_SERVER = None
+
+# Set while this instance is the one acting on events; cleared while it waits
+# to take over, and once it starts handing over
+ACTIVE = asyncio.Event()
+ACTIVE.set()
+# Tasks answering messages, which a handoff waits for
+ANSWERING = set()
+# The task running the bot, cancelled once it's handed over
+RUNNING = None
+
+# If set, events come in as Slack Events API posts to this port instead of
+# over an RTM websocket, and replies go out with chat.postMessage; requests
+# are checked against the app's signing secret, if there is one
+EVENTS_PORT = int(os.getenv('QBOT_EVENTS_PORT', 0))
+SIGNING_SECRET = os.getenv('SLACK_SIGNING_SECRET')
+
+# Minimum time (in seconds) between messages sent to the same channel
+SEND_INTERVAL = float(os.getenv('QBOT_SEND_INTERVAL', 1))
+OUTBOX = None
+
+# Number of worker processes to shard channels across (0 handles everything
+# in this process)
+WORKER_COUNT = int(os.getenv('QBOT_WORKERS', 0))
+WORKERS = None
+
+# If set, commands that arrive within this many seconds of each other (0 for
+# the same loop tick) are handled as a batch, with one reply per channel
+BATCH_WINDOW = os.getenv('QBOT_BATCH_WINDOW')
+BATCH_WINDOW = float(BATCH_WINDOW) if BATCH_WINDOW else None
+BATCHER = None
+
+# Most received events waiting to be parsed, how many consumers parse them,
+# and what to do when the buffer's full of events that can't be shed
+# ('block' stops reading from Slack until there's room, 'drop' drops events)
+INGEST_SIZE = int(os.getenv('QBOT_INGEST_SIZE', 1000))
+INGEST_CONSUMERS = 4
+INGEST_OVERFLOW = os.getenv('QBOT_INGEST_OVERFLOW', 'block')
+INGEST = None
+
+# Messages already handled, by channel and ts, so ones Slack sends again
+# (like after a reconnect) don't change a queue twice
+SEEN_MESSAGES = EventDeduper()
+
+# Cached Slack users, set up in main()
+USERS = None
+
+# How often (in seconds) to resend messages that Slack hasn't acked
+ACK_CHECK_INTERVAL = 1
+
+LOGGER = logs.LOGGER
+
+# Event types to handle (comma separated), and optionally the only channels to
+# handle; anything else is dropped before it's decoded
+EVENT_TYPES = os.getenv('QBOT_EVENT_TYPES', 'hello,goodbye,message,user_change').split(',')
+CHANNELS = os.getenv('QBOT_CHANNELS', '').split(',') if os.getenv('QBOT_CHANNELS') else None
+EVENT_FILTER = EventFilter(EVENT_TYPES, CHANNELS)
+
+# Log level and the fraction of presence events to log (changeable at runtime
+# with logs.set_level and logs.set_sample_rate, or SIGUSR1 to toggle debug)
+LOG_LEVEL = os.getenv('QBOT_LOG_LEVEL', 'INFO')
+LOG_SAMPLE_RATES = {'presence_change': 0.01, 'user_typing': 0.01}
+
+# Local port to serve Prometheus metrics on (off by default)
+METRICS_PORT = int(os.getenv('QBOT_METRICS_PORT', 0))
+METRICS_SERVER = None
+STAGE_SECONDS = metrics.STAGE_SECONDS
+EVENTS = metrics.EVENTS
+DUPLICATE_EVENTS = metrics.REGISTRY.counter('qbot_duplicate_events_total',
+                                           "Repeated message events that were ignored")
+SHED_EVENTS = metrics.REGISTRY.counter('qbot_shed_events_total',
+                                      "Events shed to make room for more important ones, by type",
+                                      'type')
+OVERFLOW_EVENTS = metrics.REGISTRY.counter('qbot_overflow_events_total',
+                                          "Events dropped because the ingest buffer was full, by type",
+                                          'type')
+INGEST_DEPTH = metrics.REGISTRY.gauge('qbot_ingest_depth', "Received events waiting to be parsed",
+                                      callback=lambda: len(INGEST) if INGEST is not None else 0)
+INGEST_FULL_WAITS = metrics.REGISTRY.gauge(
+    'qbot_ingest_full_waits', "Times reading from Slack waited for room in the ingest buffer",
+    callback=lambda: INGEST.full_waits if INGEST is not None else 0)
+DROPPED_FRAMES = metrics.REGISTRY.counter('qbot_dropped_frames_total',
+                                         "Frames dropped before decoding, by reason", 'reason')
+# With worker processes, the queues (and their stats) live in the workers
+QUEUE_DEPTH = metrics.REGISTRY.gauge('qbot_queue_depth', "Users waiting in each channel's queue",
+                                     'channel', callback=lambda: (WORKERS or QUEUES).depths())
+WAIT_MEDIAN = metrics.REGISTRY.gauge('qbot_wait_median_seconds',
+                                     "Median time users waited to be served, by channel",
+                                     'channel', callback=lambda: (WORKERS or QUEUES).wait_times(0.5))
+WAIT_P95 = metrics.REGISTRY.gauge('qbot_wait_p95_seconds',
+                                  "95th percentile time users waited to be served, by channel",
+                                  'channel', callback=lambda: (WORKERS or QUEUES).wait_times(0.95))
+
 
 def check_secrets_sourced():
     """Errors out if Slack API key not found"""
@@ -30,125 +173,744 @@ def connect(token):
     Connects to the Slack RTM API with the provided token and gets the WebSocket
     URL returned by the Slack API."""
 
+    # Presence events are the bulk of the traffic, so only ask for them if wanted
     payload = {'token': token,
-               'presence_sub': True}
-    response = requests.post('https://slack.com/api/rtm.connect', data=payload)
+               'presence_sub': 'presence_change' in EVENT_FILTER.event_types}
+    response = http_session().post(f'{SLACK_API_URL}/rtm.connect', data=payload)
     if response.ok and response.json().get('ok'):
         return response.json().get('url')
 
 
+def http_session():
+    """Return the shared HTTP session, making it (and importing requests) the first time"""
+
+    global HTTP_SESSION
+    # Called from executor threads too, so only one of them makes the session
+    with HTTP_SESSION_LOCK:
+        if HTTP_SESSION is None:
+            HTTP_SESSION = load(requests).Session()
+    return HTTP_SESSION
+
+
+async def connect_async(token):
+    """Returns the WebSocket URL like connect, without blocking the event loop"""
+
+    return await EVENT_LOOP.run_in_executor(None, connect, token)
+
+
+async def run_forever(token, backoff=None, max_connections=None, receive=None):
+    """Keep connecting to Slack and receiving events, backing off between tries
+
+    Reconnects in a loop (not by recursion), so the stack stays flat no matter
+    how many times the connection drops, and the queues stay in memory the
+    whole time. Stops after max_connections tries, if given. Each connection
+    is handled by receive (receive_events unless given).
+    """
+
+    backoff = backoff or Backoff()
+    receive = receive or receive_events
+    connections = 0
+
+    while max_connections is None or connections < max_connections:
+        connections += 1
+        connected_at = time.monotonic()
+
+        try:
+            websocket_url = await connect_async(token)
+            if websocket_url:
+                await receive(websocket_url)
+            else:
+                LOGGER.warning("Slack refused the connection")
+        except websockets.ConnectionClosed:
+            LOGGER.warning("Connection closed :(")
+        except (OSError, requests.exceptions.RequestException,
+                websockets.WebSocketException) as error:
+            # Includes a failed websocket handshake (like a 4xx or 5xx from Slack)
+            LOGGER.warning("Connection failed: %r", error)
+
+        # Only a connection that lasted a while means Slack is healthy again
+        if time.monotonic() - connected_at >= STABLE_CONNECTION:
+            backoff.reset()
+
+        delay = backoff.next_delay()
+        LOGGER.info("Restarting in %.1fs...", delay)
+        await asyncio.sleep(delay)
+
+
 async def receive_events(ws_url):
     """Connect to websocket URL and await received messages"""
 
     async with websockets.connect(ws_url) as websocket:
-        print("Opened connection!")
+        LOGGER.info("Opened connection!")
 
         # Set global event ID variable to 1
         global event_id_global
         event_id_global = 1
 
-        # Create global dictionary to track message statuses
-        global sent_responses
-        sent_responses = {}
+        # Create global tracker for acks of sent messages
+        global sent_acks
+        sent_acks = AckTracker()
+
+        # Periodically drop queues for channels that have gone quiet, save
+        # queue changes to disk, and resend unacked messages
+        evict_task = EVENT_LOOP.create_task(evict_idle_queues())
+        sync_task = EVENT_LOOP.create_task(sync_journal())
+        resend_task = EVENT_LOOP.create_task(resend_unacked(websocket))
+
+        # Received events wait in a bounded buffer for a pool of consumers
+        global INGEST
+        INGEST = ingest = IngestQueue(INGEST_SIZE, overflow=INGEST_OVERFLOW, on_drop=count_lost_event)
+        consumers = [EVENT_LOOP.create_task(consume_events(websocket, ingest))
+                     for _ in range(INGEST_CONSUMERS)]
+
+        # A new instance reads events into the buffer, but only acts on them
+        # once the running one has handed over
+        takeover_task = first_message = None
+        if INSTANCE_LOCK is not None and not INSTANCE_LOCK.held:
+            first_message = EVENT_LOOP.create_future()
+            takeover_task = EVENT_LOOP.create_task(take_over(websocket, first_message))
 
         # Continue waiting for event messages until websocket closes or errors
-        while True:
-            print("Waiting for events...")
-            msg = await websocket.recv()
-            print("Got an event!")
+        try:
+            while True:
+                LOGGER.debug("Waiting for events...")
+                msg = await websocket.recv()
+                LOGGER.debug("Got an event!")
+
+                # Skip events the bot doesn't care about without decoding them
+                reason = EVENT_FILTER.drop_reason(msg)
+                if reason:
+                    DROPPED_FRAMES.inc(reason)
+                    continue
+
+                # Until it's taken over, a new instance looks out for the first
+                # message it gets, which is where the running one stops
+                if first_message is not None and not first_message.done():
+                    key = message_key(msg)
+                    if key is not None:
+                        first_message.set_result(key)
+
+                # Queue the event for parsing (waiting here if the buffer's full)
+                await ingest.put((msg, time.perf_counter()), ingest.classify(msg))
+        finally:
+            evict_task.cancel()
+            sync_task.cancel()
+            resend_task.cancel()
+            for consumer in consumers:
+                consumer.cancel()
+            if takeover_task is not None:
+                takeover_task.cancel()
+            # Queue changes in events that already came in still count (unless
+            # they're for the instance this one handed over to)
+            while len(ingest) and ACTIVE.is_set():
+                parse_event(websocket, *ingest.get_nowait())
+            # Replies can't go out on a closed connection
+            if OUTBOX is not None and OUTBOX.websocket is websocket:
+                OUTBOX.cancel()
+            LOGGER.info("Connection ended: %r", sent_acks)
+
+
+def message_key(msg):
+    """Return [channel, ts] if a websocket frame is a message the bot acts on, or else None"""
+
+    try:
+        event = json.loads(msg)
+    except ValueError:
+        return None
+    if (isinstance(event, dict) and event.get('type') == 'message' and event.get('channel')
+            and event.get('ts') and not event.get('subtype')):
+        return [event['channel'], event['ts']]
+    return None
+
+
+async def consume_events(websocket, ingest):
+    """Parse events from the ingest buffer, one at a time, until cancelled"""
+
+    while True:
+        msg, received_at = await ingest.get()
+        await ACTIVE.wait()
+        try:
+            parse_event(websocket, msg, received_at)
+        except Exception:
+            LOGGER.exception("Couldn't parse event")
+
+
+def count_lost_event(event_type, reason):
+    """Count an event the ingest buffer shed or dropped"""
+
+    (SHED_EVENTS if reason == 'shed' else OVERFLOW_EVENTS).inc(event_type or 'unknown')
+    LOGGER.debug("Event %s: %s", reason, event_type)
+
+
+def handle_api_event(event, received_at=None):
+    """Act on an event from the Events API, like parse_event does for websocket events"""
+
+    if received_at is not None:
+        STAGE_SECONDS.observe(time.perf_counter() - received_at, 'receive')
+
+    # The bot's own posts come back as events too
+    if event.get('bot_id'):
+        return
+
+    # Same filtering as websocket frames get, but the event's already decoded
+    if event.get('type') not in EVENT_FILTER.event_types:
+        DROPPED_FRAMES.inc('type')
+        return
+    channels = EVENT_FILTER.channels
+    if channels is not None and event.get('channel') and event['channel'] not in channels:
+        DROPPED_FRAMES.inc('channel')
+        return
+
+    dispatch_event(None, event)
+
+
+async def serve_events(port):
+    """Take events from Events API posts to this port, until cancelled"""
+
+    server = await EventsServer(handle_api_event, SIGNING_SECRET).start('0.0.0.0', port)
+    LOGGER.info("Listening for Events API posts on port %d", server.port)
+    if not SIGNING_SECRET:
+        LOGGER.warning("No SLACK_SIGNING_SECRET set, so requests aren't verified")
+
+    evict_task = EVENT_LOOP.create_task(evict_idle_queues())
+    sync_task = EVENT_LOOP.create_task(sync_journal())
+    try:
+        await asyncio.Event().wait()
+    finally:
+        evict_task.cancel()
+        sync_task.cancel()
+        server.close()
+
+
+async def evict_idle_queues():
+    """Evict idle channel queues from the registry every EVICT_INTERVAL seconds"""
+
+    while True:
+        await asyncio.sleep(EVICT_INTERVAL)
+        QUEUES.evict_idle()
 
-            # Parse the received event at the next opportunity
-            EVENT_LOOP.call_soon(parse_event, websocket, msg)
 
+async def prefetch_users():
+    """Load every user into the directory, logging rather than failing if Slack can't be reached"""
+
+    try:
+        if USERS.session is None:
+            # Off the loop, since the first session imports requests
+            USERS.session = await EVENT_LOOP.run_in_executor(None, http_session)
+        loaded = await USERS.prefetch()
+        LOGGER.info("Loaded %d user(s)", loaded)
+    except (OSError, ValueError, requests.exceptions.RequestException) as error:
+        LOGGER.warning("Couldn't load users: %r", error)
+
+
+def open_journal(state=None):
+    """Restore saved queue state and start journaling changes (only once)
+
+    If given, state is the (seq, queues) handed over by the instance this one
+    took over from. It's already saved, so nothing is loaded from disk, and
+    changes are journaled after its own.
+    """
+
+    global JOURNAL
+    if JOURNAL is None:
+        JOURNAL = QueueJournal(STATE_DIR)
+        QUEUES.journal = JOURNAL
+        if state is None:
+            try:
+                replayed = JOURNAL.load(QUEUES)
+            except ValueError as e:
+                raise SystemExit(f"Couldn't restore the queues: {e}")
+        else:
+            JOURNAL.seq, queues = state
+            QUEUES.restore(queues)
+            replayed = 0
+        LOGGER.info("Restored %d queue(s) (%d journal changes)", len(QUEUES), replayed)
+
+
+def start_handling(state=None):
+    """Set up to handle commands: worker processes, or the journal (and batcher) here
+
+    state is the (seq, queues) handed over by the instance this one took over
+    from, if any.
+    """
+
+    global WORKERS, BATCHER
+    # Each worker keeps its own journal for its channels
+    if WORKER_COUNT:
+        WORKERS = WorkerPool(WORKER_COUNT, deliver_replies, STATE_DIR, loop=EVENT_LOOP).start()
+        LOGGER.info("Started %d worker process(es)", WORKER_COUNT)
+    else:
+        open_journal(state)
+        if BATCH_WINDOW is not None and BATCHER is None:
+            BATCHER = CommandBatcher(handle_batch, EVENT_LOOP, BATCH_WINDOW)
+
+
+async def serve_metrics():
+    """Serve metrics on METRICS_PORT, if it's set
+
+    Failing to (say the port's taken) is only logged: metrics are never a
+    reason not to start, or not to take over from another instance.
+    """
+
+    global METRICS_SERVER
+    if METRICS_PORT:
+        try:
+            METRICS_SERVER = await metrics.REGISTRY.serve(port=METRICS_PORT)
+        except OSError as e:
+            LOGGER.warning("Couldn't serve metrics on port %d, carrying on without them: %s",
+                           METRICS_PORT, e)
+            return
+        LOGGER.info("Serving metrics on http://127.0.0.1:%d/metrics", METRICS_PORT)
+
+
+async def serve_handoffs():
+    """Listen for a new instance asking to take over from this one"""
+
+    global HANDOFF_SERVER
+    HANDOFF_SERVER = await HandoffServer(hand_off, finish_hand_off, HANDOFF_TIMEOUT).start(
+        os.path.join(STATE_DIR, HANDOFF_SOCKET))
+
+
+async def take_free_lock(holder=None):
+    """Take the lock if the instance holding it (pid holder) has gone, and start up
+
+    There's nothing to hand over, so this starts from the queues it saved.
+    Returns whether this instance has the lock.
+    """
+
+    if not INSTANCE_LOCK.acquire():
+        return False
+    LOGGER.info("QBot (pid %s) isn't running anymore, so starting from its saved queues", holder)
+    start_handling()
+    await serve_metrics()
+    await serve_handoffs()
+    ACTIVE.set()
+    return True
+
+
+async def take_over(websocket, first_message):
+    """Take over from the instance holding the lock, now that this one's connected
+
+    Events from this connection wait in the ingest buffer in the meantime.
+    The running instance carries on until it has handled first_message (the
+    [channel, ts] of the first message on this connection, once there is
+    one), so it answers everything from before this instance connected.
+    Then it stops and hands over its queues, the messages it has seen (so
+    none it answered are answered again) and its unsent replies. Once it
+    lets go of the lock, this instance carries on from there. If it doesn't,
+    the connection is closed and run_forever tries again. If the running
+    instance has gone (it exited, or crashed), this one starts from what it
+    saved instead.
+    """
+
+    start = time.perf_counter()
+    holder = INSTANCE_LOCK.holder()
+    if await take_free_lock(holder):
+        return
+    try:
+        until = await asyncio.wait_for(asyncio.shield(first_message), HANDOFF_QUIET)
+    except asyncio.TimeoutError:
+        # It's quiet, so the running instance can stop once it's caught up
+        until = None
+
+    try:
+        state, extras = await request_handoff(os.path.join(STATE_DIR, HANDOFF_SOCKET),
+                                              until, HANDOFF_TIMEOUT)
+        if not await INSTANCE_LOCK.wait(HANDOFF_TIMEOUT):
+            raise TimeoutError("the lock was never released")
+    except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as error:
+        # Nothing listening usually means it's just gone
+        if await take_free_lock(holder):
+            return
+        LOGGER.warning("Couldn't take over from pid %s: %r", holder, error)
+        await websocket.close()
+        return
+
+    SEEN_MESSAGES.remember(map(tuple, extras['seen']))
+    start_handling(unpack_state(state))
+    outbox = get_outbox(websocket)
+    for channel, notices, rendered_queue in extras['replies']:
+        for notice in notices:
+            outbox.send(channel, notice)
+        outbox.send(channel, '', rendered_queue)
+
+    await serve_metrics()
+    await serve_handoffs()
+    ACTIVE.set()
+    LOGGER.info("Took over from pid %s in %.1f ms", holder, (time.perf_counter() - start) * 1000)
+
+
+async def hand_off(until=None):
+    """Stop acting on events and return what to hand to the instance taking over
+
+    Carries on until the message until ([channel, ts]) has been handled, or,
+    without one, every event already read has been; the new instance has
+    everything after that. Commands already under way are finished too, so
+    every change is in the queues handed over, and replies that haven't gone
+    out go along with them.
+    """
+
+    start = time.perf_counter()
+    deadline = time.monotonic() + HANDOFF_TIMEOUT
+    while time.monotonic() < deadline:
+        if until is not None and tuple(until) in SEEN_MESSAGES:
+            break
+        if until is None and (INGEST is None or not len(INGEST)):
+            break
+        await asyncio.sleep(0.001)
+    ACTIVE.clear()
+    if BATCHER is not None:
+        BATCHER.flush()
+    if ANSWERING:
+        await asyncio.wait(list(ANSWERING))
+    if WORKERS:
+        # Workers save their queues as they stop, and their last replies are
+        # delivered (on the loop) before this carries on
+        await EVENT_LOOP.run_in_executor(None, WORKERS.stop)
+    if OUTBOX is not None:
+        await OUTBOX.hold()
+
+    seq = 0
+    if JOURNAL:
+        # The new instance adds its changes to the same journal
+        await fsync_journal(JOURNAL)
+        seq = JOURNAL.seq
+
+    extras = {'seen': SEEN_MESSAGES.keys(),
+              'replies': OUTBOX.held() if OUTBOX is not None else []}
+    LOGGER.info("Handing over %d queue(s) after %.1f ms", len(QUEUES),
+                (time.perf_counter() - start) * 1000)
+    return pack_state(seq, QUEUES.state()), extras
+
+
+def finish_hand_off(handed):
+    """Stop for good once the new instance has everything, or carry on if it didn't take it"""
+
+    global JOURNAL
+    if not handed:
+        LOGGER.warning("The new instance didn't take over, so carrying on")
+        if WORKERS:
+            WORKERS.start()
+        if OUTBOX is not None:
+            OUTBOX.resume()
+        ACTIVE.set()
+        return
 
-def parse_event(websocket, event):
-    """Parse event type to determine and send appropriate response"""
+    # The new instance sends the replies that were waiting
+    if OUTBOX is not None:
+        OUTBOX.cancel()
+    if JOURNAL:
+        JOURNAL.close()
+        JOURNAL = None
+    for server in (HANDOFF_SERVER, METRICS_SERVER):
+        if server is not None:
+            server.close()
+    if INSTANCE_LOCK is not None:
+        INSTANCE_LOCK.release()
+    LOGGER.info("Handed over to the new instance")
+    if RUNNING is not None:
+        RUNNING.cancel()
+
+
+async def fsync_journal(journal):
+    """Fsync the journal's latest changes in the executor, so the loop carries on meanwhile"""
+
+    fd = journal.start_sync()
+    if fd is not None:
+        await EVENT_LOOP.run_in_executor(None, journal.fsync, fd)
+
+
+async def sync_journal():
+    """Sync the journal every JOURNAL_SYNC_INTERVAL seconds, compacting as needed
+
+    The fsyncs and packing and writing snapshots run in the executor, so
+    events carry on being handled (and their changes journaled) meanwhile.
+    """
+
+    while True:
+        await asyncio.sleep(JOURNAL_SYNC_INTERVAL)
+        journal = JOURNAL
+        if not journal:
+            continue
+
+        await fsync_journal(journal)
+        if journal is JOURNAL and journal.needs_snapshot():
+            seq, state = journal.start_snapshot(QUEUES)
+            await EVENT_LOOP.run_in_executor(None, journal.write_snapshot, seq, state)
+            # Unless the journal was closed (handed over) while writing
+            if journal is JOURNAL:
+                journal.finish_snapshot()
+
+
+def parse_event(websocket, event, received_at=None):
+    """Parse event type to determine and send appropriate response
+
+    If given, received_at is the time.perf_counter() when the event came off
+    the websocket, for timing how long it waited to be parsed.
+    """
+
+    start = time.perf_counter()
+    if received_at is not None:
+        STAGE_SECONDS.observe(start - received_at, 'receive')
 
     event = json.loads(event)
-    print("Parsing event:", event)
+    STAGE_SECONDS.observe(time.perf_counter() - start, 'decode')
+    dispatch_event(websocket, event)
+
+
+def dispatch_event(websocket, event):
+    """Act on a decoded event (from the websocket, or the Events API if websocket is None)"""
+
     msg_type = event.get('type')
     reply = event.get('reply_to')
+    logs.log_event(msg_type, "Parsing event", event=event)
+    EVENTS.inc(msg_type or ('reply' if reply else 'unknown'))
 
-    # Add previous sent message's success info to dictionary for server replies
+    # Mark previous sent message as acked for server replies
     if reply:
         if not msg_type:
-            global sent_responses
-            sent_responses[reply] = event
-            # print(sent_responses)
+            latency = sent_acks.acked(reply, event.get('ok', True))
+            if latency is not None:
+                STAGE_SECONDS.observe(latency, 'ack')
+                LOGGER.debug("Message %s acked in %.0f ms", reply, latency * 1000)
         return
 
-    def add_message_task(msg):
-        """Add a coro to the event loop to send message through the websocket"""
-
-        # Use global event id to for the message ids
-        global event_id_global
-        EVENT_LOOP.create_task(send_message(websocket,
-                                            msg,
-                                            event_id_global))
-        event_id_global += 1
+    outbox = get_outbox(websocket)
 
     # If the event is initial hello, respond with connection message
     if msg_type == 'hello':
-        add_message_task("QBot is connected!")
+        outbox.send(CHANNEL_ID, "QBot is connected!")
 
     # If the event is connection closing goodbye, respond with goodbye
     if msg_type == 'goodbye':
-        add_message_task("QBot: Out!")
+        outbox.send(CHANNEL_ID, "QBot: Out!")
+
+    # Keep cached users current
+    if msg_type == 'user_change' and USERS is not None and event.get('user'):
+        USERS.update(event['user'])
 
     # Further parsing for actual messages (ignoring things like channel join msgs)
-    if msg_type == 'message' and event.get('channel') == CHANNEL_ID and not event.get('subtype'):
-        response_msg = respond_to_message(f"<@{event.get('user')}>",
-                                          event.get('text'))
-        if response_msg:
-            add_message_task(response_msg)
+    if msg_type == 'message' and event.get('channel') and not event.get('subtype'):
+        if event.get('ts') and SEEN_MESSAGES.seen((event['channel'], event['ts'])):
+            DUPLICATE_EVENTS.inc()
+            LOGGER.debug("Ignoring repeated message %s in %s", event['ts'], event['channel'])
+            return
+
+        if WORKERS:
+            WORKERS.submit(event.get('channel'), f"<@{event.get('user')}>", event.get('text'))
+        elif BATCHER is not None:
+            BATCHER.add(event.get('channel'), f"<@{event.get('user')}>", event.get('text'))
+        else:
+            task = EVENT_LOOP.create_task(handle_message(outbox,
+                                                         event.get('channel'),
+                                                         f"<@{event.get('user')}>",
+                                                         event.get('text')))
+            ANSWERING.add(task)
+            task.add_done_callback(ANSWERING.discard)
 
 
-def respond_to_message(user, text):
-    """Parse messages to determine and return appropriate response"""
+def get_outbox(websocket):
+    """Return the message scheduler that sends everything on this websocket
+
+    With no websocket (in Events API mode), messages go out with chat.postMessage.
+    """
+
+    global OUTBOX
+    if OUTBOX is None or OUTBOX.websocket is not websocket:
+        # Anything still waiting for an old connection can't be sent anymore
+        if OUTBOX is not None:
+            OUTBOX.cancel()
+        send = send_to_channel if websocket is not None else post_to_channel
+        OUTBOX = MessageScheduler(websocket, send, SEND_INTERVAL)
+    return OUTBOX
+
+
+def next_event_id():
+    """Return the next local event id for an outgoing message"""
+
+    global event_id_global
+    event_id = event_id_global
+    event_id_global += 1
+    return event_id
+
+
+async def handle_message(outbox, channel, user, text):
+    """Respond to a message and schedule the reply, in order for its channel
+
+    Holds the channel's lock while responding, so commands in one channel are
+    handled in the order they came in without holding up any other channel.
+    """
+
+    async with QUEUES.lock(channel):
+        response = get_response(user, text, channel)
+        if response:
+            response_msg, hb_queue = response
+            outbox.send(channel, response_msg, hb_queue)
+
+
+def handle_batch(commands):
+    """Respond to a batch of commands, with one reply per channel"""
+
+    # Replies for a connection that's gone can't be sent
+    if OUTBOX is not None:
+        for channel, response_msg, hb_queue in get_responses(commands):
+            OUTBOX.send(channel, response_msg, hb_queue)
+
+
+def deliver_replies(replies):
+    """Schedule replies that came back from the worker processes"""
+
+    # Replies for a connection that's gone can't be sent
+    if OUTBOX is not None:
+        for channel, response_msg, rendered_queue in replies:
+            OUTBOX.send(channel, response_msg, rendered_queue)
+
+
+def respond_to_message(user, text, channel=CHANNEL_ID):
+    """Parse messages to determine and return appropriate response
+
+    Commands change the queue for the given channel.
+    """
 
-    potential_new_queue = parsing.get_queue_change(text)
+    response = get_response(user, text, channel)
+    if response:
+        response_msg, hb_queue = response
+        return response_msg + str(hb_queue)
+
+
+def get_responses(commands):
+    """Carry out a batch of (channel, user, text) commands, in order
+
+    Returns a list with a tuple for each channel that got a response: the
+    channel, every response message for it joined in order, and its queue
+    (left for the caller to render once).
+    """
+
+    responses = {}
+    for channel, user, text in commands:
+        response = get_response(user, text, channel)
+        if response:
+            response_msg, hb_queue = response
+            previous = responses.get(channel)
+            if previous:
+                response_msg = previous[0] + response_msg
+            responses[channel] = (response_msg, hb_queue)
+    return [(channel, response_msg, hb_queue)
+            for channel, (response_msg, hb_queue) in responses.items()]
+
+
+def get_response(user, text, channel=CHANNEL_ID):
+    """Carry out a message's command and return the response
+
+    Returns a tuple of the response message (if any) and the channel's queue,
+    or None if the message isn't a command.
+    """
+
+    start = time.perf_counter()
+    command = parsing.classify(text)
+    STAGE_SECONDS.observe(time.perf_counter() - start, 'classify')
     response_msg = ''
 
+    # If none of the commands match, return None
+    if command is None:
+        return
+
+    hb_queue = QUEUES.get(channel)
+
     # If the message is to recreate/override the queue
-    if potential_new_queue is not None:
-        HB_QUEUE.override(potential_new_queue)
+    if command.kind == parsing.OVERRIDE:
+        response_msg = describe_changes(user, hb_queue.override(command.new_queue))
 
     # If the message indicates that they're on their way to someone:
-    elif parsing.is_dequeue_message(text):
+    elif command.kind == parsing.DEQUEUE:
 
         # Find the user they're trying to pop
-        user_to_pop = parsing.get_user_to_pop(text)
+        user_to_pop = command.users[0] if command.users else None
         if user_to_pop:
-            if user_to_pop == HB_QUEUE.peek():
-                HB_QUEUE.pop()
+            if user_to_pop == hb_queue.peek():
+                hb_queue.pop()
             elif user_to_pop == user:
-                HB_QUEUE.remove(user)
+                hb_queue.remove(user)
             else:
                 response_msg = f"First in, first out! You can't dequeue that person yet {user}.\n"
         else:
             response_msg = f"Please specify who you want to dequeue {user}.\n"
 
     # If the message indicates they want to be added to the queue:
-    elif parsing.is_enqueue_message(text):
-        if HB_QUEUE.has_user(user):
+    elif command.kind == parsing.ENQUEUE:
+        if hb_queue.has_user(user):
             response_msg = f"You're already in the queue {user}.\n"
         else:
-            HB_QUEUE.push(user)
+            hb_queue.push(user)
 
     # Return help message
-    elif parsing.is_help_message(text):
+    elif command.kind == parsing.HELP:
         response_msg = f"Here's where a helpful message would go!\n"
 
     # Return a status update
-    elif parsing.is_status_message(text):
-        response_msg = "Qbot is up and running!\nType 'qbot help' to see a list of commands.\n"
+    elif command.kind == parsing.STATUS:
+        response_msg = "Qbot is up and running!\n"
+        if hb_queue.stats and hb_queue.stats.count():
+            response_msg += (f"Recent wait times: {format_wait(hb_queue.stats.quantile(0.5))} median, "
+                             f"{format_wait(hb_queue.stats.quantile(0.95))} for the slowest 5%.\n")
+        response_msg += "Type 'qbot help' to see a list of commands.\n"
 
-    # If none of the conditions are met, return None
-    else:
+    # Return the specified message (if any) and the queue
+    return response_msg, hb_queue
+
+
+def describe_changes(user, changes):
+    """Return a notice of what an override changed, or '' if nothing did"""
+
+    parts = [f"{action} {' '.join(users)}"
+             for action, users in zip(('added', 'removed', 'moved'), changes) if users]
+    if parts:
+        return f"{user} changed the queue: {', '.join(parts)}.\n"
+    return ''
+
+
+def format_wait(seconds):
+    """Return a wait time in seconds as a short string like '4m 05s'"""
+
+    minutes, seconds = divmod(round(seconds), 60)
+    if minutes >= 60:
+        return f"{minutes // 60}h {minutes % 60:02d}m"
+    if minutes:
+        return f"{minutes}m {seconds:02d}s"
+    return f"{seconds}s"
+
+
+async def send_to_channel(websocket, channel, msg):
+    """Send a message to a channel with the next local event id"""
+
+    try:
+        await send_message(websocket, msg, next_event_id(), channel)
+    except websockets.ConnectionClosed:
+        # receive_events sees the close too, and main() reconnects
+        LOGGER.warning("Couldn't send message to %s, connection closed", channel)
+
+
+async def post_to_channel(websocket, channel, msg):
+    """Send a message to a channel with chat.postMessage (websocket is unused)"""
+
+    post = functools.partial(post_message, check_secrets_sourced(), channel, msg)
+    start = time.perf_counter()
+    try:
+        response = await EVENT_LOOP.run_in_executor(None, post)
+    except (OSError, ValueError, requests.exceptions.RequestException) as error:
+        LOGGER.warning("Couldn't send message to %s: %r", channel, error)
         return
+    STAGE_SECONDS.observe(time.perf_counter() - start, 'send')
+    if not response.get('ok'):
+        LOGGER.warning("Couldn't send message to %s: %s", channel, response.get('error'))
 
-    # Return the specified message (if any) and the queue
-    return response_msg + str(HB_QUEUE)
+
+def post_message(token, channel, msg):
+    """Post a message with the Slack Web API and return the decoded response"""
+
+    response = http_session().post(f'{SLACK_API_URL}/chat.postMessage',
+                                   data={'token': token, 'channel': channel, 'text': msg})
+    return response.json()
 
 
 async def send_message(websocket, msg, local_event_id, channel=CHANNEL_ID):
@@ -164,31 +926,85 @@ async def send_message(websocket, msg, local_event_id, channel=CHANNEL_ID):
                            'type': 'message',
                            'channel': channel,
                            'text': msg})
-    print(f"Sending message {local_event_id}: {msg}...")
+    LOGGER.debug("Sending message %s: %s...", local_event_id, msg)
     # await asyncio.sleep(5)
+    start = time.perf_counter()
     await websocket.send(msg_json)
-    print(f"Sent message {local_event_id}!")
+    STAGE_SECONDS.observe(time.perf_counter() - start, 'send')
+    LOGGER.debug("Sent message %s!", local_event_id)
+
+    # Track the sent message until Slack acks it
+    sent_acks.sent(local_event_id, msg, channel)
+
+
+async def resend_unacked(websocket):
+    """Resend messages that haven't been acked every ACK_CHECK_INTERVAL seconds
+
+    They go through the outbox again, as new messages with new ids, so they
+    keep to the channel's send interval. A message's text ends with the queue
+    as it was then, so it isn't resent if a newer message to the channel has
+    been sent or is waiting to be. It's resent as the channel's state, so one
+    that comes along while it waits replaces it rather than following it.
+    """
 
-    # Add the sent message to global sent_responses dict
-    global sent_responses
-    sent_responses[local_event_id] = None
+    while True:
+        await asyncio.sleep(ACK_CHECK_INTERVAL)
+        for local_event_id, channel, msg in sent_acks.due(OUTBOX if OUTBOX is not None else ()):
+            LOGGER.info("Resending unacked message %s...", local_event_id)
+            get_outbox(websocket).send(channel, state=msg)
 
 
 def main():
-    """Recursive main function to maintain continuous qbot connection"""
+    """Main function to maintain continuous qbot connection"""
+
+    logs.setup(LOG_LEVEL, sample_rates=LOG_SAMPLE_RATES)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, logs.toggle_debug)
 
     token = check_secrets_sourced()
-    websocket_url = connect(token)
 
+    global USERS, INSTANCE_LOCK, RUNNING
+    USERS = UserDirectory(token, HTTP_SESSION, SLACK_API_URL)
+    EVENT_LOOP.create_task(prefetch_users())
+
+    # Only one instance acts on events at a time; a new one connects, then
+    # takes over from the running one (see take_over)
+    INSTANCE_LOCK = InstanceLock(os.path.join(STATE_DIR, LOCK_FILE))
+    if INSTANCE_LOCK.acquire():
+        start_handling()
+        EVENT_LOOP.run_until_complete(serve_metrics())
+        if not EVENTS_PORT:
+            EVENT_LOOP.run_until_complete(serve_handoffs())
+    elif EVENTS_PORT:
+        # The running instance has the port, and events it's acked can't be
+        # handed over, so there's no taking over in this mode
+        raise SystemExit(f"QBot is already running (pid {INSTANCE_LOCK.holder()})")
+    else:
+        LOGGER.info("QBot is already running (pid %s), so taking over once connected",
+                    INSTANCE_LOCK.holder())
+        ACTIVE.clear()
+
+    if EVENTS_PORT:
+        RUNNING = EVENT_LOOP.create_task(serve_events(EVENTS_PORT))
+    else:
+        RUNNING = EVENT_LOOP.create_task(run_forever(token))
     try:
-        EVENT_LOOP.run_until_complete(receive_events(websocket_url))
-    except websockets.exceptions.ConnectionClosed:
-        print("Connection closed :(")
-        print("Restarting...")
-        main()
+        EVENT_LOOP.run_until_complete(RUNNING)
+    except asyncio.CancelledError:
+        # Handed over, and the new instance has saved everything
+        LOGGER.info("*Stopped*")
+        logs.stop()
     except KeyboardInterrupt:
         EVENT_LOOP.stop()
-        print("\n*Stopped*")
+        # Save a compact copy of the queues for the next start
+        if WORKERS:
+            WORKERS.stop()
+        elif JOURNAL:
+            JOURNAL.snapshot(QUEUES)
+            JOURNAL.close()
+        INSTANCE_LOCK.release()
+        LOGGER.info("*Stopped*")
+        logs.stop()
 
 
 if __name__ == '__main__':
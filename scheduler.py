@@ -0,0 +1,123 @@
+"""Rate-limited scheduler for outgoing Slack messages"""
+import asyncio
+
+
+class PendingMessage(object):
+    """Notices and the latest queue state waiting to be sent to one channel"""
+
+    def __init__(self):
+        self.notices = []
+        self.state = None
+
+    def text(self):
+        """Return the message text, with all the notices and then the state"""
+
+        parts = list(self.notices)
+        if self.state is not None:
+            parts.append(str(self.state))
+
+        # Put each part on its own line
+        return ''.join(part if part.endswith('\n') else part + '\n'
+                       for part in parts[:-1]) + parts[-1]
+
+
+class MessageScheduler(object):
+    """Send messages to each channel no more often than once per send_interval
+
+    Messages for a channel are held while the channel is waiting out its
+    interval. Notices (errors, "you're already in the queue", etc.) pile up
+    in order, but only the latest queue state is kept, so a burst of commands
+    collapses into one message with every notice and the newest queue.
+
+    The state can be any object (like a Queue); it's rendered with str() when
+    the message is actually sent. send is a coroutine function that takes the
+    websocket, a channel, and the message text, and writes it to the websocket.
+
+    hold() stops sending (once any send under way has finished) while
+    messages keep piling up, so they can be handed to another instance with
+    held(); resume() starts sending them again.
+    """
+
+    def __init__(self, websocket, send, send_interval=1.0):
+        self.websocket = websocket
+        self._send = send
+        self.send_interval = send_interval
+        # Channel ID -> PendingMessage, and the task draining each channel
+        self._pending = {}
+        self._tasks = {}
+        self._held = False
+        self._sending = 0
+
+    def send(self, channel, notice='', state=None):
+        """Schedule a notice and/or the latest queue state for a channel"""
+
+        if not notice and state is None:
+            return
+
+        pending = self._pending.get(channel)
+        if pending is None:
+            pending = self._pending[channel] = PendingMessage()
+
+        if notice:
+            pending.notices.append(notice)
+        if state is not None:
+            pending.state = state
+
+        if channel not in self._tasks and not self._held:
+            self._tasks[channel] = asyncio.ensure_future(self._drain(channel))
+
+    async def _drain(self, channel):
+        """Send a channel's pending messages, waiting send_interval between them"""
+
+        try:
+            while channel in self._pending and not self._held:
+                pending = self._pending.pop(channel)
+                self._sending += 1
+                try:
+                    await self._send(self.websocket, channel, pending.text())
+                finally:
+                    self._sending -= 1
+                await asyncio.sleep(self.send_interval)
+        finally:
+            del self._tasks[channel]
+
+    async def hold(self):
+        """Stop sending, and return once no message is partway out"""
+
+        self._held = True
+        while self._sending:
+            await asyncio.sleep(0.001)
+
+    def held(self):
+        """Return (channel, notices, rendered state or None) for each channel with messages waiting"""
+
+        return [(channel, list(pending.notices),
+                 None if pending.state is None else str(pending.state))
+                for channel, pending in self._pending.items()]
+
+    def resume(self):
+        """Start sending again after hold()"""
+
+        self._held = False
+        for channel in self._pending:
+            if channel not in self._tasks:
+                self._tasks[channel] = asyncio.ensure_future(self._drain(channel))
+
+    def cancel(self):
+        """Stop sending and drop all pending messages"""
+
+        for task in list(self._tasks.values()):
+            task.cancel()
+        self._pending.clear()
+
+    def __len__(self):
+        """Number of channels with messages waiting to be sent"""
+        return len(self._pending)
+
+    def __contains__(self, channel):
+        """Whether a message is waiting to be sent to a channel"""
+        return channel in self._pending
+
+    def __repr__(self):
+        """Representation of the scheduler"""
+        return f"<Message Scheduler: pending={len(self._pending)} interval={self.send_interval}>"
@@ -1,9 +1,29 @@
 import unittest
+import asyncio
+import json
+import os
 import requests
 
 import qbot
 import myqueue
 import parsing
+import journal
+import scheduler
+import acks
+import batching
+import fakeslack
+import backoff
+import workers
+import waitstats
+import directory
+import dedupe
+import ingest
+import lazyimport
+import eventfilter
+import eventsapi
+import handoff
+import metrics
+import logs
 
 import mocks
 
@@ -12,8 +32,8 @@ class TestQbot(unittest.TestCase):
     """Tests for the QBot"""
 
     def setUp(self):
-        requests.post = mocks.post_request
-        # Probably something with resetting qbot.EVENT_LOOP & qbot.HB_QUEUE
+        qbot.HTTP_SESSION = mocks.MockSession()
+        # Probably something with resetting qbot.EVENT_LOOP & qbot.QUEUES
         # Also setting up a websocket?
 
     def test_secrets_sourced(self):
@@ -32,17 +52,1678 @@ class TestQbot(unittest.TestCase):
         no_url = qbot.connect('bad-token')
         self.assertIsNone(no_url)
 
+    def test_connect_async(self):
+        good_url = qbot.EVENT_LOOP.run_until_complete(qbot.connect_async('good-token'))
+        self.assertEqual(good_url, 'websock.et/url')
+
+    def test_run_forever(self):
+        import sys
+        import tracemalloc
+
+        stack_depths = []
+
+        async def dropped_connection(ws_url):
+            depth = 0
+            frame = sys._getframe()
+            while frame:
+                depth += 1
+                frame = frame.f_back
+            stack_depths.append(depth)
+            raise ConnectionResetError("forced disconnect")
+
+        no_wait = backoff.Backoff(base=0, storm_delay=0)
+
+        def reconnect(times):
+            # Keep the log records of every disconnect out of the memory check
+            qbot.LOGGER.disabled = True
+            try:
+                qbot.EVENT_LOOP.run_until_complete(
+                    qbot.run_forever('good-token', no_wait, max_connections=times,
+                                     receive=dropped_connection))
+            finally:
+                qbot.LOGGER.disabled = False
+
+        qbot.QUEUES = myqueue.QueueRegistry()
+        qbot.QUEUES.get('C1').push('<@A>')
+
+        tracemalloc.start()
+        reconnect(1000)
+        warm, _ = tracemalloc.get_traced_memory()
+        reconnect(9000)
+        reconnected, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.assertEqual(len(stack_depths), 10000)
+        self.assertEqual(len(set(stack_depths)), 1)
+        self.assertLess(reconnected - warm, 100000)
+        self.assertEqual(str(qbot.QUEUES.get('C1')), "QUEUE = [ <@A> ]")
+
+    def test_run_forever_handshake(self):
+        import websockets
+
+        attempts = []
+
+        async def refused(ws_url):
+            attempts.append(ws_url)
+            raise websockets.InvalidHandshake("server rejected WebSocket connection: HTTP 503")
+
+        no_wait = backoff.Backoff(base=0, storm_delay=0)
+        with self.assertLogs(qbot.LOGGER, 'WARNING') as logged:
+            qbot.EVENT_LOOP.run_until_complete(
+                qbot.run_forever('good-token', no_wait, max_connections=3, receive=refused))
+
+        # A failed handshake is retried like any other failed connection
+        self.assertEqual(attempts, ['websock.et/url'] * 3)
+        self.assertEqual(len([line for line in logged.output if 'Connection failed' in line]), 3)
+
     def test_receive_events(self):
-        pass
+        import websockets
+
+        events = [{'type': 'message', 'channel': 'C1', 'user': 'A', 'text': 'nq'},
+                  {'type': 'presence_change', 'user': 'A', 'presence': 'away'},
+                  {'type': 'message', 'channel': 'C2', 'user': 'B', 'text': 'nq'},
+                  {'type': 'message', 'channel': 'C1', 'user': 'C', 'text': 'just chatting'}]
+        fake = fakeslack.FakeSlack(events, drain_timeout=1).start()
+        qbot.QUEUES = myqueue.QueueRegistry()
+        qbot.OUTBOX = None
+        qbot.SEND_INTERVAL, send_interval = 0, qbot.SEND_INTERVAL
+        qbot.SLACK_API_URL, api_url = fake.api_url, qbot.SLACK_API_URL
+        # The local fake Slack needs real requests
+        qbot.HTTP_SESSION = requests.Session()
+        dropped = qbot.DROPPED_FRAMES.value('type')
+
+        try:
+            ws_url = qbot.connect('good-token')
+            self.assertEqual(ws_url, fake.ws_url)
+            with self.assertRaises(websockets.ConnectionClosed):
+                qbot.EVENT_LOOP.run_until_complete(qbot.receive_events(ws_url))
+        finally:
+            fake.stop()
+            qbot.SEND_INTERVAL = send_interval
+            qbot.SLACK_API_URL = api_url
+
+        texts = [(msg['channel'], msg['text']) for msg in fake.received]
+        self.assertIn((qbot.CHANNEL_ID, "QBot is connected!"), texts)
+        self.assertIn(('C1', "QUEUE = [ <@A> ]"), texts)
+        self.assertIn(('C2', "QUEUE = [ <@B> ]"), texts)
+
+        report = fake.report()
+        self.assertEqual(report['commands_answered'], 2)
+        self.assertEqual(report['commands_unanswered'], 0)
+        self.assertEqual(qbot.sent_acks.acked_count, len(fake.received))
+        # The presence event never got decoded
+        self.assertEqual(qbot.DROPPED_FRAMES.value('type'), dropped + 1)
 
     def test_parse_event(self):
-        pass
+        qbot.QUEUES = myqueue.QueueRegistry()
+        qbot.event_id_global = 1
+        qbot.sent_acks = acks.AckTracker()
+        websocket = mocks.MockWebSocket()
+
+        for channel, user in [('C1', 'A'), ('C2', 'B'), ('C1', 'B')]:
+            event = {'type': 'message', 'channel': channel, 'user': user, 'text': 'nq'}
+            qbot.parse_event(websocket, json.dumps(event))
+        qbot.parse_event(websocket, json.dumps({'type': 'message', 'channel': 'C1',
+                                                'subtype': 'channel_join', 'user': 'C'}))
+        qbot.EVENT_LOOP.run_until_complete(asyncio.sleep(0.01))
+
+        qbot.OUTBOX.cancel()
+
+        # Both of C1's replies collapse into one message with the latest queue
+        sent = [json.loads(msg) for msg in websocket.sent]
+        self.assertEqual([(msg['channel'], msg['text']) for msg in sent],
+                         [('C1', "QUEUE = [ <@A> <@B> ]"),
+                          ('C2', "QUEUE = [ <@B> ]")])
+        self.assertEqual(len(qbot.sent_acks), 2)
+
+        acks_timed = qbot.STAGE_SECONDS.count('ack')
+        qbot.parse_event(websocket, json.dumps({'ok': True, 'reply_to': 1, 'ts': '1.0'}))
+        self.assertNotIn(1, qbot.sent_acks)
+        self.assertEqual(qbot.sent_acks.acked_count, 1)
+        self.assertEqual(qbot.STAGE_SECONDS.count('ack'), acks_timed + 1)
+        self.assertGreaterEqual(qbot.EVENTS.value('message'), 4)
+
+    def test_resend_unacked(self):
+        qbot.event_id_global = 1
+        qbot.sent_acks = acks.AckTracker(resend_after=0, max_tries=3)
+        qbot.SEND_INTERVAL, send_interval = 0, qbot.SEND_INTERVAL
+        qbot.ACK_CHECK_INTERVAL, check_interval = 0.001, qbot.ACK_CHECK_INTERVAL
+        websocket = mocks.MockWebSocket()
+        qbot.OUTBOX = None
+        qbot.get_outbox(websocket).send('C1', '', "QUEUE = [ <@A> ]")
+        resend = qbot.EVENT_LOOP.create_task(qbot.resend_unacked(websocket))
+
+        try:
+            qbot.EVENT_LOOP.run_until_complete(asyncio.sleep(0.05))
+        finally:
+            resend.cancel()
+            qbot.OUTBOX.cancel()
+            qbot.SEND_INTERVAL, qbot.ACK_CHECK_INTERVAL = send_interval, check_interval
+
+        # Each resend went out through the outbox with a new id, until it ran out of tries
+        sent = [json.loads(msg) for msg in websocket.sent]
+        self.assertEqual([(msg['id'], msg['text']) for msg in sent],
+                         [(1, "QUEUE = [ <@A> ]"), (2, "QUEUE = [ <@A> ]"), (3, "QUEUE = [ <@A> ]")])
+        self.assertEqual(qbot.sent_acks.dropped_count, 1)
+        self.assertEqual(len(qbot.sent_acks), 0)
+
+    def test_resend_after_queue_changed(self):
+        qbot.event_id_global = 1
+        qbot.sent_acks = acks.AckTracker(resend_after=0.03, max_tries=2)
+        qbot.SEND_INTERVAL, send_interval = 0.1, qbot.SEND_INTERVAL
+        qbot.ACK_CHECK_INTERVAL, check_interval = 0.005, qbot.ACK_CHECK_INTERVAL
+        websocket = mocks.MockWebSocket()
+        qbot.OUTBOX = None
+        outbox = qbot.get_outbox(websocket)
+        q1, q2 = myqueue.Queue(), myqueue.Queue()
+        q1.push('<@A>')
+        q2.push('<@X>')
+        resend = qbot.EVENT_LOOP.create_task(qbot.resend_unacked(websocket))
+
+        try:
+            # Neither first message is acked
+            outbox.send('C1', '', q1)
+            outbox.send('C2', '', q2)
+            qbot.EVENT_LOOP.run_until_complete(asyncio.sleep(0.01))
+            # C2's queue changes before its resend is due
+            q2.push('<@Y>')
+            outbox.send('C2', "notice\n", q2)
+            qbot.EVENT_LOOP.run_until_complete(asyncio.sleep(0.04))
+            # C1's resend is waiting out the send interval when its queue changes
+            self.assertIn('C1', outbox)
+            q1.push('<@B>')
+            outbox.send('C1', '', q1)
+            qbot.EVENT_LOOP.run_until_complete(asyncio.sleep(0.08))
+        finally:
+            resend.cancel()
+            qbot.OUTBOX.cancel()
+            qbot.SEND_INTERVAL, qbot.ACK_CHECK_INTERVAL = send_interval, check_interval
+
+        # The old queues were never sent again, ahead of or instead of the new ones
+        sent = [json.loads(msg) for msg in websocket.sent]
+        self.assertEqual([msg['text'] for msg in sent if msg['channel'] == 'C1'],
+                         ["QUEUE = [ <@A> ]", "QUEUE = [ <@A> <@B> ]"])
+        self.assertEqual([msg['text'] for msg in sent if msg['channel'] == 'C2'],
+                         ["QUEUE = [ <@X> ]", "notice\nQUEUE = [ <@X> <@Y> ]"])
+        self.assertEqual(qbot.sent_acks.superseded_count, 1)
+
+    def test_worker_replies(self):
+        qbot.event_id_global = 1
+        qbot.sent_acks = acks.AckTracker()
+        qbot.SEND_INTERVAL, send_interval = 0, qbot.SEND_INTERVAL
+        websocket = mocks.MockWebSocket()
+        # Nothing is waiting to be sent, so the outbox is empty when replies come back
+        qbot.OUTBOX = None
+        qbot.get_outbox(websocket)
+        qbot.WORKERS = workers.WorkerPool(1, qbot.deliver_replies, loop=qbot.EVENT_LOOP).start()
+
+        try:
+            event = {'type': 'message', 'channel': 'C1', 'user': 'A', 'text': 'nq'}
+            qbot.parse_event(websocket, json.dumps(event))
+            qbot.EVENT_LOOP.run_until_complete(asyncio.sleep(0))
+            qbot.WORKERS.stop()
+            qbot.EVENT_LOOP.run_until_complete(asyncio.sleep(0.01))
+        finally:
+            qbot.WORKERS = None
+            qbot.SEND_INTERVAL = send_interval
+            qbot.OUTBOX.cancel()
+
+        sent = [json.loads(msg) for msg in websocket.sent]
+        self.assertEqual([(msg['channel'], msg['text']) for msg in sent],
+                         [('C1', "QUEUE = [ <@A> ]")])
+
+    def test_parse_event_batched(self):
+        qbot.QUEUES = myqueue.QueueRegistry()
+        qbot.event_id_global = 1
+        qbot.sent_acks = acks.AckTracker()
+        qbot.BATCHER = batching.CommandBatcher(qbot.handle_batch, qbot.EVENT_LOOP)
+        websocket = mocks.MockWebSocket()
+
+        try:
+            for channel, user, text in [('C1', 'A', 'nq'), ('C2', 'B', 'nq'), ('C1', 'A', 'nq'),
+                                        ('C1', 'B', 'nq'), ('C1', 'C', 'omw <@B>')]:
+                event = {'type': 'message', 'channel': channel, 'user': user, 'text': text}
+                qbot.parse_event(websocket, json.dumps(event))
+            qbot.EVENT_LOOP.run_until_complete(asyncio.sleep(0.01))
+            qbot.OUTBOX.cancel()
+        finally:
+            batcher, qbot.BATCHER = qbot.BATCHER, None
+
+        # One batch, with C1's notices in order and its queue rendered once
+        self.assertEqual((batcher.batches, batcher.commands), (1, 5))
+        sent = [json.loads(msg) for msg in websocket.sent]
+        self.assertEqual([(msg['channel'], msg['text']) for msg in sent],
+                         [('C1', "You're already in the queue <@A>.\n"
+                                 "First in, first out! You can't dequeue that person yet <@C>.\n"
+                                 "QUEUE = [ <@A> <@B> ]"),
+                          ('C2', "QUEUE = [ <@B> ]")])
+
+    def test_get_responses(self):
+        qbot.QUEUES = myqueue.QueueRegistry()
+
+        responses = qbot.get_responses([('C1', '<@A>', 'nq'), ('C1', '<@B>', 'just chatting'),
+                                        ('C2', '<@B>', 'nq'), ('C1', '<@A>', 'omw <@A>')])
+        self.assertEqual([(channel, msg, hb_queue.users()) for channel, msg, hb_queue in responses],
+                         [('C1', '', []), ('C2', '', ['<@B>'])])
+        self.assertEqual(qbot.get_responses([('C1', '<@A>', 'just chatting')]), [])
+
+    def test_events_api(self):
+        os.environ['SLACK_BOT_TOKEN'] = 'good-token'
+        qbot.QUEUES = myqueue.QueueRegistry()
+        qbot.OUTBOX = None
+        qbot.SEEN_MESSAGES = dedupe.EventDeduper()
+
+        events = [{'type': 'message', 'channel': 'C1', 'user': 'A', 'text': 'nq', 'ts': '1.1'},
+                  {'type': 'message', 'channel': 'C1', 'user': 'B', 'text': 'nq', 'ts': '1.2'},
+                  # The bot's own reply, and a retry of the first message
+                  {'type': 'message', 'channel': 'C1', 'bot_id': 'B1', 'text': 'QUEUE = [ ]'},
+                  {'type': 'message', 'channel': 'C1', 'user': 'A', 'text': 'nq', 'ts': '1.1'},
+                  {'type': 'presence_change', 'user': 'A', 'presence': 'away'}]
+        dropped = qbot.DROPPED_FRAMES.value('type')
+        try:
+            for event in events:
+                qbot.handle_api_event(event)
+            qbot.EVENT_LOOP.run_until_complete(asyncio.sleep(0.05))
+            qbot.OUTBOX.cancel()
+        finally:
+            os.environ.pop('SLACK_BOT_TOKEN', None)
+
+        self.assertIsNone(qbot.OUTBOX.websocket)
+        self.assertEqual(qbot.HTTP_SESSION.posted, [('C1', "QUEUE = [ <@A> <@B> ]")])
+        self.assertEqual(qbot.QUEUES.state(), {'C1': ['<@A>', '<@B>']})
+        self.assertEqual(qbot.DROPPED_FRAMES.value('type'), dropped + 1)
+
+    def test_sync_journal(self):
+        import tempfile
+        import threading
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        qbot.QUEUES = myqueue.QueueRegistry()
+        qbot.JOURNAL = journal.QueueJournal(tmp_dir.name, snapshot_every=2)
+        qbot.QUEUES.journal = qbot.JOURNAL
+        qbot.JOURNAL_SYNC_INTERVAL, sync_interval = 0, qbot.JOURNAL_SYNC_INTERVAL
+        write_snapshot, writers, written = qbot.JOURNAL.write_snapshot, [], threading.Event()
+
+        def slow_write_snapshot(seq, state):
+            writers.append(threading.get_ident())
+            written.wait(5)
+            write_snapshot(seq, state)
+
+        async def meanwhile():
+            while not writers:
+                await asyncio.sleep(0.001)
+            # The loop carries on (and journals changes) while the snapshot's written
+            qbot.QUEUES.get('C1').push('<@C>')
+            written.set()
+            while qbot.JOURNAL._snapshot_at is not None:
+                await asyncio.sleep(0.001)
+
+        task = None
+        try:
+            qbot.JOURNAL.write_snapshot = slow_write_snapshot
+            qbot.QUEUES.get('C1').push('<@A>')
+            qbot.QUEUES.get('C1').push('<@B>')
+            task = qbot.EVENT_LOOP.create_task(qbot.sync_journal())
+            qbot.EVENT_LOOP.run_until_complete(asyncio.wait_for(meanwhile(), 5))
+            self.assertNotEqual(writers[0], threading.get_ident())
+
+            qbot.JOURNAL.sync()
+
+            restored = myqueue.QueueRegistry()
+            reloaded = journal.QueueJournal(tmp_dir.name)
+            self.assertEqual(reloaded.load(restored), 1)
+            reloaded.close()
+            self.assertEqual(restored.state(), {'C1': ['<@A>', '<@B>', '<@C>']})
+        finally:
+            if task:
+                task.cancel()
+                qbot.EVENT_LOOP.run_until_complete(asyncio.gather(task, return_exceptions=True))
+            qbot.JOURNAL.close()
+            qbot.JOURNAL = None
+            qbot.JOURNAL_SYNC_INTERVAL = sync_interval
+            tmp_dir.cleanup()
+
+    def test_hand_off(self):
+        import tempfile
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        qbot.QUEUES = myqueue.QueueRegistry()
+        qbot.JOURNAL, qbot.STATE_DIR, state_dir = None, tmp_dir.name, qbot.STATE_DIR
+        qbot.SEEN_MESSAGES = dedupe.EventDeduper()
+        qbot.event_id_global = 1
+        qbot.sent_acks = acks.AckTracker()
+        qbot.OUTBOX = None
+        qbot.SEND_INTERVAL, send_interval = 10, qbot.SEND_INTERVAL
+        qbot.METRICS_PORT, metrics_port = 0, qbot.METRICS_PORT
+        old_socket, new_socket = mocks.MockWebSocket(), mocks.MockWebSocket()
+        old_lock = handoff.InstanceLock(os.path.join(tmp_dir.name, qbot.LOCK_FILE))
+        new_lock = handoff.InstanceLock(old_lock.path)
+        old_lock.acquire()
+        server = None
+
+        try:
+            qbot.open_journal()
+            events = [{'type': 'message', 'channel': 'C1', 'user': user, 'text': 'nq',
+                       'ts': f'1.{i}'} for i, user in enumerate('ABC')]
+            # The second message waits out the send interval, so it's handed over unsent
+            for event in events[:2]:
+                qbot.parse_event(old_socket, json.dumps(event))
+                qbot.EVENT_LOOP.run_until_complete(asyncio.sleep(0.01))
+
+            # The old instance stops at the new one's first message (the second),
+            # and lets go once the new one has everything
+            exported = qbot.EVENT_LOOP.run_until_complete(qbot.hand_off(['C1', '1.1']))
+            self.assertFalse(qbot.ACTIVE.is_set())
+            qbot.finish_hand_off(True)
+            self.assertIsNone(qbot.JOURNAL)
+
+            async def export(until):
+                self.assertEqual(until, ['C1', '1.1'])
+                return exported
+
+            # It only lets go of the lock once the new instance has everything
+            server = qbot.EVENT_LOOP.run_until_complete(
+                handoff.HandoffServer(export, lambda handed: old_lock.release()).start(
+                    os.path.join(tmp_dir.name, qbot.HANDOFF_SOCKET)))
+            first_message = qbot.EVENT_LOOP.create_future()
+            first_message.set_result(['C1', '1.1'])
+            qbot.INSTANCE_LOCK = new_lock
+            qbot.QUEUES = myqueue.QueueRegistry()
+            qbot.SEEN_MESSAGES = dedupe.EventDeduper()
+            qbot.EVENT_LOOP.run_until_complete(qbot.take_over(new_socket, first_message))
+
+            # The new instance has the old one's queues, replies and seen messages
+            self.assertFalse(old_lock.held)
+            self.assertTrue(new_lock.held)
+            self.assertTrue(qbot.ACTIVE.is_set())
+            self.assertEqual(qbot.QUEUES.state(), {'C1': ['<@A>', '<@B>']})
+            for event in events:
+                qbot.parse_event(new_socket, json.dumps(event))
+            qbot.EVENT_LOOP.run_until_complete(asyncio.sleep(0.01))
+            self.assertEqual(qbot.QUEUES.state(), {'C1': ['<@A>', '<@B>', '<@C>']})
+            self.assertEqual([json.loads(msg)['text'] for msg in old_socket.sent],
+                             ["QUEUE = [ <@A> ]"])
+            self.assertEqual([json.loads(msg)['text'] for msg in new_socket.sent],
+                             ["QUEUE = [ <@A> <@B> ]"])
+            self.assertEqual(qbot.SEEN_MESSAGES.duplicates, 2)
+
+            # Its changes are journaled after the old instance's
+            qbot.JOURNAL.sync()
+            restored = myqueue.QueueRegistry()
+            reloaded = journal.QueueJournal(tmp_dir.name)
+            reloaded.load(restored)
+            reloaded.close()
+            self.assertEqual(restored.state(), qbot.QUEUES.state())
+        finally:
+            qbot.OUTBOX.cancel()
+            for handoff_server in (server, qbot.HANDOFF_SERVER):
+                if handoff_server:
+                    handoff_server.close()
+            qbot.INSTANCE_LOCK = qbot.HANDOFF_SERVER = None
+            qbot.METRICS_PORT = metrics_port
+            new_lock.release()
+            if qbot.JOURNAL:
+                qbot.JOURNAL.close()
+            qbot.JOURNAL, qbot.STATE_DIR = None, state_dir
+            qbot.SEND_INTERVAL = send_interval
+            qbot.ACTIVE.set()
+            tmp_dir.cleanup()
+
+    def test_hand_off_failed(self):
+        import tempfile
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        qbot.QUEUES = myqueue.QueueRegistry()
+        qbot.SEEN_MESSAGES = dedupe.EventDeduper()
+        qbot.OUTBOX = scheduler.MessageScheduler(mocks.MockWebSocket(), qbot.send_to_channel, 10)
+        qbot.OUTBOX.send('C1', "sent\n")
+        qbot.EVENT_LOOP.run_until_complete(asyncio.sleep(0.01))
+        qbot.OUTBOX.send('C1', "waiting\n")
+        websocket = mocks.MockWebSocket()
+        qbot.STATE_DIR, state_dir = tmp_dir.name, qbot.STATE_DIR
+        holder = handoff.InstanceLock(os.path.join(tmp_dir.name, qbot.LOCK_FILE))
+        holder.acquire()
+        qbot.INSTANCE_LOCK = handoff.InstanceLock(holder.path)
+        first_message = qbot.EVENT_LOOP.create_future()
+        first_message.set_result(['C1', '1.1'])
+
+        try:
+            # The running instance isn't listening: the connection's closed to try again later
+            qbot.EVENT_LOOP.run_until_complete(qbot.take_over(websocket, first_message))
+            self.assertTrue(websocket.closed)
+            self.assertFalse(qbot.INSTANCE_LOCK.held)
+
+            # A handoff the new instance never confirms leaves this one carrying on
+            qbot.EVENT_LOOP.run_until_complete(qbot.hand_off())
+            self.assertFalse(qbot.ACTIVE.is_set())
+            self.assertEqual(qbot.OUTBOX.held(), [('C1', ["waiting\n"], None)])
+            qbot.finish_hand_off(False)
+            self.assertTrue(qbot.ACTIVE.is_set())
+            self.assertEqual(len(qbot.OUTBOX._tasks), 1)
+        finally:
+            qbot.OUTBOX.cancel()
+            qbot.INSTANCE_LOCK = None
+            qbot.STATE_DIR = state_dir
+            qbot.ACTIVE.set()
+            holder.release()
+            tmp_dir.cleanup()
+
+    def test_take_over_stale(self):
+        import socket
+        import tempfile
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        qbot.QUEUES = myqueue.QueueRegistry()
+        qbot.JOURNAL, qbot.STATE_DIR, state_dir = None, tmp_dir.name, qbot.STATE_DIR
+        qbot.METRICS_PORT, metrics_port = 0, qbot.METRICS_PORT
+        qbot.HANDOFF_QUIET, quiet = 0.05, qbot.HANDOFF_QUIET
+        socket_path = os.path.join(tmp_dir.name, qbot.HANDOFF_SOCKET)
+
+        # An instance that crashed left its queues, lock file and socket behind
+        saved = myqueue.QueueRegistry()
+        crashed = journal.QueueJournal(tmp_dir.name)
+        saved.journal = crashed
+        saved.get('C1').push('<@A>')
+        crashed.sync()
+        crashed.close()
+        with open(os.path.join(tmp_dir.name, qbot.LOCK_FILE), 'w') as lock_file:
+            lock_file.write('99999')
+        stale = socket.socket(socket.AF_UNIX)
+        stale.bind(socket_path)
+        stale.close()
+
+        def take_over(websocket):
+            qbot.QUEUES = myqueue.QueueRegistry()
+            qbot.ACTIVE.clear()
+            qbot.INSTANCE_LOCK = handoff.InstanceLock(os.path.join(tmp_dir.name, qbot.LOCK_FILE))
+            qbot.EVENT_LOOP.run_until_complete(
+                qbot.take_over(websocket, qbot.EVENT_LOOP.create_future()))
+
+        try:
+            # Nothing holds the lock, so it's taken straight away
+            websocket = mocks.MockWebSocket()
+            take_over(websocket)
+            self.assertFalse(websocket.closed)
+            self.assertTrue(qbot.INSTANCE_LOCK.held)
+            self.assertTrue(qbot.ACTIVE.is_set())
+            self.assertEqual(qbot.QUEUES.state(), {'C1': ['<@A>']})
+            self.assertEqual(qbot.INSTANCE_LOCK.holder(), os.getpid())
+
+            # The handoff socket was replaced with a live one
+            qbot.EVENT_LOOP.run_until_complete(asyncio.open_unix_connection(socket_path))[1].close()
+
+            # It exits while this instance waits to ask for a handoff
+            qbot.HANDOFF_SERVER.close()
+            qbot.JOURNAL.close()
+            qbot.JOURNAL = None
+            holder, websocket = qbot.INSTANCE_LOCK, mocks.MockWebSocket()
+            qbot.EVENT_LOOP.call_later(0.01, holder.release)
+            take_over(websocket)
+            self.assertFalse(websocket.closed)
+            self.assertTrue(qbot.INSTANCE_LOCK.held)
+            self.assertEqual(qbot.QUEUES.state(), {'C1': ['<@A>']})
+        finally:
+            if qbot.HANDOFF_SERVER:
+                qbot.HANDOFF_SERVER.close()
+            qbot.INSTANCE_LOCK.release()
+            qbot.INSTANCE_LOCK = qbot.HANDOFF_SERVER = None
+            if qbot.JOURNAL:
+                qbot.JOURNAL.close()
+            qbot.JOURNAL, qbot.STATE_DIR = None, state_dir
+            qbot.METRICS_PORT, qbot.HANDOFF_QUIET = metrics_port, quiet
+            qbot.ACTIVE.set()
+            tmp_dir.cleanup()
+
+    def test_metrics_port_taken(self):
+        import socket
+        import tempfile
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        qbot.QUEUES = myqueue.QueueRegistry()
+        qbot.JOURNAL, qbot.STATE_DIR, state_dir = None, tmp_dir.name, qbot.STATE_DIR
+        qbot.INSTANCE_LOCK = handoff.InstanceLock(os.path.join(tmp_dir.name, qbot.LOCK_FILE))
+        qbot.ACTIVE.clear()
+        taken = socket.socket()
+        taken.bind(('127.0.0.1', 0))
+        taken.listen()
+        qbot.METRICS_PORT, metrics_port = taken.getsockname()[1], qbot.METRICS_PORT
+        websocket = mocks.MockWebSocket()
+
+        try:
+            # Something else has the metrics port, but the bot still takes over
+            with self.assertLogs(qbot.LOGGER, 'WARNING') as logged:
+                qbot.EVENT_LOOP.run_until_complete(
+                    qbot.take_over(websocket, qbot.EVENT_LOOP.create_future()))
+            self.assertIn("Couldn't serve metrics", logged.output[0])
+            self.assertFalse(websocket.closed)
+            self.assertTrue(qbot.INSTANCE_LOCK.held)
+            self.assertTrue(qbot.ACTIVE.is_set())
+            self.assertIsNotNone(qbot.HANDOFF_SERVER)
+        finally:
+            taken.close()
+            if qbot.HANDOFF_SERVER:
+                qbot.HANDOFF_SERVER.close()
+            qbot.INSTANCE_LOCK.release()
+            qbot.INSTANCE_LOCK = qbot.HANDOFF_SERVER = None
+            if qbot.JOURNAL:
+                qbot.JOURNAL.close()
+            qbot.JOURNAL, qbot.STATE_DIR = None, state_dir
+            qbot.METRICS_PORT = metrics_port
+            qbot.ACTIVE.set()
+            tmp_dir.cleanup()
+
+    def test_parse_event_duplicates(self):
+        qbot.QUEUES = myqueue.QueueRegistry()
+        qbot.SEEN_MESSAGES = dedupe.EventDeduper()
+        qbot.event_id_global = 1
+        qbot.sent_acks = acks.AckTracker()
+        websocket = mocks.MockWebSocket()
+        duplicates = qbot.DUPLICATE_EVENTS.value()
+
+        # Slack sends the same messages again after a reconnect
+        events = [{'type': 'message', 'channel': 'C1', 'user': 'A', 'text': 'nq', 'ts': '1.1'},
+                  {'type': 'message', 'channel': 'C1', 'user': 'A', 'text': 'omw <@A>', 'ts': '1.2'}]
+        for event in events + events:
+            qbot.parse_event(websocket, json.dumps(event))
+        # The same ts in another channel is a different message
+        qbot.parse_event(websocket, json.dumps(dict(events[0], channel='C2')))
+        qbot.EVENT_LOOP.run_until_complete(asyncio.sleep(0.01))
+        qbot.OUTBOX.cancel()
+
+        self.assertEqual(qbot.QUEUES.state(), {'C2': ['<@A>']})
+        self.assertEqual(qbot.DUPLICATE_EVENTS.value(), duplicates + 2)
+        self.assertEqual(qbot.SEEN_MESSAGES.duplicates, 2)
 
     def test_response_to_message(self):
-        pass
+        qbot.QUEUES = myqueue.QueueRegistry()
+
+        self.assertIsNone(qbot.respond_to_message('<@A>', "just chatting"))
+
+        self.assertEqual(qbot.respond_to_message('<@A>', "nq"), "QUEUE = [ <@A> ]")
+        already = qbot.respond_to_message('<@A>', "nq")
+        self.assertTrue(already.startswith("You're already in the queue <@A>."))
+
+        qbot.respond_to_message('<@B>', "nq")
+        too_soon = qbot.respond_to_message('<@C>', "omw <@B>")
+        self.assertTrue(too_soon.startswith("First in, first out!"))
+        self.assertEqual(qbot.respond_to_message('<@C>', "omw <@A>"), "QUEUE = [ <@B> ]")
+
+        self.assertEqual(qbot.respond_to_message('<@C>', "q = [ <@C> <@B> ]"),
+                         "<@C> changed the queue: added <@C>.\nQUEUE = [ <@C> <@B> ]")
+        self.assertEqual(qbot.respond_to_message('<@C>', "q = [ <@C> <@B> ]"),
+                         "QUEUE = [ <@C> <@B> ]")
+
+        # Other channels get their own queue
+        self.assertEqual(qbot.respond_to_message('<@A>', "nq", 'C2'), "QUEUE = [ <@A> ]")
+        self.assertEqual(str(qbot.QUEUES.get(qbot.CHANNEL_ID)), "QUEUE = [ <@C> <@B> ]")
+
+    def test_status_wait_times(self):
+        now = [0]
+        qbot.QUEUES = myqueue.QueueRegistry(clock=lambda: now[0])
+
+        status = qbot.respond_to_message('<@A>', "qbot status")
+        self.assertTrue(status.startswith("Qbot is up and running!\nType 'qbot help'"))
+
+        for i, wait in enumerate([30, 60, 90, 240, 1900]):
+            qbot.respond_to_message(f'<@U{i}>', "nq")
+            now[0] += wait
+            qbot.respond_to_message('<@TA>', f"omw <@U{i}>")
+
+        status = qbot.respond_to_message('<@A>', "qbot status")
+        self.assertIn("Recent wait times: 1m 30s median, 31m 40s for the slowest 5%.\n", status)
+        self.assertEqual(qbot.format_wait(3700), "1h 01m")
+        self.assertEqual(qbot.QUEUES.wait_times(0.5), {qbot.CHANNEL_ID: 90})
+        self.assertIn(f'qbot_wait_median_seconds{{channel="{qbot.CHANNEL_ID}"}} 90',
+                      metrics.REGISTRY.render())
 
     def test_sent_message(self):
-        pass
+        qbot.sent_acks = acks.AckTracker()
+        websocket = mocks.MockWebSocket()
+
+        qbot.EVENT_LOOP.run_until_complete(qbot.send_message(websocket, "hi", 7, 'C1'))
+        self.assertEqual(json.loads(websocket.sent[0]),
+                         {'id': 7, 'type': 'message', 'channel': 'C1', 'text': "hi"})
+        self.assertIn(7, qbot.sent_acks)
+
+
+class TestMessageScheduler(unittest.TestCase):
+    """Tests for the MessageScheduler class"""
+
+    def setUp(self):
+        self.sent = []
+
+        async def send(websocket, channel, msg):
+            self.sent.append((channel, msg))
+
+        self.outbox = scheduler.MessageScheduler(None, send, send_interval=0.05)
+
+    def run_for(self, seconds):
+        """Run the event loop for a bit"""
+        qbot.EVENT_LOOP.run_until_complete(asyncio.sleep(seconds))
+
+    def test_send(self):
+        self.outbox.send('C1', "hello\n")
+        self.run_for(0.01)
+        self.assertEqual(self.sent, [('C1', "hello\n")])
+        self.assertEqual(len(self.outbox), 0)
+        self.assertNotIn('C1', self.outbox)
+
+    def test_coalesce(self):
+        q = myqueue.Queue()
+        q.push('<@A>')
+
+        # First message goes right away, then the rest wait out the interval
+        self.outbox.send('C1', '', q)
+        self.outbox.send('C2', "other channel")
+        self.outbox.send('C2', "notices")
+        self.run_for(0.01)
+        self.outbox.send('C1', "First in, first out!\n", q)
+        q.push('<@B>')
+        self.outbox.send('C1', '', q)
+        self.outbox.send('C1', "You're already in the queue\n", q)
+        q.push('<@C>')
+        self.run_for(0.01)
+        self.assertEqual(len(self.sent), 2)
+
+        self.run_for(0.1)
+        self.assertEqual(self.sent, [('C1', "QUEUE = [ <@A> ]"),
+                                     ('C2', "other channel\nnotices"),
+                                     ('C1', "First in, first out!\nYou're already in the queue\n"
+                                            "QUEUE = [ <@A> <@B> <@C> ]")])
+        self.assertEqual(self.outbox._tasks, {})
+
+    def test_hold(self):
+        q = myqueue.Queue()
+        q.push('<@A>')
+
+        self.outbox.send('C1', "one\n")
+        self.run_for(0.01)
+        self.outbox.send('C1', "two\n")
+        qbot.EVENT_LOOP.run_until_complete(self.outbox.hold())
+        self.outbox.send('C2', '', q)
+        self.run_for(0.1)
+
+        self.assertEqual(self.sent, [('C1', "one\n")])
+        self.assertEqual(self.outbox.held(), [('C1', ["two\n"], None),
+                                              ('C2', [], "QUEUE = [ <@A> ]")])
+
+        self.outbox.resume()
+        self.run_for(0.01)
+        self.assertEqual(self.sent, [('C1', "one\n"), ('C1', "two\n"), ('C2', "QUEUE = [ <@A> ]")])
+
+    def test_cancel(self):
+        self.outbox.send('C1', "one\n")
+        self.run_for(0.01)
+        self.outbox.send('C1', "two\n")
+        self.outbox.cancel()
+        self.run_for(0.1)
+        self.assertEqual(self.sent, [('C1', "one\n")])
+
+
+class TestCommandBatcher(unittest.TestCase):
+    """Tests for the CommandBatcher class"""
+
+    def setUp(self):
+        self.batches = []
+
+    def run_loop(self, seconds=0.0):
+        qbot.EVENT_LOOP.run_until_complete(asyncio.sleep(seconds))
+
+    def test_tick(self):
+        batcher = batching.CommandBatcher(self.batches.append, qbot.EVENT_LOOP)
+        batcher.add('C1', '<@A>', 'nq')
+        batcher.add('C2', '<@B>', 'nq')
+        self.assertEqual(len(batcher), 2)
+        self.run_loop()
+        batcher.add('C1', '<@C>', 'nq')
+        self.run_loop()
+
+        self.assertEqual(self.batches, [[('C1', '<@A>', 'nq'), ('C2', '<@B>', 'nq')],
+                                        [('C1', '<@C>', 'nq')]])
+        self.assertEqual((batcher.batches, batcher.commands, batcher.largest), (2, 3, 2))
+
+    def test_window(self):
+        batcher = batching.CommandBatcher(self.batches.append, qbot.EVENT_LOOP, window=0.05)
+        batcher.add('C1', '<@A>', 'nq')
+        self.run_loop(0.01)
+        batcher.add('C1', '<@B>', 'nq')
+        self.assertEqual(self.batches, [])
+        self.run_loop(0.08)
+        self.assertEqual(self.batches, [[('C1', '<@A>', 'nq'), ('C1', '<@B>', 'nq')]])
+
+    def test_flush(self):
+        batcher = batching.CommandBatcher(self.batches.append, qbot.EVENT_LOOP, window=10)
+        batcher.add('C1', '<@A>', 'nq')
+        batcher.flush()
+        batcher.flush()
+        self.assertEqual(self.batches, [[('C1', '<@A>', 'nq')]])
+        self.assertEqual(len(batcher), 0)
+
+
+class TestAckTracker(unittest.TestCase):
+    """Tests for the AckTracker class"""
+
+    def setUp(self):
+        self.now = 0
+        self.tracker = acks.AckTracker(max_size=3, resend_after=5, max_tries=2, expire_after=30,
+                                       clock=lambda: self.now)
+
+    def test_acked(self):
+        self.tracker.sent(1, 'one')
+        self.now = 2
+        self.assertEqual(self.tracker.acked(1), 2)
+        self.assertIsNone(self.tracker.acked(1))
+        self.assertIsNone(self.tracker.acked(99))
+
+        self.tracker.sent(2, 'two')
+        self.now = 6
+        self.tracker.acked(2, ok=False)
+        self.assertEqual(self.tracker.acked_count, 2)
+        self.assertEqual(self.tracker.error_count, 1)
+        self.assertEqual(self.tracker.mean_latency(), 3)
+        self.assertEqual(self.tracker.max_latency, 4)
+
+    def test_max_size(self):
+        for event_id in range(1, 6):
+            self.tracker.sent(event_id, 'msg')
+        self.assertEqual(len(self.tracker), 3)
+        self.assertNotIn(2, self.tracker)
+        self.assertIn(3, self.tracker)
+        self.assertEqual(self.tracker.dropped_count, 2)
+
+    def test_due(self):
+        self.tracker.sent(1, 'one', 'C1')
+        self.now = 3
+        self.tracker.sent(2, 'two', 'C2')
+        self.assertEqual(self.tracker.due(), [])
+
+        # Message 1 is resent as a new message, which takes over its tries
+        self.now = 5
+        self.assertEqual(self.tracker.due(), [(1, 'C1', 'one')])
+        self.assertNotIn(1, self.tracker)
+        self.tracker.sent(3, 'one', 'C1')
+        self.assertEqual(self.tracker.due(), [])
+
+        # Message 3 is out of tries, message 2 gets its resend
+        self.now = 10
+        self.assertEqual(self.tracker.due(), [(2, 'C2', 'two')])
+        self.assertNotIn(3, self.tracker)
+        self.assertEqual(self.tracker.resent_count, 2)
+        self.assertEqual(self.tracker.dropped_count, 1)
+
+        # Acks still count latency from the first send
+        self.tracker.sent(4, 'two', 'C2')
+        self.now = 11
+        self.assertEqual(self.tracker.acked(4), 8)
+
+    def test_superseded(self):
+        self.tracker.sent(1, "QUEUE = [ <@A> ]", 'C1')
+        self.tracker.sent(2, "QUEUE = [ <@B> ]", 'C2')
+        self.tracker.sent(3, "QUEUE = [ <@A> <@C> ]", 'C1')
+
+        # Message 3 has C1's newer queue, so message 1 isn't resent
+        self.now = 5
+        self.assertEqual(self.tracker.due(), [(2, 'C2', "QUEUE = [ <@B> ]"),
+                                              (3, 'C1', "QUEUE = [ <@A> <@C> ]")])
+        self.assertEqual(len(self.tracker), 0)
+        self.assertEqual(self.tracker.superseded_count, 1)
+        self.assertEqual(self.tracker.resent_count, 2)
+
+    def test_superseded_by_waiting(self):
+        self.tracker.sent(1, "QUEUE = [ <@A> ]", 'C1')
+        self.tracker.sent(2, "QUEUE = [ <@B> ]", 'C2')
+
+        # A newer message waiting to go to C1 has its newer queue too
+        self.now = 5
+        self.assertEqual(self.tracker.due(waiting={'C1'}), [(2, 'C2', "QUEUE = [ <@B> ]")])
+        self.assertEqual(self.tracker.superseded_count, 1)
+
+    def test_soak_memory(self):
+        import tracemalloc
+
+        tracker = acks.AckTracker(max_size=500, clock=lambda: self.now)
+
+        def soak(first_id, count):
+            for event_id in range(first_id, first_id + count):
+                self.now += 0.01
+                tracker.sent(event_id, f'{{"id": {event_id}, "text": "QUEUE = [ ]"}}')
+                # Leave every tenth message unacked
+                if event_id % 10:
+                    tracker.acked(event_id)
+                if event_id % 100 == 0:
+                    tracker.due()
+
+        tracemalloc.start()
+        soak(1, 5000)
+        warm, _ = tracemalloc.get_traced_memory()
+        soak(5001, 30000)
+        soaked, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.assertLessEqual(len(tracker), 500)
+        self.assertLess(soaked - warm, 50000)
+
+
+class TestBackoff(unittest.TestCase):
+    """Tests for the Backoff class"""
+
+    def setUp(self):
+        self.now = 0
+        self.backoff = backoff.Backoff(base=1, cap=8, max_attempts=5, window=60, storm_delay=30,
+                                       clock=lambda: self.now, rand=lambda: 1)
+
+    def test_next_delay(self):
+        delays = []
+        for _ in range(5):
+            self.now += 100
+            delays.append(self.backoff.next_delay())
+        self.assertEqual(delays, [1, 2, 4, 8, 8])
+
+        self.backoff.reset()
+        self.assertEqual(self.backoff.next_delay(), 1)
+
+    def test_jitter(self):
+        jittery = backoff.Backoff(base=1, cap=8, rand=lambda: 0.25)
+        self.assertEqual([jittery.next_delay() for _ in range(3)], [0.25, 0.5, 1])
+
+    def test_storm(self):
+        delays = [self.backoff.next_delay() for _ in range(6)]
+        self.assertEqual(delays[:5], [1, 2, 4, 8, 8])
+        self.assertEqual(delays[5], 30)
+
+        # Once the window passes, the storm delay stops
+        self.now = 100
+        self.backoff.reset()
+        self.assertEqual(self.backoff.next_delay(), 1)
+
+
+class TestEventFilter(unittest.TestCase):
+    """Tests for the EventFilter class"""
+
+    def test_drop_types(self):
+        event_filter = eventfilter.EventFilter()
+
+        kept = [{'type': 'hello'},
+                {'type': 'message', 'channel': 'C1', 'user': 'A', 'text': 'nq'},
+                {'ok': True, 'reply_to': 3, 'ts': '1.1', 'text': 'QUEUE = [ ]'},
+                # A nested type doesn't hide the event's own type
+                {'attachments': [{'type': 'image'}], 'type': 'message', 'channel': 'C1'}]
+        dropped = [{'type': 'presence_change', 'user': 'A', 'presence': 'away'},
+                   {'type': 'user_typing', 'channel': 'C1', 'user': 'A'}]
+
+        for event in kept:
+            self.assertIsNone(event_filter.drop_reason(json.dumps(event)), event)
+            self.assertIsNone(event_filter.drop_reason(json.dumps(event, separators=(',', ':'))))
+        for event in dropped:
+            self.assertEqual(event_filter.drop_reason(json.dumps(event)), 'type')
+        self.assertEqual(event_filter.drop_reason(json.dumps(dropped[0]).encode()), 'type')
+        self.assertEqual(event_filter.dropped_types, 3)
+
+    def test_drop_channels(self):
+        event_filter = eventfilter.EventFilter(channels=['C1'])
+
+        self.assertIsNone(event_filter.drop_reason('{"type": "message", "channel": "C1"}'))
+        self.assertIsNone(event_filter.drop_reason('{"type": "hello"}'))
+        self.assertEqual(event_filter.drop_reason('{"type": "message", "channel": "C2"}'),
+                         'channel')
+        self.assertEqual(event_filter.dropped_channels, 1)
+
+
+class TestEventsServer(unittest.TestCase):
+    """Tests for the Events API server"""
+
+    def setUp(self):
+        self.events = []
+        self.server = qbot.EVENT_LOOP.run_until_complete(
+            eventsapi.EventsServer(lambda *args: self.events.append(args), 'shh',
+                                   clock=lambda: 1000).start(port=0))
+
+    def tearDown(self):
+        self.server.close()
+
+    def request(self, body, headers=None, method='POST', version='HTTP/1.1'):
+        return f'{method} /slack/events {version}\r\n'.encode() + b''.join(
+            f'{name}: {value}\r\n'.encode() for name, value in (headers or {}).items()
+        ) + f'Content-Length: {len(body)}\r\n\r\n'.encode() + body
+
+    def signed(self, body, timestamp='1000', **kwargs):
+        headers = {'X-Slack-Request-Timestamp': timestamp,
+                   'X-Slack-Signature': eventsapi.signature('shh', timestamp, body)}
+        return self.request(body, headers, **kwargs)
+
+    def exchange(self, *requests):
+        """Send requests on one connection and return the (status, body) of each response"""
+
+        async def run():
+            reader, writer = await asyncio.open_connection('127.0.0.1', self.server.port)
+            responses = []
+            for request in requests:
+                writer.write(request)
+                status = int((await reader.readline()).split()[1])
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    if line.lower().startswith(b'content-length'):
+                        length = int(line.split(b':')[1])
+                responses.append((status, await reader.readexactly(length)))
+            # The server closes the connection if it isn't kept alive
+            closed = await reader.read() == b'' if len(requests) == 1 else None
+            writer.close()
+            await asyncio.sleep(0)
+            return responses, closed
+
+        return qbot.EVENT_LOOP.run_until_complete(asyncio.wait_for(run(), 5))
+
+    def test_url_verification(self):
+        body = json.dumps({'type': 'url_verification', 'challenge': 'abc'}).encode()
+        responses, _ = self.exchange(self.signed(body, version='HTTP/1.0'))
+        self.assertEqual(responses, [(200, b'{"challenge": "abc"}')])
+
+    def test_events_keep_alive(self):
+        bodies = [json.dumps({'type': 'event_callback', 'event': {'type': 'message', 'text': t}})
+                  .encode() for t in ('one', 'two')]
+        responses, _ = self.exchange(*[self.signed(body) for body in bodies])
+
+        self.assertEqual(responses, [(200, b''), (200, b'')])
+        self.assertEqual([event['text'] for event, received_at in self.events], ['one', 'two'])
+        self.assertEqual((self.server.requests, self.server.events), (2, 2))
+
+    def test_rejected(self):
+        body = json.dumps({'type': 'event_callback', 'event': {'type': 'message'}}).encode()
+        unsigned = self.request(body)
+        forged = self.request(body, {'X-Slack-Request-Timestamp': '1000',
+                                     'X-Slack-Signature': 'v0=00'})
+        stale = self.signed(body, timestamp='600')
+        responses, _ = self.exchange(unsigned, forged, stale)
+
+        self.assertEqual([status for status, _ in responses], [401, 401, 401])
+        self.assertEqual(self.server.rejected, 3)
+        self.assertEqual(self.events, [])
+
+    def test_bad_requests(self):
+        responses, _ = self.exchange(self.signed(b'not json'), self.signed(b'[1]'),
+                                     self.signed(b'', method='GET'))
+        self.assertEqual([status for status, _ in responses], [400, 400, 405])
+
+        # HTTP/1.0 isn't kept alive unless asked
+        responses, closed = self.exchange(self.signed(b'{}', version='HTTP/1.0'))
+        self.assertEqual((responses, closed), ([(200, b'')], True))
+
+
+class TestInstanceLock(unittest.TestCase):
+    """Tests for the InstanceLock class"""
+
+    def setUp(self):
+        import tempfile
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'state', 'qbot.lock')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_exclusive(self):
+        first, second = handoff.InstanceLock(self.path), handoff.InstanceLock(self.path)
+
+        self.assertTrue(first.acquire())
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        self.assertEqual(second.holder(), os.getpid())
+
+        first.release()
+        self.assertFalse(first.held)
+        self.assertTrue(second.acquire())
+        self.assertTrue(second.held)
+        second.release()
+
+    def test_wait(self):
+        first, second = handoff.InstanceLock(self.path), handoff.InstanceLock(self.path)
+        first.acquire()
+
+        self.assertFalse(qbot.EVENT_LOOP.run_until_complete(second.wait(0.01)))
+        qbot.EVENT_LOOP.call_later(0.01, first.release)
+        self.assertTrue(qbot.EVENT_LOOP.run_until_complete(second.wait(1)))
+        second.release()
+
+
+class TestHandoffServer(unittest.TestCase):
+    """Tests for the HandoffServer class and request_handoff"""
+
+    def setUp(self):
+        import tempfile
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'qbot.sock')
+        self.asked = []
+        self.finished = []
+
+        async def export(until):
+            self.asked.append(until)
+            return b'\0state', {'seen': [['C1', '1.1']]}
+
+        self.server = qbot.EVENT_LOOP.run_until_complete(
+            handoff.HandoffServer(export, self.finished.append, timeout=0.5).start(self.path))
+
+    def tearDown(self):
+        self.server.close()
+        self.tmp_dir.cleanup()
+
+    def test_handoff(self):
+        state, extras = qbot.EVENT_LOOP.run_until_complete(
+            handoff.request_handoff(self.path, ['C1', '1.2'], timeout=1))
+        qbot.EVENT_LOOP.run_until_complete(asyncio.sleep(0.01))
+
+        self.assertEqual((state, extras), (b'\0state', {'seen': [['C1', '1.1']]}))
+        self.assertEqual(self.asked, [['C1', '1.2']])
+        self.assertEqual(self.finished, [True])
+        self.assertEqual(self.server.handoffs, 1)
+
+    def test_not_taken(self):
+        async def ask(request, read=True):
+            reader, writer = await asyncio.open_unix_connection(self.path)
+            writer.write(request)
+            if read:
+                await reader.read(1)
+            writer.close()
+            await asyncio.sleep(0.05)
+
+        # Anything else is ignored
+        qbot.EVENT_LOOP.run_until_complete(ask(b'HELLO\n', read=False))
+        self.assertEqual((self.asked, self.finished), ([], []))
+
+        # Hanging up without confirming leaves the old instance carrying on
+        qbot.EVENT_LOOP.run_until_complete(ask(b'HANDOFF null\n'))
+        self.assertEqual((self.asked, self.finished), ([None], [False]))
+        self.assertEqual(self.server.failed, 1)
+
+    def test_nothing_listening(self):
+        with self.assertRaises(OSError):
+            qbot.EVENT_LOOP.run_until_complete(
+                handoff.request_handoff(os.path.join(self.tmp_dir.name, 'nope.sock')))
+
+
+class TestWorkerPool(unittest.TestCase):
+    """Tests for the WorkerPool class"""
+
+    def setUp(self):
+        self.replies = []
+
+    def run_pool(self, messages, state_dir=None):
+        pool = workers.WorkerPool(2, self.replies.extend, state_dir).start()
+        for channel, user, text in messages:
+            pool.submit(channel, user, text)
+        pool.stop()
+        return pool
+
+    def test_shard_for(self):
+        shards = {workers.shard_for(f'C{i}', 4) for i in range(100)}
+        self.assertEqual(shards, {0, 1, 2, 3})
+        self.assertEqual(workers.shard_for('C1', 4), workers.shard_for('C1', 4))
+
+    def test_ordering(self):
+        channels = [f'C{i}' for i in range(8)]
+        messages = [(channel, f'<@U{i}>', 'nq') for i in range(20) for channel in channels]
+        pool = workers.WorkerPool(2, self.replies.extend).start()
+        for i, (channel, user, text) in enumerate(messages, 1):
+            pool.submit(channel, user, text)
+            # Send the commands in batches of 40, so 5 per channel
+            if i % 40 == 0:
+                pool.flush()
+        pool.stop()
+        self.assertEqual((pool.submitted, pool.handled), (160, 160))
+
+        # Each channel's replies come back in the order its commands went out,
+        # with its queue rendered once per batch
+        for channel in channels:
+            states = [rendered for reply_channel, _, rendered in self.replies
+                      if reply_channel == channel]
+            self.assertEqual([state.count('<@') for state in states], [5, 10, 15, 20])
+            self.assertEqual(states[-1],
+                             "QUEUE = [ " + " ".join(f'<@U{i}>' for i in range(20)) + " ]")
+
+    def test_notices(self):
+        self.run_pool([('C1', '<@A>', 'nq'), ('C1', '<@A>', 'nq'), ('C1', '<@B>', 'nq'),
+                       ('C1', '<@B>', 'nq')])
+        self.assertEqual(self.replies,
+                         [('C1', "You're already in the queue <@A>.\n"
+                                 "You're already in the queue <@B>.\n", "QUEUE = [ <@A> <@B> ]")])
+
+    def test_state_dir(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as state_dir:
+            self.run_pool([('C1', '<@A>', 'nq'), ('C2', '<@B>', 'nq')], state_dir)
+            self.replies.clear()
+            self.run_pool([('C1', '<@C>', 'nq'), ('C2', '<@D>', 'nq')], state_dir)
+
+        self.assertIn(('C1', '', "QUEUE = [ <@A> <@C> ]"), self.replies)
+        self.assertIn(('C2', '', "QUEUE = [ <@B> <@D> ]"), self.replies)
+
+    def test_reports(self):
+        pool = self.run_pool([('C1', '<@A>', 'nq'), ('C1', '<@B>', 'nq'), ('C1', '<@C>', 'omw <@A>'),
+                              ('C2', '<@D>', 'nq')])
+        self.assertEqual(pool.depths(), {'C1': 1, 'C2': 1})
+        self.assertEqual(list(pool.wait_times(0.5)), ['C1'])
+        self.assertEqual(list(pool.wait_times(0.95)), ['C1'])
+
+        # The front process's gauges show what the workers reported
+        qbot.WORKERS = pool
+        try:
+            depths = list(qbot.QUEUE_DEPTH.samples())
+            waits = list(qbot.WAIT_MEDIAN.samples())
+        finally:
+            qbot.WORKERS = None
+        self.assertIn('qbot_queue_depth{channel="C1"} 1', depths)
+        self.assertIn('qbot_queue_depth{channel="C2"} 1', depths)
+        self.assertEqual(len(waits), 1)
+
+
+    def test_dead_worker(self):
+        import tempfile
+        import time
+
+        def wait_for(condition):
+            deadline = time.monotonic() + 20
+            while not condition():
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+
+        workers.CHECK_INTERVAL, check_interval = 0.05, workers.CHECK_INTERVAL
+        tmp_dir = tempfile.TemporaryDirectory()
+        pool = workers.WorkerPool(2, self.replies.extend, tmp_dir.name).start()
+        index = workers.shard_for('C1', 2)
+        try:
+            pool.submit('C1', '<@A>', 'nq')
+            pool.flush()
+            wait_for(lambda: self.replies)
+
+            # The worker dies, and the commands sent to it meanwhile fail
+            dead = pool._processes[index]
+            dead.kill()
+            dead.join()
+            pool.submit('C1', '<@B>', 'nq')
+            pool.submit('C1', '<@B>', 'just chatting')
+            pool.flush()
+            wait_for(lambda: pool.restarts)
+            self.assertIsNot(pool._processes[index], dead)
+            self.assertEqual(pool.failed, 1)
+
+            # Its replacement carries on from its journal
+            pool.submit('C1', '<@C>', 'nq')
+            pool.flush()
+            wait_for(lambda: len(self.replies) == 3)
+        finally:
+            pool.stop()
+            workers.CHECK_INTERVAL = check_interval
+            tmp_dir.cleanup()
+
+        self.assertEqual(self.replies, [
+            ('C1', '', "QUEUE = [ <@A> ]"),
+            ('C1', "Sorry <@B>, something went wrong and that didn't go through. "
+                   "Please try again.\n", None),
+            ('C1', '', "QUEUE = [ <@A> <@C> ]")])
+        self.assertEqual(pool.handled, 2)
+
+
+class TestWaitStats(unittest.TestCase):
+    """Tests for the P2Quantile and WaitStats classes"""
+
+    def test_p2_exact_start(self):
+        estimate = waitstats.P2Quantile(0.5)
+        self.assertIsNone(estimate.value())
+        for value in [5, 1, 3]:
+            estimate.add(value)
+        self.assertEqual(estimate.value(), 3)
+
+    def test_p2_accuracy(self):
+        import random
+
+        rand = random.Random(16)
+        values = [rand.expovariate(1 / 300) for _ in range(20000)]
+        ranked = sorted(values)
+        for p in (0.5, 0.95):
+            estimate = waitstats.P2Quantile(p)
+            for value in values:
+                estimate.add(value)
+            exact = ranked[int(p * len(ranked))]
+            self.assertAlmostEqual(estimate.value() / exact, 1, delta=0.05)
+
+        # Memory doesn't grow with the number of values
+        self.assertEqual(len(estimate._heights), 5)
+
+    def test_rolling_window(self):
+        now = [0]
+        stats = waitstats.WaitStats(window=100, clock=lambda: now[0])
+        self.assertIsNone(stats.quantile(0.5))
+
+        for _ in range(10):
+            stats.add(10)
+        self.assertEqual(stats.quantile(0.5), 10)
+
+        # The last window is used until the new one has enough waits
+        now[0] = 150
+        stats.add(50)
+        self.assertEqual((stats.quantile(0.5), stats.count()), (10, 10))
+        for _ in range(10):
+            stats.add(50)
+        self.assertEqual(stats.quantile(0.95), 50)
+
+        # Waits from long ago are dropped
+        now[0] = 1000
+        self.assertIsNone(stats.quantile(0.5))
+        self.assertEqual(stats.count(), 0)
+
+    def test_queue_waits(self):
+        now = [0]
+        stats = waitstats.WaitStats(clock=lambda: now[0])
+        q = myqueue.Queue(indexed=True, stats=stats, clock=lambda: now[0])
+        q.push('a')
+        q.push('b')
+        now[0] = 5
+        q.push('c')
+        q.override(['c', 'b', 'd'])
+        now[0] = 20
+
+        # Leaving without being served isn't a wait
+        q.remove('b')
+        q.pop()
+        q.pop()
+        self.assertEqual((stats.count(), stats.quantile(0.5)), (2, 15))
+        self.assertEqual(q._joined, {})
+
+        q.push('e')
+        q.empty()
+        self.assertEqual(q._joined, {})
+
+
+class TestUserDirectory(unittest.TestCase):
+    """Tests for the UserDirectory class"""
+
+    def setUp(self):
+        self.now = 0
+        self.session = mocks.MockSession()
+        self.users = directory.UserDirectory('good-token', self.session, max_size=3, ttl=60,
+                                             clock=lambda: self.now)
+
+    def run_async(self, coro):
+        return qbot.EVENT_LOOP.run_until_complete(coro)
+
+    def test_prefetch(self):
+        self.users.max_size = 10
+        self.assertEqual(self.run_async(self.users.prefetch()), 5)
+        self.assertEqual(self.session.calls['users.list'], 3)
+
+        self.assertEqual(self.run_async(self.users.name('U1')), 'User 1')
+        self.assertTrue(self.run_async(self.users.get('U4'))['deleted'])
+        self.assertEqual(self.session.calls['users.info'], 0)
+        self.assertEqual(self.users.hits, 2)
+
+    def test_shared_miss(self):
+        async def lookups():
+            return await asyncio.gather(*[self.users.get('U2') for _ in range(10)],
+                                        self.users.get('U3'))
+
+        found = self.run_async(lookups())
+        self.assertEqual([user['id'] for user in found], ['U2'] * 10 + ['U3'])
+        self.assertEqual(self.session.calls['users.info'], 2)
+        self.assertEqual(self.users.misses, 2)
+
+        self.assertIsNone(self.run_async(self.users.get('Umissing')))
+        self.assertEqual(self.run_async(self.users.name('Umissing')), 'Umissing')
+
+    def test_lru_and_ttl(self):
+        for user in mocks.MOCK_USERS[:3]:
+            self.users.update(user)
+        self.assertIsNotNone(self.users.peek('U0'))
+
+        # U1 was used least recently, so it goes first
+        self.users.update(mocks.MOCK_USERS[3])
+        self.assertEqual(len(self.users), 3)
+        self.assertIsNone(self.users.peek('U1'))
+        self.assertIsNotNone(self.users.peek('U0'))
+
+        self.now = 60
+        self.assertIsNone(self.users.peek('U0'))
+        self.run_async(self.users.get('U0'))
+        self.assertEqual(self.session.calls['users.info'], 1)
+
+    def test_user_change(self):
+        qbot.USERS, users = self.users, qbot.USERS
+        try:
+            renamed = dict(mocks.MOCK_USERS[0], profile={'display_name': 'Renamed'})
+            qbot.parse_event(mocks.MockWebSocket(),
+                             json.dumps({'type': 'user_change', 'user': renamed}))
+        finally:
+            qbot.USERS = users
+        self.assertEqual(self.run_async(self.users.name('U0')), 'Renamed')
+        self.assertEqual(self.session.calls['users.info'], 0)
+
+
+class TestEventDeduper(unittest.TestCase):
+    """Tests for the EventDeduper class"""
+
+    def setUp(self):
+        self.now = 0
+        self.deduper = dedupe.EventDeduper(max_size=3, max_age=10, clock=lambda: self.now)
+
+    def test_seen(self):
+        self.assertFalse(self.deduper.seen(('C1', '1.1')))
+        self.assertTrue(self.deduper.seen(('C1', '1.1')))
+        self.assertFalse(self.deduper.seen(('C2', '1.1')))
+        self.assertEqual(self.deduper.duplicates, 1)
+
+    def test_bounded(self):
+        for i in range(100):
+            self.deduper.seen(('C1', i))
+        self.assertEqual(len(self.deduper), 3)
+        # The oldest keys went first
+        self.assertFalse(self.deduper.seen(('C1', 0)))
+        self.assertTrue(self.deduper.seen(('C1', 99)))
+
+    def test_max_age(self):
+        self.deduper.seen(('C1', '1.1'))
+        self.now = 5
+        self.deduper.seen(('C1', '1.2'))
+        self.now = 10
+        self.assertFalse(self.deduper.seen(('C1', '1.1')))
+        self.assertTrue(self.deduper.seen(('C1', '1.2')))
+
+        self.now = 100
+        self.deduper.seen(('C1', '1.3'))
+        self.assertEqual(len(self.deduper), 1)
+
+    def test_remember(self):
+        for ts in ('1.1', '1.2'):
+            self.deduper.seen(('C1', ts))
+        other = dedupe.EventDeduper(max_size=3, max_age=10, clock=lambda: self.now)
+        other.seen(('C2', '1.0'))
+        other.remember(self.deduper.keys() + [('C1', '1.3')])
+
+        # Only the newest max_size are kept
+        self.assertEqual(other.keys(), [('C1', '1.1'), ('C1', '1.2'), ('C1', '1.3')])
+        self.assertIn(('C1', '1.2'), other)
+        self.assertTrue(other.seen(('C1', '1.1')))
+        self.assertEqual(other.duplicates, 1)
+
+
+class TestIngestQueue(unittest.TestCase):
+    """Tests for the IngestQueue class"""
+
+    def run_async(self, coro):
+        return qbot.EVENT_LOOP.run_until_complete(coro)
+
+    def fill(self, buffer, events):
+        for event_type in events:
+            self.assertTrue(self.run_async(buffer.put(event_type, event_type)))
+
+    def test_order(self):
+        buffer = ingest.IngestQueue(10)
+        self.fill(buffer, ['presence_change', 'message', 'hello', 'presence_change', 'message'])
+        got = [buffer.get_nowait() for _ in range(len(buffer))]
+        self.assertEqual(got, ['presence_change', 'message', 'hello', 'presence_change', 'message'])
+
+    def test_shed(self):
+        lost = []
+        buffer = ingest.IngestQueue(3, on_drop=lambda *args: lost.append(args))
+        self.fill(buffer, ['presence_change', 'message', 'user_typing', 'message'])
+        self.assertEqual(lost, [('presence_change', 'shed')])
+        self.fill(buffer, ['hello'])
+        self.assertEqual([buffer.get_nowait() for _ in range(3)], ['message', 'message', 'hello'])
+        self.assertEqual(buffer.shed, {'presence_change': 1, 'user_typing': 1})
+
+    def test_drop(self):
+        buffer = ingest.IngestQueue(2, overflow='drop')
+        self.fill(buffer, ['message', 'message'])
+        self.assertFalse(self.run_async(buffer.put('presence_change', 'presence_change')))
+        self.assertFalse(self.run_async(buffer.put('message', 'message')))
+        self.assertEqual(buffer.dropped, {'presence_change': 1, 'message': 1})
+        self.assertRaises(ValueError, ingest.IngestQueue, 2, overflow='sometimes')
+
+    def test_block(self):
+        buffer = ingest.IngestQueue(1)
+        got = []
+
+        async def consume():
+            await asyncio.sleep(0.01)
+            got.append(await buffer.get())
+
+        async def produce():
+            consumer = asyncio.ensure_future(consume())
+            await buffer.put('first', 'message')
+            # Waits for the consumer to make room
+            await buffer.put('second', 'message')
+            await consumer
+
+        self.run_async(produce())
+        self.assertEqual(got, ['first'])
+        self.assertEqual(buffer.full_waits, 1)
+        self.assertEqual(buffer.get_nowait(), 'second')
+
+    def test_classify(self):
+        buffer = ingest.IngestQueue()
+        self.assertEqual(buffer.classify('{"type": "presence_change"}'), 'presence_change')
+        self.assertEqual(buffer.classify('{"blocks": [{"type": "rich_text"}], "type": "message"}'),
+                         'message')
+        self.assertEqual(buffer.classify(b'{"ok": true, "reply_to": 4}'), 'reply')
+        self.assertIsNone(buffer.classify('{}'))
+
+    def burst(self, overflow):
+        """Send events at 10x the rate they're handled, 90% of them presence"""
+
+        buffer = ingest.IngestQueue(50, overflow=overflow)
+        handled = [0]
+        message_waits = []
+
+        async def consume():
+            while True:
+                event_type, handled_before = await buffer.get()
+                if event_type == 'message':
+                    # How many events were handled while this one waited
+                    message_waits.append(handled[0] - handled_before)
+                handled[0] += 1
+                await asyncio.sleep(0)
+
+        async def produce():
+            consumer = asyncio.ensure_future(consume())
+            for tick in range(200):
+                for i in range(10):
+                    event_type = 'message' if i == 0 else 'presence_change'
+                    await buffer.put((event_type, handled[0]), event_type)
+                await asyncio.sleep(0)
+            while len(buffer):
+                await asyncio.sleep(0)
+            consumer.cancel()
+
+        self.run_async(produce())
+
+        # Every message got through without waiting behind more than a
+        # buffer's worth of events, and the buffer never grew past its limit
+        self.assertEqual(len(message_waits), 200)
+        self.assertLessEqual(max(message_waits), 50)
+        self.assertLessEqual(buffer.max_seen, 50)
+        return buffer, handled[0]
+
+    def test_burst_drop(self):
+        buffer, handled = self.burst('drop')
+        lost = buffer.shed['presence_change'] + buffer.dropped['presence_change']
+        self.assertGreater(lost, 1500)
+        self.assertEqual(handled + lost, 2000)
+        self.assertEqual(buffer.full_waits, 0)
+
+    def test_burst_block(self):
+        # Nothing is lost: reading just slows down to the rate events are handled
+        buffer, handled = self.burst('block')
+        self.assertEqual(handled, 2000)
+        self.assertGreater(buffer.full_waits, 1500)
+
+
+class TestLazyImport(unittest.TestCase):
+    """Tests for lazyimport"""
+
+    def test_lazy_import(self):
+        import sys
+
+        sys.modules.pop('colorsys', None)
+        colorsys = lazyimport.lazy_import('colorsys')
+        self.assertIs(sys.modules['colorsys'], colorsys)
+        # type() is the one thing that doesn't load it
+        self.assertIsNot(type(colorsys), type(sys))
+
+        self.assertIs(lazyimport.load(colorsys), colorsys)
+        self.assertIs(type(colorsys), type(sys))
+        self.assertEqual(colorsys.rgb_to_hsv(1, 0, 0), (0, 1, 1))
+        self.assertIs(lazyimport.lazy_import('colorsys'), colorsys)
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for the metrics classes"""
+
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+
+    def test_counter(self):
+        events = self.registry.counter('events_total', "Events", 'type')
+        events.inc('message')
+        events.inc('message')
+        events.inc('hello')
+        self.assertEqual(events.value('message'), 2)
+        self.assertEqual(events.value('goodbye'), 0)
+        self.assertEqual(self.registry.render(),
+                         '# HELP events_total Events\n'
+                         '# TYPE events_total counter\n'
+                         'events_total{type="message"} 2\n'
+                         'events_total{type="hello"} 1\n')
+
+    def test_gauge(self):
+        depths = {'C1': 3}
+        self.registry.gauge('depth', "Depth", 'channel', callback=lambda: depths)
+        self.registry.gauge('up', "Up").set(1)
+        depths['C2'] = 0
+        self.assertIn('depth{channel="C1"} 3\ndepth{channel="C2"} 0\n', self.registry.render())
+        self.assertIn('\nup 1\n', self.registry.render())
+
+    def test_histogram(self):
+        stages = self.registry.histogram('stage_seconds', "Stages", 'stage', buckets=(0.01, 0.1))
+        stages.observe(0.005, 'decode')
+        stages.observe(0.05, 'decode')
+        stages.observe(5, 'decode')
+        stages.observe(0.01, 'send')
+        self.assertEqual(stages.count('decode'), 3)
+
+        rendered = self.registry.render()
+        self.assertIn('stage_seconds_bucket{stage="decode",le="0.01"} 1\n'
+                      'stage_seconds_bucket{stage="decode",le="0.1"} 2\n'
+                      'stage_seconds_bucket{stage="decode",le="+Inf"} 3\n'
+                      'stage_seconds_sum{stage="decode"} 5.055\n'
+                      'stage_seconds_count{stage="decode"} 3\n', rendered)
+        self.assertIn('stage_seconds_bucket{stage="send",le="0.01"} 1\n', rendered)
+
+    def test_serve(self):
+        self.registry.counter('hits_total', "Hits").inc()
+
+        async def scrape():
+            server = await self.registry.serve(port=0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            response = await reader.read()
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return response
+
+        response = qbot.EVENT_LOOP.run_until_complete(scrape())
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 OK'))
+        self.assertTrue(response.endswith(b'hits_total 1\n'))
+
+    def test_queue_metrics(self):
+        renders = metrics.STAGE_SECONDS.count('render')
+        q = myqueue.Queue()
+        q.override(['a', 'b'])
+        str(q)
+        str(q)
+        self.assertEqual(metrics.STAGE_SECONDS.count('render'), renders + 1)
+
+        registry = myqueue.QueueRegistry()
+        registry.get('C1').push('a')
+        registry.get('C2')
+        self.assertEqual(registry.depths(), {'C1': 1, 'C2': 0})
+
+
+class TestLogs(unittest.TestCase):
+    """Tests for the background logging helpers"""
+
+    def setUp(self):
+        import io
+
+        self.stream = io.StringIO()
+        logs.setup('INFO', stream=self.stream, sample_rates={'presence_change': 0.25})
+
+    def tearDown(self):
+        logs.stop()
+        logs.set_level('WARNING')
+
+    def output(self):
+        """Stop the background writer and return everything it wrote"""
+        logs.stop()
+        return self.stream.getvalue()
+
+    def test_levels(self):
+        logs.LOGGER.debug("hidden")
+        logs.LOGGER.info("shown %s", 1)
+        logs.set_level('DEBUG')
+        logs.LOGGER.debug("now shown", extra=logs.fields(event_type='message', user='<@A>'))
+
+        lines = self.output().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith("INFO shown 1"))
+        self.assertTrue(lines[1].endswith("DEBUG now shown event_type='message' user='<@A>'"))
+
+    def test_toggle_debug(self):
+        logs.toggle_debug()
+        self.assertTrue(logs.LOGGER.isEnabledFor(logs.logging.DEBUG))
+        logs.toggle_debug()
+        self.assertFalse(logs.LOGGER.isEnabledFor(logs.logging.DEBUG))
+
+    def test_sampling(self):
+        for i in range(8):
+            logs.LOGGER.info("presence %d", i, extra=logs.fields(event_type='presence_change'))
+        logs.LOGGER.info("message", extra=logs.fields(event_type='message'))
+        logs.LOGGER.warning("presence trouble", extra=logs.fields(event_type='presence_change'))
+
+        output = self.output()
+        self.assertIn("presence 0", output)
+        self.assertIn("presence 4", output)
+        self.assertNotIn("presence 1", output)
+        self.assertIn("message", output)
+        self.assertIn("presence trouble", output)
+
+    def test_log_event(self):
+        logs.set_level('DEBUG')
+        for i in range(8):
+            logs.log_event('presence_change', "presence %d", i, user='<@A>')
+        logs.log_event('message', "message")
+
+        lines = self.output().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].endswith("presence 4 event_type='presence_change' user='<@A>'"))
+
+    def test_formatting_is_deferred(self):
+        class Slow(object):
+            formatted_in = None
+
+            def __repr__(self):
+                import threading
+                Slow.formatted_in = threading.current_thread()
+                return "slow"
+
+        import threading
+        logs.LOGGER.info("event %r", Slow())
+        self.output()
+        self.assertIsNotNone(Slow.formatted_in)
+        self.assertIsNot(Slow.formatted_in, threading.current_thread())
 
 
 class TestQueue(unittest.TestCase):
@@ -94,6 +1775,17 @@ class TestQueue(unittest.TestCase):
         found_second = self.q.has_user('second')
         self.assertTrue(found_second)
 
+    def test_queue_len(self):
+        self.assertEqual(len(self.q), 3)
+        self.q.remove('none')
+        self.q.remove('second')
+        self.q.pop()
+        self.assertEqual(len(self.q), 1)
+        self.q.override(['a', 'b'])
+        self.assertEqual(len(self.q), 2)
+        self.q.empty()
+        self.assertEqual(len(self.q), 0)
+
     def test_queue_is_empty(self):
         self.assertTrue(self.empty_q.is_empty())
         self.assertFalse(self.q.is_empty())
@@ -112,6 +1804,42 @@ class TestQueue(unittest.TestCase):
         self.q.override([])
         self.assertTrue(self.q.is_empty())
 
+    def test_queue_override_diff(self):
+        for indexed, priority in [(False, False), (True, False), (True, True)]:
+            q = myqueue.Queue(indexed=indexed, priority=priority)
+            q.override(['a', 'b', 'c', 'd', 'e'])
+            nodes = {node.data: node for node in q._list.all()}
+
+            changes = q.override(['b', 'c', 'd', 'a', 'f'])
+            self.assertEqual(changes, myqueue.QueueChanges(added=['f'], removed=['e'], moved=['a']))
+            self.assertEqual(q.users(), ['b', 'c', 'd', 'a', 'f'])
+            self.assertEqual(len(q), 5)
+            # Everyone who stayed kept their entry
+            for node in q._list.all():
+                if node.data != 'f':
+                    self.assertIs(node, nodes[node.data])
+
+            self.assertEqual(q.override(q.users()), ([], [], []))
+            q.remove('a')
+            q.push('a')
+            self.assertTrue(q.has_user('a'))
+            self.assertEqual(q.users(), ['b', 'c', 'd', 'f', 'a'])
+
+        # Linked lists stay linked both ways
+        ll = myqueue.IndexedLinkedList()
+        ll.override(['a', 'b', 'a'])
+        ll.override(['a', 'c', 'a'])
+        self.assertEqual([(node.prev and node.prev.data, node.data) for node in ll.all()],
+                         [(None, 'a'), ('a', 'c'), ('c', 'a')])
+        self.assertEqual(ll.tail.data, 'a')
+
+    def test_diff_users(self):
+        self.assertEqual(myqueue.diff_users([], ['a']), (['a'], [], []))
+        self.assertEqual(myqueue.diff_users(['a', 'b', 'c', 'd'], ['d', 'a', 'b', 'c']),
+                         ([], [], ['d']))
+        self.assertEqual(myqueue.diff_users(['a', 'b', 'c'], ['c', 'b', 'a']), ([], [], ['c', 'b']))
+        self.assertEqual(myqueue.diff_users(['a', 'b', 'a'], ['a', 'b']), ([], ['a'], []))
+
     def test_queue_str(self):
         str_q = str(self.q)
         self.assertEqual(str_q, "QUEUE = [ first second last ]")
@@ -120,6 +1848,350 @@ class TestQueue(unittest.TestCase):
         empty_str_q = str(self.empty_q)
         self.assertEqual(empty_str_q, "QUEUE = [ :only: ]")
 
+    def test_queue_str_cache(self):
+        str_q = str(self.q)
+        self.assertIs(str(self.q), str_q)
+
+        # Nothing removed, so nothing changed
+        version = self.q.version
+        self.q.remove('none')
+        self.assertEqual(self.q.version, version)
+        self.assertIs(str(self.q), str_q)
+
+        self.q.push('another last')
+        self.assertEqual(str(self.q), "QUEUE = [ first second last another last ]")
+        self.q.pop()
+        self.assertEqual(str(self.q), "QUEUE = [ second last another last ]")
+        self.q.override(['a'])
+        self.assertEqual(str(self.q), "QUEUE = [ a ]")
+        self.q.empty()
+        self.assertIn(str(self.q)[len("QUEUE = [ :"):-len(": ]")], self.q.emoji)
+
+    def test_queue_priority(self):
+        self.assertRaises(ValueError, self.q.push, 'blocked', 1)
+        self.assertRaises(ValueError, self.q.reprioritize, 'first', 1)
+
+        calls = []
+        q = myqueue.Queue(journal=lambda *change: calls.append(change), priority=True)
+        q.push('first')
+        q.push('second')
+        q.push('blocked', 1)
+        q.push('last')
+        self.assertEqual(str(q), "QUEUE = [ blocked first second last ]")
+        self.assertEqual(q.peek(), 'blocked')
+        self.assertTrue(q.has_user('last'))
+
+        q.reprioritize('last', 2)
+        q.reprioritize('none', 2)
+        self.assertEqual(str(q), "QUEUE = [ last blocked first second ]")
+        q.pop()
+        q.remove('first')
+        self.assertEqual(q.users(), ['blocked', 'second'])
+        self.assertEqual(q.entries(), [['blocked', 1], ['second', 0]])
+        self.assertEqual(len(q), 2)
+
+        q.override([['a', 0], ['b', 5], 'c'])
+        self.assertEqual(q.users(), ['b', 'a', 'c'])
+        self.assertEqual(calls[2], ('push', 'blocked', 1))
+        self.assertEqual(calls[4], ('reprioritize', 'last', 2))
+        self.assertEqual(len(calls), 8)
+
+
+class TestQueueRegistry(unittest.TestCase):
+    """Tests for the QueueRegistry class"""
+
+    def setUp(self):
+        self.now = 0
+        self.registry = myqueue.QueueRegistry(idle_timeout=10, clock=lambda: self.now)
+
+    def test_get(self):
+        self.assertNotIn('C1', self.registry)
+
+        q = self.registry.get('C1')
+        self.assertIsInstance(q, myqueue.Queue)
+        self.assertIs(self.registry.get('C1'), q)
+        self.assertIsNot(self.registry.get('C2'), q)
+        self.assertEqual(len(self.registry), 2)
+
+    def test_restore(self):
+        self.registry.get('C1').push('<@A>')
+        self.registry.restore({'C1': ['<@B>'], 'C2': ['<@C>', '<@D>'], 'C3': []})
+
+        # Saved queues count as there before they're built
+        self.assertIn('C2', self.registry)
+        self.assertNotIn('C3', self.registry)
+        self.assertEqual(len(self.registry), 2)
+        self.assertEqual(self.registry.state(), {'C1': ['<@B>'], 'C2': ['<@C>', '<@D>']})
+        self.registry.get('C2').pop()
+        self.assertEqual(self.registry.get('C2').users(), ['<@D>'])
+        self.assertEqual(self.registry.depths(), {'C1': 1, 'C2': 1})
+
+    def test_lock(self):
+        lock = self.registry.lock('C1')
+        self.assertIs(self.registry.lock('C1'), lock)
+        self.assertIsNot(self.registry.lock('C2'), lock)
+
+    def test_evict_idle(self):
+        self.registry.get('C1')
+        self.registry.get('C2').push('<@A>')
+        self.registry.lock('chatty')
+
+        self.now = 5
+        self.registry.get('C3')
+        self.assertEqual(self.registry.evict_idle(), [])
+
+        # C2 is idle but still has someone waiting, so it stays
+        self.now = 12
+        self.assertEqual(self.registry.evict_idle(), ['C1'])
+        self.assertIn('C2', self.registry)
+        self.assertIn('C3', self.registry)
+        self.assertNotIn('chatty', self.registry._locks)
+
+        self.now = 20
+        self.assertEqual(self.registry.evict_idle(), ['C3'])
+        self.assertEqual(len(self.registry), 1)
+
+
+class TestQueueJournal(unittest.TestCase):
+    """Tests for the QueueJournal class"""
+
+    def setUp(self):
+        import tempfile
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.journal = journal.QueueJournal(self.tmp_dir.name, flush_every=2)
+        self.registry = myqueue.QueueRegistry(journal=self.journal)
+
+    def tearDown(self):
+        self.journal.close()
+        self.tmp_dir.cleanup()
+
+    def reload(self):
+        """Return a new registry restored from the journal directory"""
+
+        self.journal.close()
+        self.journal = journal.QueueJournal(self.tmp_dir.name)
+        registry = myqueue.QueueRegistry(journal=self.journal)
+        self.journal.load(registry)
+        return registry
+
+    def test_queue_journal_calls(self):
+        calls = []
+        q = myqueue.Queue(journal=lambda *change: calls.append(change))
+        q.push('a')
+        q.push('b')
+        q.remove('none')
+        q.remove('b')
+        q.pop()
+        q.pop()
+        q.override(['c', 'd'])
+        # Overriding with what's already there changes nothing
+        version = q.version
+        self.assertEqual(q.override(['c', 'd']), ([], [], []))
+        self.assertEqual(q.version, version)
+        q.empty()
+        self.assertEqual(calls, [('push', 'a'), ('push', 'b'), ('remove', 'b'), ('pop',),
+                                 ('override', ['c', 'd']), ('empty',)])
+
+    def test_record_and_sync(self):
+        self.registry.get('C1').push('<@A>')
+        self.assertEqual(self.journal._unsynced, 1)
+        with open(self.journal.journal_path) as journal_file:
+            self.assertEqual(journal_file.read(), '')
+
+        # Every flush_every changes are flushed, but only sync() fsyncs them
+        self.registry.get('C1').push('<@B>')
+        self.assertEqual(self.journal._unsynced, 2)
+        with open(self.journal.journal_path) as journal_file:
+            self.assertEqual(journal_file.read().splitlines(),
+                             ['[1, "C1", "push", "<@A>"]', '[2, "C1", "push", "<@B>"]'])
+        self.journal.sync()
+        self.assertEqual(self.journal._unsynced, 0)
+
+    def test_load(self):
+        self.registry.get('C1').override(['<@A>', '<@B>', '<@C>'])
+        self.registry.get('C1').pop()
+        self.registry.get('C2').push('<@D>')
+        self.registry.get('C1').remove('<@C>')
+        self.journal.sync()
+
+        restored = self.reload()
+        self.assertEqual(restored.state(), {'C1': ['<@B>'], 'C2': ['<@D>']})
+
+        # Changes after a restore keep being journaled
+        restored.get('C2').push('<@E>')
+        self.assertEqual(self.reload().state(), {'C1': ['<@B>'], 'C2': ['<@D>', '<@E>']})
+
+    def test_load_after_snapshot(self):
+        self.registry.get('C1').push('<@A>')
+        self.journal.snapshot(self.registry)
+        self.registry.get('C1').push('<@B>')
+        self.journal.sync()
+
+        # Pretend we crashed before the journal was truncated, and again mid-write
+        with open(self.journal.journal_path, 'r+') as journal_file:
+            tail = journal_file.read()
+            journal_file.seek(0)
+            journal_file.write('[1, "C1", "push", "<@A>"]\n' + tail + '[3, "C1", "pu')
+
+        self.assertEqual(self.reload().state(), {'C1': ['<@A>', '<@B>']})
+        self.assertEqual(self.journal.seq, 2)
+
+    def test_snapshot_in_steps(self):
+        self.registry.get('C1').push('<@A>')
+        self.registry.get('C1').push('<@B>')
+        snapshot = self.journal.start_snapshot(self.registry)
+
+        # Changes recorded while the snapshot is being written stay in the journal
+        self.registry.get('C1').remove('<@A>')
+        self.registry.get('C2').push('<@C>')
+        self.journal.write_snapshot(*snapshot)
+        self.journal.finish_snapshot()
+        self.assertEqual(self.journal._since_snapshot, 2)
+        self.assertEqual(self.journal._unsynced, 2)
+        with open(self.journal.journal_path) as journal_file:
+            self.assertEqual(journal_file.read().splitlines(),
+                             ['[3, "C1", "remove", "<@A>"]', '[4, "C2", "push", "<@C>"]'])
+
+        self.registry.get('C2').push('<@D>')
+        self.journal.finish_snapshot()
+        self.journal.sync()
+        self.assertEqual(self.reload().state(), {'C1': ['<@B>'], 'C2': ['<@C>', '<@D>']})
+
+    def test_start_sync(self):
+        self.assertIsNone(self.journal.start_sync())
+        self.registry.get('C1').push('<@A>')
+        fd = self.journal.start_sync()
+        self.assertEqual(self.journal._unsynced, 0)
+
+        # The descriptor outlives the journal closing
+        self.journal.close()
+        self.journal.fsync(fd)
+        self.assertEqual(self.reload().state(), {'C1': ['<@A>']})
+
+    def test_load_damaged_journal(self):
+        self.registry.get('C1').push('<@A>')
+        self.registry.get('C1').push('<@B>')
+        self.registry.get('C1').pop()
+        self.journal.sync()
+        with open(self.journal.journal_path) as journal_file:
+            lines = journal_file.read().splitlines(True)
+
+        # A damaged change with others after it isn't a crash mid-write, so it
+        # refuses to load rather than drop the changes after it
+        with open(self.journal.journal_path, 'w') as journal_file:
+            journal_file.write(lines[0] + '[2, "C1", "pu\n' + lines[2])
+        with self.assertLogs(journal.LOGGER, 'ERROR'):
+            with self.assertRaisesRegex(ValueError, 'damaged at line 2'):
+                self.reload()
+        self.journal.close()
+        with open(self.journal.journal_path) as journal_file:
+            self.assertEqual(journal_file.read(), lines[0] + '[2, "C1", "pu\n' + lines[2])
+
+        # The same damage on the last line (even with blank lines after it) is skipped
+        with open(self.journal.journal_path, 'w') as journal_file:
+            journal_file.write(''.join(lines[:2]) + '[3, "C1", "po\n\n')
+        self.assertEqual(self.reload().state(), {'C1': ['<@A>', '<@B>']})
+
+    def test_load_priorities(self):
+        self.registry = myqueue.QueueRegistry(journal=self.journal, priority=True)
+        self.registry.get('C1').push('<@A>')
+        self.registry.get('C1').push('<@B>', 1)
+        self.journal.snapshot(self.registry)
+        self.registry.get('C1').push('<@C>', 2)
+        self.registry.get('C1').reprioritize('<@A>', 3)
+        self.journal.sync()
+
+        self.journal.close()
+        self.journal = journal.QueueJournal(self.tmp_dir.name)
+        restored = myqueue.QueueRegistry(journal=self.journal, priority=True)
+        self.journal.load(restored)
+        self.assertEqual(restored.state(), {'C1': [['<@A>', 3], ['<@C>', 2], ['<@B>', 1]]})
+
+
+    def test_pack_state(self):
+        state = {'C1': ['<@A>', '<@B>'], 'C2': [['<@B>', 2], ['<@C>', 1]],
+                 'C3': [['<@D>', 0.5]], 'C4': []}
+        packed = journal.pack_state(7, state)
+        self.assertEqual(journal.unpack_state(packed), (7, state))
+        self.assertEqual(journal.unpack_state(journal.pack_state(0, {})), (0, {}))
+
+        self.assertRaises(ValueError, journal.unpack_state, b'{"seq": 0}' + bytes(16))
+        self.assertRaises(ValueError, journal.pack_state, 0, {'C1': ['<@A>\0']})
+
+    def test_unpack_damaged_state(self):
+        packed = journal.pack_state(7, {'C1': ['<@A>', '<@B>'], 'C2': [['<@B>', 2]]})
+
+        # Cut off anywhere, or with junk on the end
+        for end in range(len(packed)):
+            self.assertRaises(ValueError, journal.unpack_state, packed[:end])
+        self.assertRaises(ValueError, journal.unpack_state, packed + b'\0')
+
+        # A user index past the end of the string table (C2's user, before its priority)
+        damaged = bytearray(packed)
+        self.assertEqual(damaged[-12:-8], (2).to_bytes(4, 'little'))
+        damaged[-12:-8] = (99).to_bytes(4, 'little')
+        self.assertRaises(ValueError, journal.unpack_state, bytes(damaged))
+
+    def test_load_damaged_snapshot(self):
+        self.registry.get('C1').override(['<@A>', '<@B>'])
+        self.journal.snapshot(self.registry)
+        self.registry.get('C1').pop()
+        self.registry.get('C1').push('<@C>')
+        self.journal.sync()
+        with open(self.journal.snapshot_path, 'r+b') as snapshot_file:
+            snapshot_file.truncate(20)
+            snapshot_file.seek(0)
+            damaged = snapshot_file.read()
+        with open(self.journal.journal_path, 'rb') as journal_file:
+            changes = journal_file.read()
+
+        # Replaying the journal alone would leave C1 as [<@C>] rather than
+        # [<@B>, <@C>], so it refuses to load, and leaves everything as it was
+        with self.assertLogs(journal.LOGGER, 'ERROR'):
+            with self.assertRaisesRegex(ValueError, 'is damaged'):
+                self.reload()
+        self.journal.close()
+        with open(self.journal.snapshot_path, 'rb') as snapshot_file:
+            self.assertEqual(snapshot_file.read(), damaged)
+        with open(self.journal.journal_path, 'rb') as journal_file:
+            self.assertEqual(journal_file.read(), changes)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)), ['journal.jsonl', 'snapshot.bin'])
+
+        # Setting both aside starts afresh
+        os.rename(self.journal.snapshot_path, self.journal.snapshot_path + '.bad')
+        os.rename(self.journal.journal_path, self.journal.journal_path + '.bad')
+        self.assertEqual(self.reload().state(), {})
+
+    def test_load_json_snapshot(self):
+        # Snapshots from before the binary format still load, and get converted
+        self.journal.close()
+        with open(self.journal.json_snapshot_path, 'w') as snapshot_file:
+            json.dump({'seq': 4, 'queues': {'C1': ['<@A>', '<@B>']}}, snapshot_file)
+
+        self.assertEqual(self.reload().state(), {'C1': ['<@A>', '<@B>']})
+        self.assertEqual(self.journal.seq, 4)
+        self.assertTrue(os.path.exists(self.journal.snapshot_path))
+        self.assertFalse(os.path.exists(self.journal.json_snapshot_path))
+
+    def test_load_clean(self):
+        self.registry.get('C1').push('<@A>')
+        self.journal.snapshot(self.registry)
+        modified = os.stat(self.journal.snapshot_path).st_mtime_ns
+
+        # Nothing changed since the snapshot, so loading doesn't write it again
+        registry = self.reload()
+        self.assertEqual(os.stat(self.journal.snapshot_path).st_mtime_ns, modified)
+        self.assertEqual(len(registry), 1)
+        self.assertEqual(registry.depths(), {'C1': 1})
+
+        # The queue is built when it's used, without being journaled again
+        registry.get('C1').push('<@B>')
+        self.journal.sync()
+        with open(self.journal.journal_path) as journal_file:
+            self.assertEqual(journal_file.read().splitlines(), ['[2, "C1", "push", "<@B>"]'])
+        self.assertEqual(self.reload().state(), {'C1': ['<@A>', '<@B>']})
+
 
 class TestLinkedList(unittest.TestCase):
     """Tests for the Linked List (and Node) class"""
@@ -206,9 +2278,338 @@ class TestLinkedList(unittest.TestCase):
         self.assertEqual(repr(self.ll), "<Linked List: head=a tail=d>")
 
 
+class TestIndexedLinkedList(unittest.TestCase):
+    """Tests for the Indexed Linked List (and DoubleNode) class"""
+
+    def setUp(self):
+        self.ll = myqueue.IndexedLinkedList()
+        self.ll.append('a')
+        self.ll.append('b')
+        self.ll.append('c')
+        self.ll.append('d')
+
+    def test_ll_append(self):
+        self.assertEqual(self.ll.head.data, 'a')
+        self.assertIsNone(self.ll.head.prev)
+        self.assertEqual(self.ll.tail.data, 'd')
+        self.assertEqual(self.ll.tail.prev.data, 'c')
+
+    def test_ll_remove(self):
+        self.assertIsNone(self.ll.remove('empty'))
+
+        found_mid = self.ll.remove('b')
+        # a <-> c <-> d
+        self.assertEqual(found_mid.data, 'b')
+        self.assertIs(self.ll.head.next.prev, self.ll.head)
+        self.assertEqual(self.ll.head.next.data, 'c')
+
+        self.ll.remove('a')
+        self.ll.remove('d')
+        # c
+        self.assertIs(self.ll.head, self.ll.tail)
+        self.assertIsNone(self.ll.head.prev)
+
+        self.ll.remove('c')
+        self.assertIsNone(self.ll.head)
+        self.assertIsNone(self.ll.tail)
+        self.assertFalse(self.ll.find('c'))
+
+    def test_ll_duplicates(self):
+        self.ll.append('a')
+        found_a = self.ll.remove('a')
+        self.assertIsNone(found_a.prev)
+        self.assertEqual(self.ll.head.data, 'b')
+        self.assertTrue(self.ll.find('a'))
+
+        self.ll.remove('a')
+        self.assertFalse(self.ll.find('a'))
+        self.assertEqual(self.ll.tail.data, 'd')
+
+    def test_ll_find(self):
+        self.assertFalse(self.ll.find('x'))
+        self.assertTrue(self.ll.find('c'))
+
+    def test_indexed_queue(self):
+        q = myqueue.Queue(indexed=True)
+        self.assertIsInstance(q._list, myqueue.IndexedLinkedList)
+
+        q.override(['first', 'second', 'last'])
+        q.remove('second')
+        self.assertTrue(q.has_user('last'))
+        self.assertFalse(q.has_user('second'))
+        self.assertEqual(str(q), "QUEUE = [ first last ]")
+
+        q.pop()
+        self.assertEqual(q.peek(), 'last')
+
+        q.empty()
+        self.assertIsInstance(q._list, myqueue.IndexedLinkedList)
+        self.assertTrue(q.is_empty())
+
+
+# Messages for checking classify against the individual parsing functions
+MESSAGE_CORPUS = [
+    "", "   ", "Enqueue", "nqueue me~", "   enq me please", "ENQ!!!", "nqqqqqqq",
+    "enqueueis at the start", "I have enqueue in the message", "Dequeue",
+    "dqueue dairy queen", "   deq me please thx", "dq <@U12345678>", "OMW <@U12345678>!",
+    "omw", "omwww <@U1>", "dq <@x> <@y>", "DQ!!!", "dequeueis at the start",
+    "qbot!! help!!", "  QUEUEbot come help me thx", "queuebot to the rescue",
+    "i hope qbot will help me", "qbot is a helpful dood", "qbot help status",
+    "qbot!! status!!", "q  status?", "  queue status please!!", "queuebot give me the stats",
+    "q is a statusupdating thing", "QUEUE.empty()", "Q.CLear(    )", "q=[]",
+    "   queue    =   [         ]", "Queue = [ <@U1234> <@xyz>   ]",
+    "Queue = [ <@U1234> <@xyz> typo ]", "Queue = <@fake> <@wrong>",
+    "nq and also q = [ <@A> ]", "dq <@A> then q.clear()", "qbot help\nq.empty()",
+    "qbot\nhelp", "q\nstatus", "<@U1> nq", "nq <@U1>", "\tomw <@U2>\n",
+]
+
+
+class TestCompactList(unittest.TestCase):
+    """Tests for the Compact List (and InternTable) class"""
+
+    def setUp(self):
+        self.table = myqueue.InternTable()
+        self.cl = myqueue.CompactList(self.table)
+        for value in 'abcd':
+            self.cl.append(value)
+
+    def test_intern_table(self):
+        self.assertEqual(self.table.id_for('a'), 0)
+        self.assertEqual(self.table.id_for('e'), 4)
+        self.assertIsNone(self.table.get_id('f'))
+        self.assertEqual(len(self.table), 5)
+
+        # Lists share the default table
+        myqueue.CompactList().append('<@shared>')
+        self.assertIsNotNone(myqueue.USER_IDS.get_id('<@shared>'))
+
+    def test_cl_remove(self):
+        self.assertIsNone(self.cl.remove('empty'))
+        self.assertEqual(self.cl.remove('b').data, 'b')
+        self.assertEqual(self.cl._tombstones, 1)
+        self.assertFalse(self.cl.find('b'))
+        self.assertEqual(self.cl.values(), ['a', 'c', 'd'])
+
+        # Tombstones at the ends are dropped right away
+        self.cl.remove('a')
+        self.assertEqual(self.cl.head.data, 'c')
+        self.assertEqual(self.cl._tombstones, 0)
+        self.cl.remove('d')
+        self.cl.remove('c')
+        self.assertIsNone(self.cl.head)
+        self.assertEqual(len(self.cl), 0)
+
+    def test_cl_ring(self):
+        # Keep pushing and popping so the entries wrap around the buffer
+        for i in range(20):
+            self.cl.append(f'u{i}')
+            self.cl.remove(self.cl.head.data)
+        self.assertEqual(len(self.cl._slots), myqueue.CompactList.MIN_CAPACITY)
+        self.assertEqual(self.cl.values(), [f'u{i}' for i in range(16, 20)])
+
+        self.cl.remove('u17')
+        self.assertEqual([entry.data for entry in self.cl.all()], ['u16', 'u18', 'u19'])
+
+    def test_cl_grow_and_compact(self):
+        for i in range(100):
+            self.cl.append(f'u{i}')
+        self.assertEqual(len(self.cl._slots), 128)
+
+        for i in range(0, 100, 2):
+            self.cl.remove(f'u{i}')
+        self.assertLess(self.cl._tombstones, 52)
+        self.assertEqual(self.cl.values(), list('abcd') + [f'u{i}' for i in range(1, 100, 2)])
+
+        # Draining the list shrinks the buffer again
+        while self.cl.head:
+            self.cl.remove(self.cl.head.data)
+        self.assertEqual(len(self.cl._slots), myqueue.CompactList.MIN_CAPACITY)
+
+    def test_cl_duplicates(self):
+        self.cl.append('a')
+        self.cl.remove('a')
+        self.assertTrue(self.cl.find('a'))
+        self.assertEqual(self.cl.values(), ['b', 'c', 'd', 'a'])
+
+    def test_cl_random(self):
+        import random
+
+        rand = random.Random(18)
+        indexed = myqueue.IndexedLinkedList()
+        for value in 'abcd':
+            indexed.append(value)
+        for _ in range(5000):
+            value = f'u{rand.randrange(50)}'
+            action = rand.random()
+            if action < 0.4:
+                self.cl.append(value)
+                indexed.append(value)
+            elif action < 0.7:
+                self.assertEqual(bool(self.cl.remove(value)), bool(indexed.remove(value)))
+            elif indexed.head:
+                self.cl.remove(self.cl.head.data)
+                indexed.remove(indexed.head.data)
+            self.assertEqual(self.cl.find(value), indexed.find(value))
+        self.assertEqual(self.cl.values(), indexed.values())
+
+        # The table's counts match what's in the list
+        values = self.cl.values()
+        for value_id, value in enumerate(self.table.values):
+            self.assertEqual(self.table.counts[value_id], values.count(value))
+
+    def test_cl_counts(self):
+        other = myqueue.CompactList(self.table)
+        other.append('a')
+        other.append('e')
+        self.assertEqual(list(self.table.counts), [2, 1, 1, 1, 1])
+
+        # A value in another list is still found by scanning
+        self.assertFalse(self.cl.find('e'))
+        other.override(['b'])
+        self.assertEqual(list(self.table.counts), [1, 2, 1, 1, 0])
+        self.assertIsNone(self.cl.remove('e'))
+
+        # Dropping a list takes its entries out of the counts
+        del other
+        self.assertEqual(list(self.table.counts), [1, 1, 1, 1, 0])
+
+    def test_cl_search_windows(self):
+        for i in range(3000):
+            self.cl.append(f'u{i}')
+        # Wrap the entries around the end of the buffer
+        for _ in range(1100):
+            self.cl.append(self.cl.head.data)
+            self.cl.remove(self.cl.head.data)
+        self.assertGreater(self.cl._start + self.cl._used, len(self.cl._slots))
+        for value in ('u0', 'u1023', 'u1024', 'u2999', 'a', 'd'):
+            self.assertTrue(self.cl.find(value), value)
+        self.assertEqual(self.cl.remove('u2000').data, 'u2000')
+        self.assertFalse(self.cl.find('u2000'))
+
+    def test_compact_queue(self):
+        q = myqueue.Queue(compact=True)
+        q.push('first')
+        q.push('second')
+        self.assertEqual(str(q), "QUEUE = [ first second ]")
+        self.assertEqual(q.override(['second', 'last']), (['last'], ['first'], []))
+        q.pop()
+        self.assertEqual((q.peek(), len(q)), ('last', 1))
+        self.assertTrue(q.has_user('last'))
+
+
+class TestIndexedHeap(unittest.TestCase):
+    """Tests for the Indexed Heap (and HeapNode) class"""
+
+    def setUp(self):
+        self.heap = myqueue.IndexedHeap()
+        for data, priority in [('a', 0), ('b', 1), ('c', 0), ('d', 2), ('e', 1)]:
+            self.heap.append(data, priority)
+
+    def order(self):
+        return [node.data for node in self.heap.all()]
+
+    def check_positions(self):
+        for pos, node in enumerate(self.heap._heap):
+            self.assertEqual(node.pos, pos)
+            if pos:
+                self.assertGreaterEqual(node.key, self.heap._heap[(pos - 1) // 2].key)
+
+    def test_heap_order(self):
+        # Highest priority first, first come first served within a priority
+        self.assertEqual(self.order(), ['d', 'b', 'e', 'a', 'c'])
+        self.assertEqual(self.heap.head.data, 'd')
+        self.check_positions()
+
+    def test_heap_remove(self):
+        self.assertIsNone(self.heap.remove('empty'))
+
+        popped = [self.heap.remove(self.heap.head.data).data for _ in range(5)]
+        self.assertEqual(popped, ['d', 'b', 'e', 'a', 'c'])
+        self.assertIsNone(self.heap.head)
+
+        self.setUp()
+        self.assertEqual(self.heap.remove('b').data, 'b')
+        self.assertFalse(self.heap.find('b'))
+        self.assertEqual(self.order(), ['d', 'e', 'a', 'c'])
+        self.check_positions()
+
+    def test_heap_reprioritize(self):
+        self.assertIsNone(self.heap.reprioritize('empty', 5))
+
+        self.heap.reprioritize('c', 5)
+        self.heap.reprioritize('d', 0)
+        # d keeps its place among priority 0 by when it came in
+        self.assertEqual(self.order(), ['c', 'b', 'e', 'a', 'd'])
+        self.check_positions()
+
+    def test_heap_duplicates(self):
+        self.heap.append('a', 3)
+        self.assertEqual(self.heap.head.data, 'a')
+        self.assertEqual(self.heap.remove('a').priority, 3)
+        self.assertTrue(self.heap.find('a'))
+        self.assertEqual(self.order(), ['d', 'b', 'e', 'a', 'c'])
+
+    def test_heap_random(self):
+        import random
+
+        rand = random.Random(15)
+        self.heap = myqueue.IndexedHeap()
+        expected = {}
+        for i in range(2000):
+            value = rand.randrange(200)
+            if value in expected and rand.random() < 0.5:
+                if rand.random() < 0.5:
+                    self.heap.remove(value)
+                    del expected[value]
+                else:
+                    self.heap.reprioritize(value, rand.randrange(5))
+                    expected[value] = (-self.heap._index[value][0].priority,
+                                       self.heap._index[value][0].seq)
+            elif value not in expected:
+                self.heap.append(value, rand.randrange(5))
+                node = self.heap._index[value][0]
+                expected[value] = (-node.priority, node.seq)
+        self.check_positions()
+        self.assertEqual(self.order(), sorted(expected, key=expected.get))
+
+
 class TestParsing(unittest.TestCase):
     """Tests for parsing helper functions"""
 
+    def test_lazy_regexes(self):
+        self.assertEqual(parsing.USER_RE.findall("hi <@A> and <@B>"), ['<@A>', '<@B>'])
+        self.assertIs(parsing.USER_RE, parsing.USER_RE)
+        with self.assertRaises(AttributeError):
+            parsing.NOT_A_RE
+
+    def test_classify_matches_functions(self):
+        for text in MESSAGE_CORPUS:
+            new_queue = parsing.get_queue_change(text)
+            if new_queue is not None:
+                expected = (parsing.OVERRIDE, new_queue)
+            elif parsing.is_dequeue_message(text):
+                expected = (parsing.DEQUEUE, parsing.get_user_to_pop(text))
+            elif parsing.is_enqueue_message(text):
+                expected = (parsing.ENQUEUE, None)
+            elif parsing.is_help_message(text):
+                expected = (parsing.HELP, None)
+            elif parsing.is_status_message(text):
+                expected = (parsing.STATUS, None)
+            else:
+                expected = None
+
+            command = parsing.classify(text)
+            if command is None:
+                actual = None
+            elif command.kind == parsing.OVERRIDE:
+                actual = (command.kind, command.new_queue)
+            elif command.kind == parsing.DEQUEUE:
+                actual = (command.kind, command.users[0] if command.users else None)
+            else:
+                actual = (command.kind, None)
+
+            self.assertEqual(actual, expected, msg=f"Text: {text!r}")
+
     def test_is_enqueue_message(self):
         enqueue_text = "Enqueue"
         self.assertTrue(parsing.is_enqueue_message(enqueue_text), msg=f"Text: {enqueue_text}")
@@ -0,0 +1,169 @@
+"""Streaming wait-time statistics in constant memory"""
+import time
+from bisect import bisect_right
+
+
+class P2Quantile(object):
+    """Running estimate of one quantile with the P-squared algorithm
+
+    Keeps five markers (the min, the max, the quantile, and two halfway
+    points) and nudges them toward where they belong as values come in, so
+    memory and the cost of an update stay the same however many values are
+    added (Jain & Chlamtac, 1985). Until five values are in, it's exact.
+    """
+
+    __slots__ = ('p', 'count', '_heights', '_positions', '_desired', '_increments')
+
+    def __init__(self, p):
+        self.p = p
+        self.count = 0
+        self._heights = []
+        self._positions = [0, 1, 2, 3, 4]
+        # Where the markers should be after the first five values, and how far
+        # that moves with each value after them
+        self._desired = (0, 2 * p, 4 * p, 2 + 2 * p, 4)
+        self._increments = (0, p / 2, p, (1 + p) / 2, 1)
+
+    def add(self, value):
+        """Add a value to the estimate"""
+
+        self.count += 1
+        heights = self._heights
+        if self.count <= 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        # Find the cell the value falls in, stretching the ends if needed
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = bisect_right(heights, value, 1, 4) - 1
+
+        positions = self._positions
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+
+        # Move the middle markers that have drifted a whole position off
+        extra = self.count - 5
+        for i in (1, 2, 3):
+            drift = self._desired[i] + extra * self._increments[i] - positions[i]
+            if ((drift >= 1 and positions[i + 1] - positions[i] > 1)
+                    or (drift <= -1 and positions[i - 1] - positions[i] < -1)):
+                step = 1 if drift > 0 else -1
+                height = self._parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + step * ((heights[i + step] - heights[i])
+                                                  / (positions[i + step] - positions[i]))
+                heights[i] = height
+                positions[i] += step
+
+    def _parabolic(self, i, step):
+        """Return the piecewise-parabolic prediction for marker i moved by step"""
+
+        heights, positions = self._heights, self._positions
+        return heights[i] + step / (positions[i + 1] - positions[i - 1]) * (
+            (positions[i] - positions[i - 1] + step) * (heights[i + 1] - heights[i])
+            / (positions[i + 1] - positions[i])
+            + (positions[i + 1] - positions[i] - step) * (heights[i] - heights[i - 1])
+            / (positions[i] - positions[i - 1]))
+
+    def value(self):
+        """Return the estimated quantile, or None if nothing has been added"""
+
+        if not self.count:
+            return None
+        if self.count <= 5:
+            return self._heights[min(int(self.p * self.count), self.count - 1)]
+        return self._heights[2]
+
+    def __repr__(self):
+        """Representation of the estimate"""
+        return f"<P2 Quantile: p={self.p} count={self.count} value={self.value()}>"
+
+
+class WaitStats(object):
+    """Wait-time quantiles over a rolling window, in fixed memory
+
+    Values go into one set of P2Quantile estimates per window seconds. The
+    latest finished window is kept too, and quantiles are read from the
+    current window once it has enough values, or else from the last one, so
+    the stats cover between one and two windows of recent waits.
+
+    Adding a wait only appends it to a short buffer; the estimates catch up
+    when they're read or the buffer fills, so popping a queue stays cheap.
+    """
+
+    # Values the current window needs before it's trusted over the last one
+    MIN_COUNT = 5
+    # Most waits to hold before adding them to the estimates
+    BUFFER_SIZE = 256
+
+    def __init__(self, window=3600, quantiles=(0.5, 0.95), clock=time.monotonic):
+        self.window = window
+        self.quantiles = tuple(quantiles)
+        self._clock = clock
+
+        self._current = self._new_window()
+        self._previous = None
+        self._window_start = clock()
+        self._buffer = []
+
+    def _new_window(self):
+        return {p: P2Quantile(p) for p in self.quantiles}
+
+    def _rotate(self):
+        """Start a new window if the current one is over"""
+
+        elapsed = self._clock() - self._window_start
+        if elapsed >= self.window:
+            self._flush()
+            # After a quiet spell, the last window is too old to keep
+            self._previous = self._current if elapsed < 2 * self.window else None
+            self._current = self._new_window()
+            self._window_start += elapsed - elapsed % self.window
+
+    def add(self, wait):
+        """Record a wait (in seconds)"""
+
+        self._rotate()
+        self._buffer.append(wait)
+        if len(self._buffer) >= self.BUFFER_SIZE:
+            self._flush()
+
+    def _flush(self):
+        """Add the buffered waits to the current window's estimates"""
+
+        if self._buffer:
+            for estimate in self._current.values():
+                for wait in self._buffer:
+                    estimate.add(wait)
+            self._buffer.clear()
+
+    def count(self):
+        """Return how many waits the quantiles are based on"""
+
+        return self._window()[self.quantiles[0]].count
+
+    def quantile(self, p):
+        """Return the estimated p quantile wait in seconds (p must be one of quantiles), or None"""
+
+        return self._window()[p].value()
+
+    def _window(self):
+        """Return the window the quantiles should be read from"""
+
+        self._rotate()
+        self._flush()
+        current = self._current[self.quantiles[0]]
+        if current.count < self.MIN_COUNT and self._previous:
+            return self._previous
+        return self._current
+
+    def __repr__(self):
+        """Representation of the stats"""
+        return f"<Wait Stats: window={self.window} count={self.count()}>"
@@ -0,0 +1,314 @@
+"""Sharding channels across worker processes behind one websocket reader"""
+import logging
+import os
+import queue
+import threading
+import time
+import zlib
+from collections import deque
+
+import parsing
+from lazyimport import lazy_import
+
+# Only needed once a pool is made
+multiprocessing = lazy_import('multiprocessing')
+
+# Seconds between each worker's reports of its queues' depths and waits,
+# and the wait quantiles reported
+REPORT_INTERVAL = 1
+REPORTED_QUANTILES = (0.5, 0.95)
+# Seconds between checks that every worker is still running
+CHECK_INTERVAL = 1
+
+# Under the bot's logger, so these go wherever its logs do
+LOGGER = logging.getLogger('qbot.workers')
+
+
+def shard_for(channel, workers):
+    """Return the index of the worker that owns a channel
+
+    Uses crc32 rather than hash(), so a channel lands on the same worker in
+    every process and across restarts (which keeps each shard's journal valid).
+    """
+
+    return zlib.crc32(channel.encode()) % workers
+
+
+def _work(index, inbox, replies, state_dir):
+    """Run one worker process: answer commands for its channels and send back replies
+
+    Commands arrive in batches of (channel, user, text) and are handled one at
+    a time, in order; each batch's replies go back as one (channel, messages,
+    rendered queue) per channel, along with the worker's index and how many
+    commands were in the batch. Every REPORT_INTERVAL seconds, and on the way
+    out, a report of the queues' depths and waits goes back too. A None batch
+    stops the worker.
+    """
+
+    # Imported here so the front process can import this module from qbot
+    import qbot
+
+    if state_dir:
+        qbot.STATE_DIR = os.path.join(state_dir, f'shard-{index}')
+        qbot.open_journal()
+
+    def report():
+        return (qbot.QUEUES.depths(), {p: qbot.QUEUES.wait_times(p) for p in REPORTED_QUANTILES})
+
+    last_evict = last_report = time.monotonic()
+    while True:
+        try:
+            batch = inbox.get(timeout=qbot.JOURNAL_SYNC_INTERVAL)
+        except queue.Empty:
+            batch = []
+        if batch is None:
+            break
+
+        # Each channel's queue is rendered once per batch
+        answered = [(channel, response_msg, str(hb_queue))
+                    for channel, response_msg, hb_queue in qbot.get_responses(batch)]
+        stats = None
+        if time.monotonic() - last_report >= REPORT_INTERVAL:
+            stats = report()
+            last_report = time.monotonic()
+        if batch or stats:
+            replies.put((index, len(batch), answered, stats))
+
+        if qbot.JOURNAL:
+            qbot.JOURNAL.sync()
+            if qbot.JOURNAL.needs_snapshot():
+                qbot.JOURNAL.snapshot(qbot.QUEUES)
+        if time.monotonic() - last_evict >= qbot.EVICT_INTERVAL:
+            qbot.QUEUES.evict_idle()
+            last_evict = time.monotonic()
+
+    replies.put((index, 0, [], report()))
+    if qbot.JOURNAL:
+        qbot.JOURNAL.snapshot(qbot.QUEUES)
+        qbot.JOURNAL.close()
+
+
+class WorkerPool(object):
+    """Worker processes that each own the queues for a share of the channels
+
+    Commands are routed by channel, so every channel's queue lives on exactly
+    one worker, and a channel's commands and replies stay in order: one inbox
+    per worker, handled in order, and one reply queue read by a single thread.
+
+    Commands are buffered and sent to the workers in batches by flush(); if a
+    loop is given, a flush is scheduled on it whenever commands are waiting.
+    deliver is called with each batch of (channel, messages, rendered queue)
+    replies (one per channel per batch a worker handles), on the loop if
+    there is one, or else on the reply thread. If state_dir is given, each
+    worker journals its queues in a shard-N subdirectory (so the number of
+    workers shouldn't change between runs).
+
+    The queues live in the workers, so depths() and wait_times() give what
+    the workers last reported (every REPORT_INTERVAL seconds).
+
+    Every CHECK_INTERVAL seconds the reply thread checks the workers are
+    still running. One that's died (killed, crashed) is started again, and
+    picks up its queues from its journal. The commands it was sent but
+    never answered aren't handled again, as it may have died partway
+    through them: each one gets a reply asking to try again instead.
+    """
+
+    def __init__(self, workers, deliver, state_dir=None, loop=None, context='spawn'):
+        self.workers = workers
+        self.deliver = deliver
+        self.state_dir = state_dir
+        self.loop = loop
+        # Workers are spawned, not forked, since the front process runs threads
+        self._context = multiprocessing.get_context(context)
+
+        self._processes = []
+        self._inboxes = []
+        self._replies = None
+        self._collector = None
+        self._pending = [[] for _ in range(workers)]
+        self._flush_scheduled = False
+        # Batches sent to each worker that it hasn't answered yet, oldest
+        # first, and the lock that keeps them in step with the inboxes
+        self._unanswered = [deque() for _ in range(workers)]
+        self._lock = threading.Lock()
+        self._stopping = False
+        # Worker index -> (depths, quantile -> waits) it last reported
+        self._reports = {}
+
+        self.submitted = 0
+        self.handled = 0
+        self.restarts = 0
+        self.failed = 0
+
+    def _start_worker(self, index):
+        """Start worker index's process, and return it and its inbox"""
+
+        inbox = self._context.Queue()
+        process = self._context.Process(target=_work, name=f'qbot-worker-{index}',
+                                        args=(index, inbox, self._replies, self.state_dir),
+                                        daemon=True)
+        process.start()
+        return process, inbox
+
+    def start(self):
+        """Start the worker processes and the reply thread, and return the pool"""
+
+        self._stopping = False
+        self._replies = self._context.Queue()
+        for index in range(self.workers):
+            process, inbox = self._start_worker(index)
+            self._inboxes.append(inbox)
+            self._processes.append(process)
+
+        self._collector = threading.Thread(target=self._collect, name='qbot-replies', daemon=True)
+        self._collector.start()
+        return self
+
+    def submit(self, channel, user, text):
+        """Queue a message to be handled by the worker that owns its channel"""
+
+        self._pending[shard_for(channel, self.workers)].append((channel, user, text))
+        self.submitted += 1
+        if self.loop and not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        """Send every buffered message to its worker"""
+
+        self._flush_scheduled = False
+        with self._lock:
+            for index, batch in enumerate(self._pending):
+                if batch:
+                    self._inboxes[index].put(batch)
+                    self._unanswered[index].append(batch)
+                    self._pending[index] = []
+
+    def _collect(self):
+        """Hand batches of replies from the workers to deliver, in the order they came"""
+
+        last_check = time.monotonic()
+        while True:
+            try:
+                item = self._replies.get(timeout=CHECK_INTERVAL)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                self._take(item)
+            if time.monotonic() - last_check >= CHECK_INTERVAL:
+                self._check_workers()
+                last_check = time.monotonic()
+
+    def _take(self, item):
+        """Deliver one item from the reply queue, and note what it answers"""
+
+        index, handled, batch, stats = item
+        if handled:
+            self.handled += handled
+            with self._lock:
+                if self._unanswered[index]:
+                    self._unanswered[index].popleft()
+        if stats:
+            self._reports[index] = stats
+        if batch:
+            self._deliver(batch)
+
+    def _deliver(self, batch):
+        """Pass a batch of replies to deliver, on the loop if there is one"""
+
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.deliver, batch)
+        else:
+            self.deliver(batch)
+
+    def _check_workers(self):
+        """Start any worker that's died again, and fail the commands it didn't answer"""
+
+        for index, process in enumerate(list(self._processes)):
+            if self._stopping or process.exitcode is None:
+                continue
+
+            # Whatever it answered before it died is still to be delivered
+            while True:
+                try:
+                    item = self._replies.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    # stop() was called meanwhile, so leave it to finish up
+                    self._replies.put(None)
+                    return
+                self._take(item)
+
+            replacement, inbox = self._start_worker(index)
+            with self._lock:
+                old_inbox = self._inboxes[index]
+                self._processes[index], self._inboxes[index] = replacement, inbox
+                unanswered = [command for batch in self._unanswered[index] for command in batch]
+                self._unanswered[index].clear()
+            # Nothing reads the old inbox anymore, so don't wait on it at exit
+            old_inbox.cancel_join_thread()
+            old_inbox.close()
+
+            failed = [(channel, user) for channel, user, text in unanswered
+                      if parsing.classify(text) is not None]
+            self.restarts += 1
+            self.failed += len(failed)
+            LOGGER.error("Worker %d exited with code %s, so started it again "
+                         "(%d command(s) it hadn't answered failed)",
+                         index, process.exitcode, len(failed))
+            if failed:
+                notices = {}
+                for channel, user in failed:
+                    notices[channel] = notices.get(channel, '') + (
+                        f"Sorry {user}, something went wrong and that didn't go through. "
+                        f"Please try again.\n")
+                self._deliver([(channel, notice, None) for channel, notice in notices.items()])
+
+    def stop(self, timeout=5):
+        """Let the workers finish what they've been sent, save their state, and exit"""
+
+        self.flush()
+        self._stopping = True
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+        # Every worker has exited, so its replies are already in the queue
+        self._replies.put(None)
+        self._collector.join(timeout)
+
+        self._processes = []
+        self._inboxes = []
+        for unanswered in self._unanswered:
+            unanswered.clear()
+
+    def depths(self):
+        """Return a dict of channel IDs to the number of users in each queue"""
+
+        depths = {}
+        for worker_depths, _ in list(self._reports.values()):
+            depths.update(worker_depths)
+        return depths
+
+    def wait_times(self, p):
+        """Return a dict of channel IDs to the p quantile wait, for queues with waits
+
+        p has to be one of REPORTED_QUANTILES.
+        """
+
+        waits = {}
+        for _, worker_waits in list(self._reports.values()):
+            waits.update(worker_waits[p])
+        return waits
+
+    def __repr__(self):
+        """Representation of the pool"""
+        return (f"<Worker Pool: workers={self.workers} "
+                f"submitted={self.submitted} handled={self.handled} "
+                f"restarts={self.restarts} failed={self.failed}>")